@@ -0,0 +1,93 @@
+"""FSM-хранилище: память, число записей в базу, переживание перезапуска и TTL.
+
+N пользователей начинают добавление книги (set_state + несколько update_data,
+как в хендлерах AddBook) и бросают его. Для MemoryStorage и SQLiteStorage
+сравнивается прирост памяти (tracemalloc), для SQLiteStorage — сколько
+транзакций ушло в базу. Затем хранилище пересоздается (имитация перезапуска),
+состояние читается заново, и после истечения TTL записи удаляются.
+
+Запуск: python benchmarks/bench_fsm_storage.py [число_пользователей]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:bench-fsm")
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import models
+import storage as storage_module
+from storage import SQLiteStorage
+from main import AddBook
+
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+
+def context(storage, uid):
+    return FSMContext(storage=storage, key=StorageKey(bot_id=1, chat_id=uid, user_id=uid))
+
+async def abandoned_flow(storage, uid):
+    state = context(storage, uid)
+    await state.set_state(AddBook.waiting_for_title)
+    await state.update_data(title=f"Книга {uid}", isbn="9785170000000")
+    await state.update_data(author="Лев Толстой")
+    await state.set_state(AddBook.waiting_for_genre)
+    await state.update_data(genre="Роман")
+
+async def memory_growth(storage):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for chunk in range(0, USERS, 1000):
+        await asyncio.gather(*(abandoned_flow(storage, uid) for uid in range(chunk, min(chunk + 1000, USERS))))
+    if isinstance(storage, SQLiteStorage): await storage.flush()
+    grown = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return grown
+
+async def run():
+    models.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    await models.init_db()
+    try: await bench()
+    finally: await models.close_db()
+
+async def bench():
+    print(f"{USERS} брошенных диалогов (5 изменений состояния на каждый)")
+    mem = await memory_growth(MemoryStorage())
+    print(f"  MemoryStorage: +{mem / 1024:8.0f} КБ памяти")
+
+    sqlite = SQLiteStorage(ttl=3600)
+    with models.count_queries() as q:
+        mem = await memory_growth(sqlite)
+    print(f"  SQLiteStorage: +{mem / 1024:8.0f} КБ памяти, в буфере {len(sqlite._pending)} записей, "
+          f"{sqlite.writes} изменений -> {sqlite.flushes} транзакций, {q['queries']} запросов")
+    await sqlite.close()
+
+    # Перезапуск: новое хранилище читает то же состояние из базы
+    restarted = SQLiteStorage(ttl=3600)
+    state = context(restarted, USERS - 1)
+    assert await state.get_state() == AddBook.waiting_for_genre.state
+    assert (await state.get_data())['author'] == "Лев Толстой"
+    print("  после перезапуска состояние и данные на месте")
+
+    # Завершенный диалог удаляет строку
+    await state.clear(); await restarted.flush()
+    assert await context(SQLiteStorage(ttl=3600), USERS - 1).get_state() is None
+
+    # TTL: через ttl секунд простоя диалоги не читаются и удаляются при очистке
+    expired = SQLiteStorage(ttl=1)
+    time.sleep(1.1)
+    assert await context(expired, 0).get_state() is None
+    storage_module.FSM_SWEEP_INTERVAL = 0
+    start = time.perf_counter()
+    await expired.flush()
+    print(f"  TTL: удалено {expired.evicted} устаревших диалогов за {(time.perf_counter() - start) * 1000:.0f} мс")
+    assert expired.evicted == USERS - 1
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,92 @@
+"""Задержка поиска по ISBN на локальных заглушках Google Books и Open Library.
+
+Сравнивает прежний последовательный опрос (новая сессия на вызов, сначала
+Google, потом Open Library) с параллельным fetch_book_by_isbn на общей сессии.
+Заглушки вносят задержки, кэш isbn_cache на время замера отключен.
+
+Запуск: python benchmarks/bench_isbn.py
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:bench-isbn")
+
+import aiohttp
+from aiohttp import web
+
+import main
+
+PORT = 8791
+BOOK = {"title": "Мастер и Маргарита", "authors": ["Михаил Булгаков"]}
+
+# Сценарий: (задержка Google, ответ Google, задержка Open Library)
+SCENARIOS = {
+    "оба быстрые": (0.05, "found", 0.08),
+    "Google медленный": (1.5, "found", 0.1),
+    "Google квота (429)": (0.05, "quota", 0.1),
+    "Google завис": (30, "found", 0.1),
+}
+
+def stub_app(scenario):
+    async def google(request):
+        delay, answer, _ = SCENARIOS[scenario[0]]
+        await asyncio.sleep(delay)
+        if answer == "quota": return web.Response(status=429)
+        return web.json_response({"totalItems": 1, "items": [{"volumeInfo": BOOK}]})
+
+    async def open_library(request):
+        await asyncio.sleep(SCENARIOS[scenario[0]][2])
+        return web.json_response({"numFound": 1, "docs": [{"title": BOOK["title"], "author_name": BOOK["authors"]}]})
+
+    app = web.Application()
+    app.router.add_get("/google", google)
+    app.router.add_get("/openlibrary", open_library)
+    return app
+
+async def sequential_lookup(isbn):
+    # Прежнее поведение: своя сессия, Google с таймаутом 10 с, затем Open Library
+    async with aiohttp.ClientSession() as session:
+        for lookup in main.ISBN_PROVIDERS:
+            try:
+                book = await asyncio.wait_for(lookup(session, isbn), 10)
+                if book: return book
+            except Exception: pass
+
+async def measure(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        assert await fn("9785170878444")
+        timings.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(timings)
+
+async def run(repeats=5):
+    scenario = [None]
+    runner = web.AppRunner(stub_app(scenario), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+    main.GOOGLE_BOOKS_URL = f"http://127.0.0.1:{PORT}/google"
+    main.OPEN_LIBRARY_URL = f"http://127.0.0.1:{PORT}/openlibrary"
+    main.ISBN_LOOKUP_TIMEOUT = 1.0
+
+    async def no_cache(isbn): return main.MISSING
+    async def no_store(*args): pass
+    main.get_cached_isbn, main.cache_isbn = no_cache, no_store
+
+    print(f"Дедлайн на источник: {main.ISBN_LOOKUP_TIMEOUT} с\n")
+    print(f"{'сценарий':<22}{'послед., мс':>14}{'параллельно, мс':>18}")
+    for name in SCENARIOS:
+        scenario[0] = name
+        before = await measure(sequential_lookup, 1 if SCENARIOS[name][0] > 10 else repeats)
+        after = await measure(main.fetch_book_by_isbn, repeats)
+        print(f"{name:<22}{before:>14.0f}{after:>18.0f}")
+
+    await main.http_session.close()
+    await runner.cleanup()
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,183 @@
+"""Набор замеров функций models.py на синтетической базе.
+
+Для каждой функции выполняет --iterations вызовов с аргументами, выбранными
+из данных (популярные книги, владельцы с запросами, читатели с полками,
+слова из каталога). Считает p50/p99/среднее и QPS последовательно, а также
+QPS при --concurrency одновременных вызовов через пул соединений.
+
+Результат пишется в JSON (--json), чтобы прогоны можно было сравнить:
+--compare старый.json печатает изменение p50 и p99 по каждой функции.
+
+Если базы нет, она создается generate_data.py (можно уменьшить --scale).
+
+Запуск: python benchmarks/bench_models.py [--db путь] [--json out.json] [--compare base.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+from generate_data import DEFAULT_OUT, GENRES, AGE_RATINGS, TAGS, generate
+
+PAGE = 6  # PAGE_SIZE каталога + 1, как запрашивает show_books_page
+
+def sample_args(path, rnd):
+    """Выборки аргументов из готовой базы (через rnd, чтобы прогоны с одним --seed совпадали)."""
+    db = sqlite3.connect(path)
+    col = lambda sql: [r[0] for r in db.execute(sql)]
+    sample = lambda values, k: rnd.sample(values, min(k, len(values)))
+    books = col("SELECT id FROM books")
+    titles = [db.execute("SELECT title FROM books WHERE id = ?", (b,)).fetchone()[0] for b in sample(books, 300)]
+    data = {
+        'users': sample(col("SELECT user_id FROM users"), 1000),
+        'books': sample(books, 1000),
+        'popular': col("SELECT book_id FROM book_transfer_counts ORDER BY count DESC, book_id LIMIT 200"),
+        'owners': sample(col("SELECT DISTINCT b.owner_id FROM bookings k JOIN books b ON b.id = k.book_id WHERE k.status = 'pending'"), 500),
+        'holders': sample(col("SELECT current_holder_id FROM books WHERE current_holder_id IS NOT NULL"), 500),
+        'words': [w for t in titles for w in t.split()[1:]],
+        'max_book': max(books),
+    }
+    db.close()
+    return data
+
+def workloads(a, rnd):
+    """Имя -> функция без аргументов, возвращающая корутину со случайными аргументами из rnd."""
+    m, pick = models, rnd.choice
+    return {
+        'get_user': lambda: m.get_user(pick(a['users'])),
+        'get_book': lambda: m.get_book(pick(a['books'])),
+        'get_all_books[page1]': lambda: m.get_all_books('available', limit=PAGE),
+        'get_all_books[deep]': lambda: m.get_all_books('available', after=(rnd.randint(1, a['max_book']),), limit=PAGE),
+        'search_books[text]': lambda: m.search_books(text_query=pick(a['words']), limit=PAGE),
+        'search_books[text,all]': lambda: m.search_books(text_query=pick(a['words'])),
+        'search_books[genre]': lambda: m.search_books(genre=pick(GENRES), status_filter='available', limit=PAGE),
+        'search_books[tag]': lambda: m.search_books(tag=pick(TAGS), limit=PAGE),
+        'search_books[age]': lambda: m.search_books(age_rating=pick(AGE_RATINGS), status_filter='available', limit=PAGE),
+        'get_unique_genres': lambda: m.get_unique_genres(),
+        'get_stats': lambda: m.get_stats(),
+        'get_book_history': lambda: m.get_book_history(pick(a['popular'])),
+        'get_incoming_requests': lambda: m.get_incoming_requests(pick(a['owners'])),
+        'get_books_on_shelf': lambda: m.get_books_on_shelf(pick(a['holders'])),
+        'get_user_books': lambda: m.get_user_books(pick(a['users'])),
+        'get_user_bookings': lambda: m.get_user_bookings(pick(a['users'])),
+        'get_waitlists': lambda: m.get_waitlists(rnd.sample(a['books'], 5)),
+        'get_book_reviews': lambda: m.get_book_reviews(pick(a['books'])),
+        'get_admin_logs': lambda: m.get_admin_logs(),
+    }
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+async def measure(make_call, iterations, concurrency):
+    for _ in range(min(5, iterations)):  # прогрев кэша страниц SQLite
+        await make_call()
+    timings = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        await make_call()
+        timings.append((time.perf_counter() - t0) * 1000)
+    sequential = time.perf_counter() - started
+
+    async def worker(n):
+        for _ in range(n): await make_call()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(iterations // concurrency) for _ in range(concurrency)))
+    concurrent = time.perf_counter() - started
+
+    timings.sort()
+    return {
+        'iterations': iterations,
+        'p50_ms': round(statistics.median(timings), 3),
+        'p99_ms': round(percentile(timings, 0.99), 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'qps': round(iterations / sequential, 1),
+        'qps_concurrent': round(iterations // concurrency * concurrency / concurrent, 1),
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+async def run(args):
+    rnd = random.Random(args.seed)
+    a = sample_args(args.db, rnd)
+    models.DB_PATH = args.db
+    await models.init_db()
+    results = {}
+    try:
+        for name in workloads(a, rnd):
+            if args.only and not any(o in name for o in args.only): continue
+            # Свой генератор на функцию: аргументы не зависят от --only и порядка замеров
+            make_call = workloads(a, random.Random(f"{args.seed}:{name}"))[name]
+            models.user_cache.clear()
+            results[name] = await measure(make_call, args.iterations, args.concurrency)
+            r = results[name]
+            print(f"{name:<26}{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}{r['qps']:>10.0f}{r['qps_concurrent']:>10.0f}", file=sys.stderr)
+    finally:
+        await models.close_db()
+    db = sqlite3.connect(args.db)
+    rows = {t: db.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in ("users", "books", "movements")}
+    db.close()
+    return {
+        'meta': {
+            'revision': git_revision(), 'created_at': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+            'seed': args.seed, 'iterations': args.iterations, 'concurrency': args.concurrency,
+            'pool_size': models.POOL_SIZE, 'rows': rows,
+        },
+        'results': results,
+    }
+
+def compare(base, current):
+    print(f"\n{'функция':<26}{'p50 было':>10}{'стало':>9}{'Δ':>8}{'p99 было':>10}{'стало':>9}{'Δ':>8}")
+    for name, r in current['results'].items():
+        old = base['results'].get(name)
+        if not old: continue
+        d50 = (r['p50_ms'] / old['p50_ms'] - 1) * 100 if old['p50_ms'] else 0
+        d99 = (r['p99_ms'] / old['p99_ms'] - 1) * 100 if old['p99_ms'] else 0
+        print(f"{name:<26}{old['p50_ms']:>10.2f}{r['p50_ms']:>9.2f}{d50:>+7.0f}%{old['p99_ms']:>10.2f}{r['p99_ms']:>9.2f}{d99:>+7.0f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры функций models.py")
+    parser.add_argument("--db", default=DEFAULT_OUT)
+    parser.add_argument("--scale", type=float, default=1.0, help="объем базы, если ее нужно сгенерировать")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--only", nargs="*", help="замерять только функции, в имени которых есть подстрока")
+    parser.add_argument("--json", help="куда сохранить результаты (по умолчанию stdout)")
+    parser.add_argument("--compare", help="JSON предыдущего прогона для сравнения")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"Генерация {args.db} (scale={args.scale})...", file=sys.stderr)
+        generate(args.db, args.seed, args.scale, log=lambda s: print(s, file=sys.stderr))
+    print(f"{'функция':<26}{'p50, мс':>9}{'p99, мс':>9}{'QPS':>10}{'QPS ∥':>10}", file=sys.stderr)
+    report = asyncio.run(run(args))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Сравнение задержки одного вызова: новое соединение на вызов vs общий пул.
+
+Запуск: python benchmarks/bench_pool.py [кол-во вызовов]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiosqlite
+import models
+
+async def get_user_per_call(user_id):
+    # Старое поведение: aiosqlite.connect() на каждый вызов
+    async with aiosqlite.connect(models.DB_PATH) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            return await cursor.fetchone()
+
+async def get_user_pooled(user_id):
+    # Тот же запрос через пул; models.get_user сюда не подходит — он отвечает из user_cache
+    async with models.pool.acquire() as db:
+        async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            return await cursor.fetchone()
+
+async def measure(fn, n):
+    timings = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        await fn(i % 100)
+        timings.append((time.perf_counter() - t0) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99) - 1]
+
+async def run(n):
+    with tempfile.TemporaryDirectory() as tmp:
+        models.DB_PATH = os.path.join(tmp, "bench.db")
+        await models.init_db()
+        for uid in range(100):
+            await models.add_user(uid, f"user{uid}", f"User {uid}", status='approved')
+
+        before = await measure(get_user_per_call, n)
+        after = await measure(get_user_pooled, n)
+        await models.close_db()
+
+    print(f"{'вариант':<12}{'p50, мс':>10}{'p99, мс':>10}")
+    print(f"{'per-call':<12}{before[0]:>10.3f}{before[1]:>10.3f}")
+    print(f"{'pool':<12}{after[0]:>10.3f}{after[1]:>10.3f}")
+
+if __name__ == "__main__":
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))
@@ -0,0 +1,89 @@
+"""Задержка текстового поиска на синтетическом каталоге: LIKE '%...%' vs FTS5.
+
+Запуск: python benchmarks/bench_search.py [кол-во книг]
+"""
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+
+SYLLABLES = ["ба", "ве", "го", "да", "жи", "зо", "ка", "ле", "ми", "но", "пу", "ро", "си", "ту", "фё", "ха",
+             "це", "чу", "ша", "ю", "ян", "ол", "ер", "ск", "ой"]
+AUTHORS = ["Толстой", "Чехов", "Булгаков", "Стругацкие", "Пелевин", "Улицкая", "Кинг", "Толкин"]
+
+def make_vocabulary(rnd, size=20_000):
+    words = set()
+    while len(words) < size:
+        words.add("".join(rnd.choices(SYLLABLES, k=rnd.randint(2, 4))))
+    return sorted(words)
+
+LIKE_QUERY = """
+    SELECT b.*, u.username as owner_username, u.full_name as owner_name,
+           h.username as holder_username, h.full_name as holder_name
+    FROM books b
+    JOIN users u ON b.owner_id = u.user_id
+    LEFT JOIN users h ON b.current_holder_id = h.user_id
+    WHERE (b.status = 'available' OR b.current_holder_id IS NOT NULL)
+      AND (b.title LIKE ? OR b.author LIKE ? OR b.description LIKE ?)
+"""
+
+def seed(path, n_books):
+    rnd = random.Random(42)
+    words = make_vocabulary(rnd)
+    db = sqlite3.connect(path)
+    db.executemany("INSERT INTO users (user_id, username, full_name, status) VALUES (?, ?, ?, 'approved')",
+                   [(i, f"user{i}", f"User {i}") for i in range(1, 1001)])
+    db.executemany(
+        "INSERT INTO books (owner_id, title, author, genre, tags, age_rating, description, photo_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [(rnd.randint(1, 1000), " ".join(rnd.sample(words, 3)).capitalize(), rnd.choice(AUTHORS), "Роман",
+          ", ".join(rnd.sample(words, 2)), "16+", " ".join(rnd.choices(words, k=30)), "photo")
+         for _ in range(n_books)])
+    db.commit()
+    db.close()
+    # Запросы: одно слово, два слова, автор и префикс
+    return [rnd.choice(words), " ".join(rnd.sample(words, 2)), "Булгаков", rnd.choice(words)[:4]]
+
+async def like_search(text):
+    async with models.pool.acquire() as db:
+        async with db.execute(LIKE_QUERY, (f"%{text}%",) * 3) as cursor:
+            return await cursor.fetchall()
+
+async def fts_search(text):
+    return await models.search_books(text_query=text)
+
+async def measure(fn, queries, repeats):
+    timings = []
+    for _ in range(repeats):
+        for q in queries:
+            t0 = time.perf_counter()
+            await fn(q)
+            timings.append((time.perf_counter() - t0) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99) - 1]
+
+async def run(n_books):
+    with tempfile.TemporaryDirectory() as tmp:
+        models.DB_PATH = os.path.join(tmp, "bench.db")
+        await models.init_db()
+        t0 = time.perf_counter()
+        queries = seed(models.DB_PATH, n_books)
+        print(f"Каталог: {n_books} книг, заполнение {time.perf_counter() - t0:.1f} с")
+
+        results = [("LIKE", await measure(like_search, queries, 5)),
+                   ("FTS5", await measure(fts_search, queries, 5))]
+        await models.close_db()
+
+    print(f"{'вариант':<10}{'p50, мс':>10}{'p99, мс':>10}")
+    for name, (p50, p99) in results:
+        print(f"{name:<10}{p50:>10.2f}{p99:>10.2f}")
+
+if __name__ == "__main__":
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000))
@@ -0,0 +1,81 @@
+"""/stats на большой истории: агрегаты по movements vs счетчики, обновляемые триггерами.
+
+Заполняет временную БД (по умолчанию 1 млн перемещений), сравнивает время
+прежнего get_stats (пять агрегирующих запросов) и нынешнего, затем сверяет
+счетчики с подсчетом с нуля через verify_stats().
+
+Запуск: python benchmarks/bench_stats.py [кол-во перемещений]
+"""
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+
+USERS, BOOKS = 10_000, 100_000
+
+# Прежняя реализация get_stats — полный пересчет на каждый запрос
+OLD_QUERIES = list(models.STATS_FROM_SCRATCH.values()) + [
+    """SELECT b.title, COUNT(m.id) as count FROM movements m JOIN books b ON m.book_id = b.id
+       WHERE m.event_type = 'transfer' GROUP BY m.book_id ORDER BY count DESC LIMIT 5""",
+    """SELECT u.real_name, u.username, COUNT(m.id) as count FROM movements m JOIN users u ON m.to_user_id = u.user_id
+       WHERE m.event_type = 'transfer' GROUP BY m.to_user_id ORDER BY count DESC LIMIT 5""",
+]
+
+def seed(path, n_movements):
+    rnd = random.Random(7)
+    db = sqlite3.connect(path)
+    db.executemany("INSERT INTO users (user_id, username, full_name, status) VALUES (?, ?, ?, ?)",
+                   [(i, f"user{i}", f"Читатель {i}", rnd.choice(("approved", "approved", "pending"))) for i in range(1, USERS + 1)])
+    db.executemany("INSERT INTO books (owner_id, title, author) VALUES (?, ?, ?)",
+                   [(rnd.randint(1, USERS), f"Книга {i}", "Автор") for i in range(BOOKS)])
+    db.executemany(
+        "INSERT INTO movements (book_id, from_user_id, to_user_id, event_type) VALUES (?, ?, ?, ?)",
+        ((rnd.randint(1, BOOKS), rnd.randint(1, USERS), rnd.randint(1, USERS), rnd.choice(("transfer", "return")))
+         for _ in range(n_movements)))
+    db.commit()
+    db.close()
+
+async def old_get_stats():
+    async with models.pool.acquire() as db:
+        for query in OLD_QUERIES:
+            async with db.execute(query) as c:
+                await c.fetchall()
+
+async def measure(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        await fn()
+        timings.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(timings)
+
+async def run(n_movements):
+    with tempfile.TemporaryDirectory() as tmp:
+        models.DB_PATH = os.path.join(tmp, "bench.db")
+        await models.init_db()
+        t0 = time.perf_counter()
+        seed(models.DB_PATH, n_movements)
+        print(f"{USERS} пользователей, {BOOKS} книг, {n_movements} перемещений: {time.perf_counter() - t0:.1f} с\n")
+
+        before = await measure(old_get_stats, 3)
+        after = await measure(models.get_stats, 50)
+        print(f"{'get_stats':<22}{'p50, мс':>10}")
+        print(f"{'агрегаты (прежний)':<22}{before:>10.2f}")
+        print(f"{'счетчики':<22}{after:>10.2f}")
+
+        t0 = time.perf_counter()
+        mismatches = await models.verify_stats()
+        print(f"\nverify_stats: {len(mismatches)} расхождений за {time.perf_counter() - t0:.1f} с")
+        await models.close_db()
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)))
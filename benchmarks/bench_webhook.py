@@ -0,0 +1,150 @@
+"""Сквозная задержка обработки обновлений в режиме вебхука.
+
+Поднимает WebhookServer на локальном порту и отправляет в него POST-ами
+записанные обновления Telegram (/start, «📚 Поиск книг», кнопка «Весь список»).
+Bot API подменен сессией-заглушкой, которая запоминает время каждого ответа.
+Задержка считается от отправки POST до последнего ответа бота в этот чат.
+Отдельно проверяется, что запрос без секрета получает 401 и что /healthz отвечает.
+«Весь список» отправляет в чат 6 сообщений, поэтому его время определяется
+лимитом планировщика на чат (sender.PER_CHAT_RATE), а не обработкой.
+
+Запуск: python benchmarks/bench_webhook.py [число_пользователей]
+"""
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+import typing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:bench-webhook")
+
+import aiohttp
+from aiohttp import web
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Message
+
+import models
+import main
+from webhook import WebhookServer, SECRET_HEADER
+
+PORT = 8792
+SECRET = "bench-secret"
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+class FakeSession(BaseSession):
+    """Отвечает на вызовы Bot API без сети и запоминает время последнего ответа в чат."""
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self.last_reply = {}
+
+    async def make_request(self, bot, method, timeout=None):
+        await asyncio.sleep(0.002)  # условный round-trip до api.telegram.org
+        self.calls += 1
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is not None: self.last_reply[chat_id] = time.perf_counter()
+        returning = method.__returning__
+        if returning is Message or Message in typing.get_args(returning):
+            return Message.model_validate({
+                "message_id": self.calls, "date": int(time.time()),
+                "chat": {"id": chat_id or 0, "type": "private"}, "text": "ok",
+            }, context={"bot": bot})
+        return True
+
+    async def close(self): pass
+    async def stream_content(self, *args, **kwargs): yield b""
+
+update_ids = iter(range(1, 10**9))
+
+def user_json(uid):
+    return {"id": uid, "is_bot": False, "first_name": "Читатель", "username": f"reader{uid}"}
+
+def message_update(uid, text):
+    entities = [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else None
+    msg = {"message_id": next(update_ids), "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+           "from": user_json(uid), "text": text}
+    if entities: msg["entities"] = entities
+    return {"update_id": next(update_ids), "message": msg}
+
+def callback_update(uid, data):
+    return {"update_id": next(update_ids), "callback_query": {
+        "id": str(next(update_ids)), "from": user_json(uid), "chat_instance": "1", "data": data,
+        "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+                    "from": {"id": 123456, "is_bot": True, "first_name": "bot"}, "text": "menu"},
+    }}
+
+SCRIPT = [
+    ("/start", lambda uid: message_update(uid, "/start")),
+    ("📚 Поиск книг", lambda uid: message_update(uid, "📚 Поиск книг")),
+    ("Весь список", lambda uid: callback_update(uid, "lib_all")),
+]
+
+async def post(http, payload, secret=SECRET):
+    async with http.post(f"http://127.0.0.1:{PORT}/webhook", json=payload, headers={SECRET_HEADER: secret}) as r:
+        return r.status
+
+async def end_to_end(http, session, server, uid, payload):
+    session.last_reply.pop(uid, None)
+    start = time.perf_counter()
+    assert await post(http, payload) == 200
+    await server.drain()
+    return (session.last_reply[uid] - start) * 1000
+
+def summary(timings):
+    timings = sorted(timings)
+    return (f"p50 {statistics.median(timings):6.1f} мс   "
+            f"p99 {timings[min(len(timings) - 1, int(len(timings) * 0.99))]:6.1f} мс")
+
+async def run():
+    models.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    await models.init_db()
+    try: await bench()
+    finally: await models.close_db()
+
+async def bench():
+    uids = list(range(1000, 1000 + USERS))
+    for uid in uids:
+        await models.add_user(uid, f"reader{uid}", "Читатель", status='approved')
+        await models.update_user_profile(uid, "Читатель", "Центр", "Главная")
+    for i in range(30):
+        await models.add_book(uids[0], f"Книга {i}", "Автор", "Роман", "", "16+", "", "photo")
+
+    session = FakeSession()
+    session.middleware(main.scheduler)
+    main.bot.session = session
+    server = WebhookServer(main.dp, main.bot, path="/webhook", secret=SECRET)
+    runner = web.AppRunner(server.app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+
+    async with aiohttp.ClientSession() as http:
+        assert await post(http, message_update(uids[0], "/start"), secret="wrong") == 401
+        print("Без секрета: 401")
+
+        print(f"\nПоследовательно, {USERS} пользователей:")
+        for name, make in SCRIPT:
+            timings = [await end_to_end(http, session, server, uid, make(uid)) for uid in uids]
+            print(f"  {name:<14} {summary(timings)}")
+
+        print(f"\nОдновременно {USERS} обновлений (лимит {server.max_concurrency}):")
+        for name, make in SCRIPT:
+            for uid in uids: session.last_reply.pop(uid, None)
+            start = time.perf_counter()
+            statuses = await asyncio.gather(*(post(http, make(uid)) for uid in uids))
+            await server.drain()
+            assert set(statuses) == {200}
+            timings = [(session.last_reply[uid] - start) * 1000 for uid in uids]
+            print(f"  {name:<14} {summary(timings)}   всего {(time.perf_counter() - start) * 1000:.0f} мс")
+
+        async with http.get(f"http://127.0.0.1:{PORT}/healthz") as r:
+            print("\n/healthz:", await r.json())
+
+    await runner.cleanup()
+
+if __name__ == "__main__":
+    logging.disable(logging.INFO)  # журнал aiogram и aiohttp.access заглушил бы таблицу
+    asyncio.run(run())
@@ -0,0 +1,161 @@
+"""Пропускная способность записи при конкурентной нагрузке.
+
+Мелкие изменения, как в хендлерах (log_admin_action, add_review,
+add_to_waitlist), выполняются из --concurrency одновременных задач.
+Сравниваются два режима:
+  старый — журнал отката (DELETE), synchronous=FULL, каждый вызов
+           коммитит сам на любом соединении пула;
+  новый  — WAL, PRAGMAS из models.py и единственный писатель с групповым
+           коммитом (models.pool.write).
+Параллельно идут чтения get_book: видно, ждут ли они писателей.
+
+Запуск: python benchmarks/bench_writes.py [--ops 3000] [--concurrency 1 8 32 128]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiosqlite
+import models
+
+USERS, BOOKS = 200, 500
+
+def seed(path):
+    db = sqlite3.connect(path)
+    db.executemany("INSERT INTO users (user_id, username, full_name, status) VALUES (?, ?, ?, 'approved')",
+                   [(i, f"user{i}", f"Читатель {i}") for i in range(1, USERS + 1)])
+    db.executemany("INSERT INTO books (owner_id, title, author) VALUES (?, ?, ?)",
+                   [(i % USERS + 1, f"Книга {i}", "Автор") for i in range(BOOKS)])
+    db.commit()
+    db.close()
+
+class LegacyWrites:
+    """Прежнее поведение: журнал отката и коммит на каждый вызов на соединении из пула."""
+    def __init__(self, path, size=models.POOL_SIZE):
+        self.path, self.size = path, size
+
+    async def open(self):
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            conn = await aiosqlite.connect(self.path)
+            await conn.execute("PRAGMA journal_mode = DELETE")
+            await conn.execute("PRAGMA synchronous = FULL")
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        while not self._idle.empty():
+            await (self._idle.get_nowait()).close()
+
+    async def run(self, sql, params):
+        conn = await self._idle.get()
+        try:
+            await conn.execute(sql, params)
+            await conn.commit()
+        finally:
+            self._idle.put_nowait(conn)
+
+    async def read(self, book_id):
+        conn = await self._idle.get()
+        try:
+            async with conn.execute("SELECT * FROM books WHERE id = ?", (book_id,)) as cursor:
+                return await cursor.fetchone()
+        finally:
+            self._idle.put_nowait(conn)
+
+def legacy_ops(legacy):
+    return [
+        lambda r: legacy.run("INSERT INTO admin_logs (admin_id, action_type, details) VALUES (?, ?, ?)",
+                             (r.randint(1, USERS), "approve", "bench")),
+        lambda r: legacy.run("INSERT INTO reviews (book_id, user_id, text) VALUES (?, ?, ?)",
+                             (r.randint(1, BOOKS), r.randint(1, USERS), "Отличная книга")),
+        lambda r: legacy.run("INSERT INTO waitlist (book_id, user_id) VALUES (?, ?)", (r.randint(1, BOOKS), r.randint(1, USERS))),
+    ]
+
+def current_ops():
+    return [
+        lambda r: models.log_admin_action(r.randint(1, USERS), "approve", "bench"),
+        lambda r: models.add_review(r.randint(1, BOOKS), r.randint(1, USERS), "Отличная книга"),
+        lambda r: models.add_to_waitlist(r.randint(1, BOOKS), r.randint(1, USERS)),
+    ]
+
+async def load(ops, read, n_ops, concurrency, rnd):
+    """n_ops изменений из concurrency задач и одна задача чтения, пока они идут."""
+    write_ms, read_ms, errors = [], [], 0
+    done = asyncio.Event()
+
+    async def writer(n, r):
+        nonlocal errors
+        for _ in range(n):
+            t0 = time.perf_counter()
+            try: await r.choice(ops)(r)
+            except sqlite3.OperationalError: errors += 1
+            write_ms.append((time.perf_counter() - t0) * 1000)
+
+    async def reader(r):
+        while not done.is_set():
+            t0 = time.perf_counter()
+            await read(r.randint(1, BOOKS))
+            read_ms.append((time.perf_counter() - t0) * 1000)
+            await asyncio.sleep(0)
+
+    reading = asyncio.create_task(reader(random.Random(rnd.random())))
+    started = time.perf_counter()
+    await asyncio.gather(*(writer(n_ops // concurrency, random.Random(rnd.random())) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await reading
+    write_ms.sort(); read_ms.sort()
+    return {
+        'ops_per_s': len(write_ms) / elapsed,
+        'p50': statistics.median(write_ms), 'p99': write_ms[int(len(write_ms) * 0.99) - 1],
+        'read_p99': read_ms[int(len(read_ms) * 0.99) - 1] if read_ms else 0,
+        'errors': errors,
+    }
+
+def report(mode, concurrency, r, commits=None):
+    per_commit = f"{commits:>9}" if commits is not None else f"{'—':>9}"
+    print(f"{mode:<8}{concurrency:>6}{r['ops_per_s']:>10.0f}{r['p50']:>9.2f}{r['p99']:>9.2f}"
+          f"{r['read_p99']:>11.2f}{per_commit}{r['errors']:>8}")
+
+async def run(args):
+    tmp = tempfile.mkdtemp()
+    print(f"{'режим':<8}{'задач':>6}{'изм./с':>10}{'p50, мс':>9}{'p99, мс':>9}{'чтение p99':>11}{'коммитов':>9}{'ошибок':>8}")
+    for concurrency in args.concurrency:
+        rnd = random.Random(f"{args.seed}:{concurrency}")
+
+        models.DB_PATH = os.path.join(tmp, f"legacy{concurrency}.db")
+        await models.init_db(); await models.close_db()
+        seed(models.DB_PATH)
+        legacy = LegacyWrites(models.DB_PATH)
+        await legacy.open()
+        try: report("старый", concurrency, await load(legacy_ops(legacy), legacy.read, args.ops, concurrency, rnd))
+        finally: await legacy.close()
+
+        models.DB_PATH = os.path.join(tmp, f"wal{concurrency}.db")
+        await models.init_db(); await models.close_db()
+        seed(models.DB_PATH)
+        await models.init_db()
+        try:
+            before = models.pool.stats()['commits']
+            result = await load(current_ops(), models.get_book, args.ops, concurrency, rnd)
+            report("новый", concurrency, result, models.pool.stats()['commits'] - before)
+        finally:
+            await models.close_db()
+
+def main():
+    parser = argparse.ArgumentParser(description="Пропускная способность записи")
+    parser.add_argument("--ops", type=int, default=3000, help="изменений на каждый уровень конкурентности")
+    parser.add_argument("--concurrency", type=int, nargs="*", default=[1, 8, 32, 128])
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Регрессионная проверка кэша поиска по ISBN (isbn_cache).
+
+Поднимает локальные заглушки Google Books и Open Library, считает обращения к ним
+и проверяет fetch_book_by_isbn на временной БД: повторный поиск не ходит в сеть,
+ответ «не найдено» тоже кэшируется, ISBN-10 и ISBN-13 одной книги — один ключ,
+запись устаревает через TTL.
+
+Запуск: python benchmarks/check_isbn_cache.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:check-isbn-cache")
+
+from aiohttp import web
+
+import main
+import models
+
+PORT = 8792
+FOUND = {"9780306406157", "9785170878444"}  # Книги, которые «знают» заглушки
+BOOK = {"title": "Мастер и Маргарита", "authors": ["Михаил Булгаков"]}
+
+def stub_app(hits):
+    async def google(request):
+        hits.append(request.query["q"])
+        if request.query["q"].removeprefix("isbn:") not in FOUND: return web.json_response({"totalItems": 0})
+        return web.json_response({"totalItems": 1, "items": [{"volumeInfo": BOOK}]})
+
+    async def open_library(request):
+        hits.append(request.query["isbn"])
+        if request.query["isbn"] not in FOUND: return web.json_response({"numFound": 0})
+        return web.json_response({"numFound": 1, "docs": [{"title": BOOK["title"], "author_name": BOOK["authors"]}]})
+
+    app = web.Application()
+    app.router.add_get("/google", google)
+    app.router.add_get("/openlibrary", open_library)
+    return app
+
+async def lookups(hits, *isbns):
+    """Ищет ISBN по очереди; возвращает (ответы, сколько HTTP-запросов ушло на все, кроме первого)."""
+    results = [await main.fetch_book_by_isbn(isbns[0])]
+    before = len(hits)
+    for isbn in isbns[1:]:
+        results.append(await main.fetch_book_by_isbn(isbn))
+    return results, len(hits) - before
+
+async def run():
+    hits = []
+    runner = web.AppRunner(stub_app(hits), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+    main.GOOGLE_BOOKS_URL = f"http://127.0.0.1:{PORT}/google"
+    main.OPEN_LIBRARY_URL = f"http://127.0.0.1:{PORT}/openlibrary"
+    await models.init_db()
+
+    results = {}
+    books, calls = await lookups(hits, "9785170878444", "9785170878444")
+    results["повтор без HTTP"] = (calls == 0 and books[0] is not None and books[0] == books[1], f"{calls} запр.")
+    books, calls = await lookups(hits, "9780000000002", "9780000000002")
+    results["«не найдено» в кэше"] = (calls == 0 and books == [None, None], f"{calls} запр.")
+    books, calls = await lookups(hits, "0-306-40615-2", "978-0-306-40615-7")
+    results["ISBN-10 и ISBN-13 — один ключ"] = (calls == 0 and books[0] is not None and books[0] == books[1], f"{calls} запр.")
+
+    # Перезаписываем найденную книгу с TTL 1 с: после него поиск снова идет в сеть и обновляет запись
+    await models.cache_isbn("9785170878444", books[0], 1)
+    await asyncio.sleep(2.1)
+    before = len(hits)
+    books, calls = await lookups(hits, "9785170878444", "9785170878444")
+    refetched = len(hits) - before - calls
+    results["запись устаревает через TTL"] = (refetched > 0 and calls == 0 and books[0] is not None,
+                                             f"{refetched} запр. после TTL, {calls} — на повтор")
+
+    await main.http_session.close()
+    await models.close_db()
+    await runner.cleanup()
+    return results
+
+def main_():
+    with tempfile.TemporaryDirectory() as tmp:
+        models.DB_PATH = os.path.join(tmp, "isbn.db")
+        results = asyncio.run(run())
+    failed = False
+    for name, (ok, detail) in results.items():
+        failed |= not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {name}: {detail}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main_())
@@ -0,0 +1,159 @@
+"""Регрессионная проверка планов запросов models.py.
+
+Вызывает каждую функцию модуля на временной БД, перехватывает выполненные
+SQL-запросы и прогоняет их через EXPLAIN QUERY PLAN. Завершается с кодом 1,
+если какой-то запрос читает таблицу полным сканированием (SCAN) и эта строка
+плана не внесена в FULL_SCAN_OK для его функции. ORDER BY и LIMIT сами по себе
+проход не разрешают: каждый принятый SCAN перечислен с причиной.
+
+Запуск: python benchmarks/check_query_plans.py
+"""
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+
+# Полные проходы, нужные по смыслу: (функция, строка плана) -> причина
+FULL_SCAN_OK = {
+    ("get_all_users", "SCAN users"): "выгрузка всех пользователей для админки",
+    ("search_users", "SCAN users"): "поиск по подстроке имени (LIKE '%...%') идет по user_id до заполнения страницы",
+    ("count_users_by_status", "SCAN users USING COVERING INDEX idx_users_status"):
+        "счетчики меню админки: проход только по индексу idx_users_status",
+    ("get_all_books", "SCAN b"): "выгрузка всего каталога",
+    ("get_admin_logs", "SCAN admin_logs"):
+        "журнал без фильтров: проход по id от новых записей, LIMIT останавливает его на первой странице",
+    ("get_stats", "SCAN t USING COVERING INDEX idx_book_transfer_counts_count"):
+        "топ-5 книг: проход по индексу счетчика по убыванию, LIMIT 5",
+    ("get_stats", "SCAN t USING COVERING INDEX idx_reader_transfer_counts_count"):
+        "топ-5 читателей: проход по индексу счетчика по убыванию, LIMIT 5",
+}
+
+def calls():
+    m = models
+    return [
+        ("add_user", m.add_user(1, "alice", "Alice", status='approved')),
+        ("add_user", m.add_user(2, "bob", "Bob", status='approved')),
+        ("add_user", m.add_user(3, "carol", "Carol")),
+        ("update_user_profile", m.update_user_profile(3, "Carol", "Centro", "")),
+        ("update_user_status", m.update_user_status(3, 'approved')),
+        ("set_admin_status", m.set_admin_status(1, True)),
+        ("get_user", m.get_user(1)),
+        ("get_all_users", m.get_all_users()),
+        ("search_users", m.search_users(status='pending', limit=21)),
+        ("search_users", m.search_users(status='approved', after=1, limit=21)),
+        ("search_users", m.search_users(district="Centro", before=5, limit=21)),
+        ("search_users", m.search_users(name="car", limit=21)),
+        ("count_users_by_status", m.count_users_by_status()),
+        ("get_user_districts", m.get_user_districts()),
+        ("add_book", m.add_book(1, "Дюна", "Герберт", "Фэнтези", "космос", "16+", "Пески", "photo")),
+        ("add_book", m.add_book(2, "Улитка на склоне", "Стругацкие", "Классика", "", "16+", "Лес", "photo")),
+        ("get_book", m.get_book(1)),
+        ("get_all_books", m.get_all_books('available')),
+        ("get_all_books", m.get_all_books('held')),
+        ("get_all_books", m.get_all_books('all')),
+        ("search_books", m.search_books(genre="Фэнтези", age_rating="16+", status_filter='available')),
+        ("search_books", m.search_books(tag="Космос")),
+        ("search_books", m.search_books(tag="космос", status_filter='available', after=(1,), limit=6)),
+        ("suggest_tags", m.suggest_tags("кос")),
+        ("search_books", m.search_books(text_query="Дюна")),
+        ("search_books", m.search_books(text_query="Дюна", after=(-1.0, 1), limit=6)),
+        ("get_all_books", m.get_all_books('available', after=(1,), limit=6)),
+        ("get_unique_genres", m.get_unique_genres()),
+        ("get_unique_age_ratings", m.get_unique_age_ratings()),
+        ("get_facet_counts", m.get_facet_counts('genre')),
+        ("get_facet_counts", m.get_facet_counts('tag', 'held', limit=10)),
+        ("create_booking", m.create_booking(1, 2)),
+        ("get_user_bookings", m.get_user_bookings(2)),
+        ("get_incoming_requests", m.get_incoming_requests(1)),
+        ("get_profile", m.get_profile(1)),
+        ("reject_booking", m.reject_booking(1, 2)),
+        ("confirm_transfer", m.confirm_transfer(1, 2, 1)),
+        ("add_to_waitlist", m.add_to_waitlist(1, 3)),
+        ("get_waitlist", m.get_waitlist(1)),
+        ("get_books_on_shelf", m.get_books_on_shelf(2)),
+        ("get_profile", m.get_profile(2)),
+        ("get_profile", m.get_profile(1, book_id=1)),
+        ("request_book_return", m.request_book_return(1, 1)),
+        ("cancel_return_request", m.cancel_return_request(1, 1)),
+        ("return_book", m.return_book(1, 1)),
+        ("remove_from_waitlist", m.remove_from_waitlist(1, 3)),
+        ("get_book_history", m.get_book_history(1)),
+        ("add_review", m.add_review(1, 2, "Отлично")),
+        ("get_book_reviews", m.get_book_reviews(1)),
+        ("delete_review", m.delete_review(1)),
+        ("get_user_books", m.get_user_books(1)),
+        ("update_book_status", m.update_book_status(2, 2, 'unavailable')),
+        ("update_book_info", m.update_book_info(2, "Улитка", "Стругацкие", "Классика", "", "16+", "Лес", owner_id=2)),
+        ("log_admin_action", m.log_admin_action(1, "approve_user", "User ID: 3")),
+        ("get_admin_logs", m.get_admin_logs()),
+        ("get_admin_logs", m.get_admin_logs(after=10, limit=11)),
+        ("get_admin_logs", m.get_admin_logs(before=1, limit=11)),
+        ("get_admin_logs", m.get_admin_logs(admin_id=1, after=10, limit=11)),
+        ("get_admin_logs", m.get_admin_logs(action_type="approve_user", before=1, limit=11)),
+        ("archive_admin_logs", m.archive_admin_logs(90)),
+        ("archive_movements", m.archive_movements(365)),
+        ("archive_bookings", m.archive_bookings()),
+        ("get_book_history", m.get_book_history(1)),
+        ("incremental_vacuum", m.incremental_vacuum()),
+        ("get_stats", m.get_stats()),
+        ("delete_book", m.delete_book(2, 2)),
+        ("save_fsm", m.save_fsm({"fsm:1:1:1:default": ("AddBook:waiting_for_title", {"isbn": "1"}), "fsm:1:2:2:default": (None, {})})),
+        ("load_fsm", m.load_fsm("fsm:1:1:1:default", 3600)),
+        ("evict_fsm", m.evict_fsm(3600)),
+    ]
+
+def is_checked(sql):
+    # Служебные запросы FTS5 к своим теневым таблицам
+    if "'main'." in sql: return False
+    head = sql.lstrip().split(None, 1)[0].upper()
+    return head in ("SELECT", "UPDATE", "DELETE", "WITH") or (head == "INSERT" and "SELECT" in sql.upper())
+
+async def collect():
+    traced = []
+    await models.init_db()
+    for conn in models.pool._conns:
+        await conn.set_trace_callback(traced.append)
+    per_func = []
+    for name, coro in calls():
+        traced.clear()
+        await coro
+        per_func.extend((name, sql) for sql in traced if is_checked(sql))
+    await models.close_db()
+    return per_func
+
+def main():
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        models.DB_PATH = os.path.join(tmp, "plans.db")
+        statements = asyncio.run(collect())
+        db = sqlite3.connect(models.DB_PATH)
+        seen = set()
+        for name, sql in statements:
+            if sql in seen: continue
+            seen.add(sql)
+            plan = [row[3] for row in db.execute("EXPLAIN QUERY PLAN " + sql)]
+            # Промежуточные результаты CTE и подзапросов (CO-ROUTINE/MATERIALIZE) — не таблицы
+            subqueries = {p.split()[1] for p in plan if p.startswith(("CO-ROUTINE ", "MATERIALIZE "))}
+            scans = [p for p in plan if p.startswith("SCAN") and p.split()[1] not in subqueries
+                     # Стартовая строка рекурсивного CTE без FROM
+                     and p != "SCAN CONSTANT ROW"
+                     # MATCH по FTS5 идет через полнотекстовый индекс
+                     and "VIRTUAL TABLE INDEX" not in p]
+            for scan in scans:
+                reason = FULL_SCAN_OK.get((name, scan))
+                if reason is None:
+                    failures += 1
+                    print(f"FAIL {name}: {scan}\n     {' '.join(sql.split())}")
+                else:
+                    print(f"skip {name}: {scan} — {reason}")
+        db.close()
+    print(f"Проверено запросов: {len(seen)}, с полным сканированием: {failures}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""Регрессионная проверка числа SQL-запросов на отрисовку страницы каталога и профиля.
+
+Рендерит display_books для 1 и для PAGE_SIZE книг (с очередями), а также
+«Мой профиль» владельца 1 и 3·PROFILE_PAGE_SIZE книг, и падает, если количество
+запросов (а для профиля — и сообщений) растет вместе с числом книг (N+1).
+
+Запуск: python benchmarks/check_render_queries.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:check-render-queries")
+
+import models
+import main
+
+class FakeMessage:
+    def __init__(self, user_id=None):
+        self.from_user = types.SimpleNamespace(id=user_id)
+        self.sent = 0
+
+    async def answer(self, *args, **kwargs): self.sent += 1
+    async def answer_photo(self, *args, **kwargs): self.sent += 1
+
+async def render(books, viewer):
+    models.user_cache.clear()  # Считаем худший случай — зритель не в кэше
+    with models.count_queries() as q:
+        await main.display_books(FakeMessage(), books, viewer)
+    return q['queries']
+
+async def render_profile(user_id):
+    message = FakeMessage(user_id)
+    with models.count_queries() as q:
+        await main.cmd_profile(message)
+    return q['queries'], message.sent
+
+async def run():
+    await models.init_db()
+    for uid in range(1, 5):
+        await models.add_user(uid, f"user{uid}", f"User {uid}", status='approved')
+    await models.set_admin_status(4, True)
+    for i in range(main.PAGE_SIZE):
+        await models.add_book(1, f"Книга {i}", "Автор", "Роман", "", "16+", "", "photo")
+    books = await models.get_all_books('all', limit=main.PAGE_SIZE)
+    for b in books:
+        await models.confirm_transfer(b['id'], 2, 1)
+        await models.add_to_waitlist(b['id'], 3)
+
+    results = {}
+    for viewer in (1, 3, 4):
+        results[f"зритель {viewer}"] = (await render(books[:1], viewer), await render(books, viewer))
+
+    # Профиль: у владельца 3 одна книга, у владельца 4 — три страницы книг, на полке и в заявках
+    await models.add_book(3, "Одна книга", "Автор", "Роман", "", "16+", "", "photo")
+    for i in range(3 * main.PROFILE_PAGE_SIZE):
+        await models.add_book(4, f"Книга владельца {i}", "Автор", "Роман", "", "16+", "", "photo")
+    for b in (await models.get_profile(4))['books']:
+        await models.create_booking(b['id'], 1)
+        await models.add_to_waitlist(b['id'], 2)
+    results["профиль"] = (await render_profile(3), await render_profile(4))
+    await models.close_db()
+    return results
+
+def main_():
+    with tempfile.TemporaryDirectory() as tmp:
+        models.DB_PATH = os.path.join(tmp, "render.db")
+        results = asyncio.run(run())
+    failed = False
+    profile = results.pop("профиль")
+    for viewer, (one, page) in results.items():
+        ok = one == page
+        failed |= not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {viewer}: 1 книга — {one} запр., {main.PAGE_SIZE} книг — {page} запр.")
+    (q1, m1), (qn, mn) = profile
+    ok = (q1, m1) == (qn, mn)
+    failed |= not ok
+    print(f"{'ok  ' if ok else 'FAIL'} профиль: 1 книга — {q1} запр., {m1} сообщ.; "
+          f"{3 * main.PROFILE_PAGE_SIZE} книг — {qn} запр., {mn} сообщ.")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main_())
@@ -0,0 +1,63 @@
+"""Регрессионная проверка поиска по тегам (book_tags).
+
+Теги с кириллицей в разном регистре и с «ё» — у книги, записанной мимо add_book
+(как у книг, сохраненных до нормализации тегов), у новой и у отредактированной —
+должны находиться точным поиском и подсказками, в меню тегов «ё»/«е» не должны
+давать двух кнопок, а verify_stats() — сходиться.
+
+Запуск: python benchmarks/check_tags.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+
+async def titles(**filters):
+    return sorted(b['title'] for b in await models.search_books(**filters))
+
+async def run():
+    await models.init_db()
+    await models.add_user(1, "alice", "Alice", status='approved')
+    # Старая книга: теги как их ввел пользователь, init_db при перезапуске приводит их к normalize_tags()
+    async with models.pool.write() as db:
+        await db.execute("INSERT INTO books (owner_id, title, author, genre, tags, age_rating, description, photo_id) "
+                         "VALUES (1, 'Старая', 'Автор', 'Фэнтези', 'Тёмное Фэнтези,  Магия', '16+', '', 'photo')")
+    await models.close_db()
+    await models.init_db()
+    await models.add_book(1, "Новая", "Автор", "Фэнтези", "Драконы, ДРАКОНЫ, Магия", "16+", "", "photo")
+    await models.add_book(1, "Без ё", "Автор", "Фэнтези", "темное фэнтези", "16+", "", "photo")
+    await models.add_book(1, "Правка", "Автор", "Фэнтези", "", "16+", "", "photo")
+    book = (await models.search_books(text_query="Правка"))[0]
+    await models.update_book_info(book['id'], "Правка", "Автор", "Фэнтези", "Ёжики, МАГИЯ", "16+", "", owner_id=1)
+
+    results = {
+        "магия": (await titles(tag="магия"), ["Новая", "Правка", "Старая"]),
+        "Магия": (await titles(tag="Магия"), ["Новая", "Правка", "Старая"]),
+        "темное фэнтези": (await titles(tag="темное фэнтези"), ["Без ё", "Старая"]),
+        "меню тегов": (dict(await models.get_facet_counts('tag')).get("темное фэнтези"), 2),
+        "фэнтези": (await titles(tag="фэнтези"), []),
+        "ежики": (await titles(tag="ежики"), ["Правка"]),
+        "подсказки «маг»": (await models.suggest_tags("маг"), ["магия"]),
+        "подсказки «Д»": (await models.suggest_tags("Д"), ["драконы"]),
+        "verify_stats": (await models.verify_stats(), {}),
+    }
+    await models.close_db()
+    return results
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        models.DB_PATH = os.path.join(tmp, "tags.db")
+        results = asyncio.run(run())
+    failed = False
+    for name, (actual, expected) in results.items():
+        ok = actual == expected
+        failed |= not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {name}: {actual}" + ("" if ok else f" (ожидалось {expected})"))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
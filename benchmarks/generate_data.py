@@ -0,0 +1,194 @@
+"""Генератор синтетической базы клуба для замеров.
+
+Строит books_bot.db той же схемы, что и init_db(): пользователи с русскими
+именами и районами, каталог с названиями, авторами, тегами и описаниями на
+кириллице, история перемещений (популярные книги передаются чаще), очереди,
+бронирования, отзывы и журнал админов. Результат детерминирован: один и тот
+же --seed дает одинаковые данные.
+
+По умолчанию (--scale 1): 10 тыс. пользователей, 100 тыс. книг, 1 млн
+перемещений. Файл пишется в benchmarks/data/, чтобы не задеть рабочую базу.
+
+Запуск: python benchmarks/generate_data.py [--out путь] [--seed N] [--scale K] [--force]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+
+DEFAULT_OUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "books_bot.db")
+
+USERS, BOOKS, MOVEMENTS = 10_000, 100_000, 1_000_000
+REVIEWS, ADMIN_LOGS = 150_000, 5_000
+START = datetime(2023, 1, 1)
+
+# Те же справочники, что в main.py (не импортируем main, чтобы не требовать BOT_TOKEN)
+GENRES = ["Роман", "Детектив", "Фэнтези", "Научная фантастика", "Приключения", "Научпоп", "Ужасы", "Биография", "Классика", "Детское", "Поэзия"]
+AGE_RATINGS = ["0+", "6+", "12+", "16+", "18+"]
+
+FIRST_NAMES = ["Анна", "Мария", "Елена", "Ольга", "Наталья", "Татьяна", "Ирина", "Светлана", "Юлия", "Алёна",
+               "Дарья", "Ксения", "Алексей", "Дмитрий", "Сергей", "Андрей", "Михаил", "Иван", "Николай", "Павел",
+               "Артём", "Максим", "Фёдор", "Егор"]
+LAST_NAMES = ["Иванов", "Смирнов", "Кузнецов", "Попов", "Васильев", "Петров", "Соколов", "Михайлов", "Новиков",
+              "Фёдоров", "Морозов", "Волков", "Алексеев", "Лебедев", "Семёнов", "Егоров", "Павлов", "Козлов"]
+DISTRICTS = ["Центр", "Буэнависта", "Вальехо", "Ла-Корредория", "Пумарин", "Тейсера", "Отеро", "Сан-Ласаро",
+             "Ла-Фреснеда", "Лугонес"]
+STREETS = ["Урия", "Калье-Фруэла", "Пелайо", "Асебаль", "Сан-Франсиско", "Ирунья", "Хенераль-Элорса"]
+AUTHORS = ["Лев Толстой", "Фёдор Достоевский", "Антон Чехов", "Михаил Булгаков", "Аркадий и Борис Стругацкие",
+           "Виктор Пелевин", "Людмила Улицкая", "Стивен Кинг", "Дж. Р. Р. Толкин", "Агата Кристи",
+           "Рэй Брэдбери", "Урсула Ле Гуин", "Борис Акунин", "Гузель Яхина", "Евгений Водолазкин",
+           "Астрид Линдгрен", "Анна Ахматова", "Иосиф Бродский", "Нил Гейман", "Терри Пратчетт"]
+ADJECTIVES = ["Тёмный", "Белый", "Последний", "Тихий", "Золотой", "Забытый", "Северный", "Странный", "Долгий",
+              "Старый", "Зелёный", "Ночной", "Летний", "Каменный", "Хрустальный", "Огненный", "Дальний", "Живой"]
+NOUNS = ["лес", "город", "сад", "берег", "путь", "дом", "ветер", "остров", "маяк", "мост", "век", "сон",
+         "колодец", "замок", "поезд", "океан", "архив", "перевал", "театр", "рассвет"]
+TAGS = ["классика", "фэнтези", "тёмное фэнтези", "антиутопия", "космос", "магия", "история", "любовь",
+        "война", "детектив", "мистика", "юмор", "психология", "путешествия", "драконы", "школа", "семья",
+        "постапокалипсис", "биография", "поэзия", "наука", "для подростков", "сказки", "триллер"]
+REVIEW_PHRASES = ["Прочитала на одном дыхании.", "Очень атмосферно, особенно вторая часть.", "Концовка удивила.",
+                  "Немного затянуто в середине.", "Советую всем, кто любит жанр.", "Перечитаю ещё раз.",
+                  "Герои живые и настоящие.", "Язык тяжеловат, но оно того стоит.", "Книга в хорошем состоянии.",
+                  "Спасибо владельцу за чудесный экземпляр!", "Не моё, но написано хорошо."]
+SYLLABLES = ["ба", "ве", "го", "да", "жи", "зо", "ка", "ле", "ми", "но", "пу", "ро", "си", "ту", "фё", "ха",
+             "це", "чу", "ша", "ю", "ян", "ол", "ер", "ск", "ой"]
+
+def ts(moment):
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+def make_vocabulary(rnd, size=20_000):
+    words = set()
+    while len(words) < size:
+        words.add("".join(rnd.choices(SYLLABLES, k=rnd.randint(2, 4))))
+    return sorted(words)
+
+def gen_users(rnd, n):
+    for uid in range(1, n + 1):
+        first, last = rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES)
+        if first[-1] in "аяё": last += "а"
+        status = rnd.choices(("approved", "pending", "blocked"), (90, 7, 3))[0]
+        username = f"{last.lower()}_{uid}" if rnd.random() < 0.8 else None
+        yield (uid, username, f"{first} {last}", f"{first} {last}", rnd.choice(DISTRICTS), rnd.choice(STREETS),
+               status, 1 if uid <= 5 else 0)
+
+def gen_books(rnd, n, users, words):
+    for _ in range(n):
+        title = f"{rnd.choice(ADJECTIVES)} {rnd.choice(NOUNS)}"
+        if rnd.random() < 0.5: title += f" {rnd.choice(words)}"
+        tags = ", ".join(rnd.sample(TAGS, rnd.randint(0, 3)))
+        description = " ".join(rnd.choices(words, k=rnd.randint(10, 40))).capitalize() + "."
+        status = 'available' if rnd.random() < 0.95 else 'unavailable'
+        yield (rnd.randint(1, users), title, rnd.choice(AUTHORS), rnd.choice(GENRES), tags,
+               rnd.choice(AGE_RATINGS), description, f"photo_{rnd.getrandbits(48):012x}", status)
+
+def gen_history(rnd, owners, n_movements, users):
+    """Перемещения и итоговые держатели. Вес книги ~ 1/rank: популярные передаются чаще."""
+    n_books = len(owners)
+    weights = [1 / (i + 10) for i in range(n_books)]
+    order = list(range(1, n_books + 1))
+    rnd.shuffle(order)
+    counts = Counter(rnd.choices(order, weights, k=n_movements))
+    movements, holders, completed = [], {}, []
+    for book_id in sorted(counts):
+        owner, holder = owners[book_id - 1], None
+        moment = START + timedelta(minutes=rnd.randint(0, 60 * 24 * 365))
+        for _ in range(counts[book_id]):
+            moment += timedelta(minutes=rnd.randint(60, 60 * 24 * 20))
+            if holder is None or rnd.random() < 0.3:
+                reader = rnd.randint(1, users)
+                movements.append((book_id, holder or owner, reader, 'transfer', ts(moment)))
+                completed.append((book_id, reader, 'completed'))
+                holder = reader
+            else:
+                movements.append((book_id, holder, owner, 'return', ts(moment)))
+                holder = None
+        if holder is not None: holders[book_id] = holder
+    return movements, holders, completed
+
+async def create_schema(path):
+    models.DB_PATH = path
+    await models.init_db()
+    await models.close_db()
+
+def generate(path, seed=1, scale=1.0, log=print):
+    """Создает базу по пути path. Возвращает словарь с количеством строк в таблицах."""
+    rnd = random.Random(seed)
+    n_users, n_books = max(10, int(USERS * scale)), max(10, int(BOOKS * scale))
+    n_movements, n_reviews, n_logs = int(MOVEMENTS * scale), int(REVIEWS * scale), int(ADMIN_LOGS * scale)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    asyncio.run(create_schema(path))
+
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA synchronous = OFF")
+    started = time.perf_counter()
+    words = make_vocabulary(rnd)
+
+    db.executemany("INSERT INTO users (user_id, username, full_name, real_name, district, street, status, is_admin) "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", gen_users(rnd, n_users))
+    books = list(gen_books(rnd, n_books, n_users, words))
+    db.executemany("INSERT INTO books (owner_id, title, author, genre, tags, age_rating, description, photo_id, status) "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", books)
+    log(f"  пользователи и книги: {time.perf_counter() - started:.1f} с")
+
+    movements, holders, completed = gen_history(rnd, [b[0] for b in books], n_movements, n_users)
+    db.executemany("INSERT INTO movements (book_id, from_user_id, to_user_id, event_type, created_at) VALUES (?, ?, ?, ?, ?)",
+                   movements)
+    db.executemany("UPDATE books SET current_holder_id = ?, status = 'unavailable', return_requested = ? WHERE id = ?",
+                   ((holder, 1 if rnd.random() < 0.05 else 0, book_id) for book_id, holder in holders.items()))
+    log(f"  перемещения: {time.perf_counter() - started:.1f} с")
+
+    # Очереди на книги, которые сейчас у читателей
+    waitlist = []
+    for book_id in holders:
+        if rnd.random() < 0.3:
+            moment = START + timedelta(days=700 + rnd.randint(0, 60))
+            for reader in rnd.sample(range(1, n_users + 1), rnd.randint(1, 4)):
+                moment += timedelta(hours=rnd.randint(1, 72))
+                waitlist.append((book_id, reader, ts(moment)))
+    db.executemany("INSERT INTO waitlist (book_id, user_id, created_at) VALUES (?, ?, ?)", waitlist)
+
+    # Бронирования: выполненные (по передачам), отклоненные и ожидающие на свободные книги
+    rejected = [(rnd.randint(1, n_books), rnd.randint(1, n_users), 'rejected') for _ in range(len(completed) // 20)]
+    pending = [(book_id, rnd.randint(1, n_users), 'pending')
+               for book_id in range(1, n_books + 1) if book_id not in holders and rnd.random() < 0.05]
+    db.executemany("INSERT INTO bookings (book_id, renter_id, status) VALUES (?, ?, ?)", completed + rejected + pending)
+
+    db.executemany("INSERT INTO reviews (book_id, user_id, text, created_at) VALUES (?, ?, ?, ?)",
+                   ((rnd.randint(1, n_books), rnd.randint(1, n_users), " ".join(rnd.sample(REVIEW_PHRASES, rnd.randint(1, 3))),
+                     ts(START + timedelta(minutes=rnd.randint(0, 60 * 24 * 760)))) for _ in range(n_reviews)))
+    actions = ["approve_user", "block_user", "delete_review", "edit_book", "delete_book", "make_admin"]
+    db.executemany("INSERT INTO admin_logs (admin_id, action_type, details, created_at) VALUES (?, ?, ?, ?)",
+                   ((rnd.randint(1, 5), rnd.choice(actions), f"User ID: {rnd.randint(1, n_users)}",
+                     ts(START + timedelta(minutes=rnd.randint(0, 60 * 24 * 760)))) for _ in range(n_logs)))
+    db.commit()
+    db.execute("ANALYZE")
+    counts = {table: db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+              for table in ("users", "books", "movements", "waitlist", "bookings", "reviews", "admin_logs")}
+    db.close()
+    log(f"  всего: {time.perf_counter() - started:.1f} с")
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетическая база BookCrossing Bot")
+    parser.add_argument("--out", default=DEFAULT_OUT)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--scale", type=float, default=1.0, help="множитель объема (1 = 100 тыс. книг)")
+    parser.add_argument("--force", action="store_true", help="перезаписать существующий файл")
+    args = parser.parse_args()
+    if os.path.exists(args.out):
+        if not args.force: sys.exit(f"{args.out} уже существует (--force, чтобы перезаписать)")
+        os.remove(args.out)
+    print(f"Генерация {args.out} (seed={args.seed}, scale={args.scale})")
+    for table, count in generate(args.out, args.seed, args.scale).items():
+        print(f"  {table:<12}{count:>10}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Стресс-проверка передач и возвратов при одновременных нажатиях.
+
+Для каждой из --books книг одновременно запускаются:
+  1. по --taps нажатий «✅ Выдать» владельцем двум разным читателям;
+  2. «🤝 Передать» следующему в очереди от держателя вперемешку
+     с «✅ Получил назад» от владельца;
+  3. повторные «✅ Получил назад».
+На каждом шаге для каждой книги должно сработать ровно одно нажатие.
+В конце проверяется, что история каждой книги — непрерывная цепочка,
+число уведомлений в outbox совпадает с числом успешных переходов, а
+счетчики статистики сходятся (verify_stats).
+
+Запуск: python benchmarks/stress_transfers.py [--books 300] [--taps 5]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+
+def give(book, renter, outbox):
+    return models.confirm_transfer(book['id'], renter, book['owner_id'], outbox=outbox)
+
+async def race(calls, rnd):
+    """Запускает корутины одновременно в случайном порядке; возвращает результаты в исходном."""
+    order = list(range(len(calls)))
+    rnd.shuffle(order)
+    tasks = {i: asyncio.create_task(calls[i]) for i in order}
+    return [await tasks[i] for i in range(len(calls))]
+
+async def run(args):
+    rnd = random.Random(args.seed)
+    models.DB_PATH = os.path.join(tempfile.mkdtemp(), "stress.db")
+    await models.init_db()
+    try:
+        await stress(args, rnd)
+    finally:
+        await models.close_db()
+
+async def stress(args, rnd):
+    n_users = args.books // 2 + 3
+    for uid in range(1, n_users + 1):
+        await models.add_user(uid, f"user{uid}", f"Читатель {uid}", status='approved')
+    for i in range(args.books):
+        await models.add_book(i % n_users + 1, f"Книга {i}", "Автор", "Роман", "", "16+", "", "photo")
+    books = await models.get_all_books('all')
+    readers = {}
+    for b in books:
+        a, c = rnd.sample([u for u in range(1, n_users + 1) if u != b['owner_id']], 2)
+        readers[b['id']] = (a, c)
+        for uid in (a, c):
+            await models.create_booking(b['id'], uid)
+            await models.add_to_waitlist(b['id'], uid)
+
+    expected_outbox = 0
+    failures = []
+    started = time.perf_counter()
+    with models.count_queries() as q:
+        # 1. Двойные нажатия «Выдать» двум разным читателям
+        results = await race([give(b, r, [(r, "выдано", None)]) for b in books for r in readers[b['id']] for _ in range(args.taps)], rnd)
+        per_book = Counter(b['id'] for b, r in zip((b for b in books for _ in readers[b['id']] for _ in range(args.taps)), results) if r is not None)
+        failures += [f"выдача: книга {bid} передана {n} раз" for bid, n in per_book.items() if n != 1]
+        failures += [f"выдача: книга {b['id']} не передана" for b in books if b['id'] not in per_book]
+        expected_outbox += sum(per_book.values())
+        holders = {b['id']: (await models.get_book(b['id']))['current_holder_id'] for b in books}
+
+        # 2. Передача следующему вперемешку с возвратом владельцу
+        calls, kinds = [], []
+        for b in books:
+            holder = holders[b['id']]
+            nxt = next(u for u in readers[b['id']] if u != holder)
+            for _ in range(args.taps):
+                calls.append(models.confirm_transfer(b['id'], nxt, holder, outbox=[(nxt, "передано", None)])); kinds.append(b['id'])
+                calls.append(models.return_book(b['id'], b['owner_id'], holder, outbox=[(b['owner_id'], "возврат", None)])); kinds.append(b['id'])
+        results = await race(calls, rnd)
+        per_book = Counter(bid for bid, r in zip(kinds, results) if r is not None)
+        failures += [f"передача/возврат: книга {bid} сработала {per_book[bid]} раз" for bid in holders if per_book[bid] != 1]
+        expected_outbox += sum(per_book.values())
+
+        # 3. Повторные «Получил назад»: у книг, которые еще у читателя, срабатывает ровно одно
+        current = {b['id']: (await models.get_book(b['id']))['current_holder_id'] for b in books}
+        still_held = [b for b in books if current[b['id']]]
+        results = await race([models.return_book(b['id'], b['owner_id'], current[b['id']], outbox=[(b['owner_id'], "возврат", None)])
+                              for b in still_held for _ in range(args.taps)], rnd)
+        per_book = Counter(b['id'] for b, r in zip((b for b in still_held for _ in range(args.taps)), results) if r is not None)
+        failures += [f"возврат: книга {b['id']} сработал {per_book[b['id']]} раз" for b in still_held if per_book[b['id']] != 1]
+        expected_outbox += sum(per_book.values())
+    elapsed = time.perf_counter() - started
+    attempts = args.books * args.taps * 4 + len(still_held) * args.taps
+
+    # История: каждое событие начинается там, где закончилось предыдущее
+    for b in books:
+        place = b['owner_id']
+        for m in await models.get_book_history(b['id']):
+            if m['from_user_id'] != place: failures.append(f"история книги {b['id']} разорвана: {dict(m)}")
+            place = m['to_user_id']
+        if place != b['owner_id'] or (await models.get_book(b['id']))['current_holder_id'] is not None:
+            failures.append(f"книга {b['id']} не вернулась владельцу")
+    async with models.pool.acquire() as db:
+        async with db.execute("SELECT COUNT(*) FROM outbox") as c:
+            outbox = (await c.fetchone())[0]
+        async with db.execute("SELECT book_id FROM bookings WHERE status = 'completed' GROUP BY book_id HAVING COUNT(*) > 2") as c:
+            failures += [f"книга {row[0]}: лишние завершенные бронирования" for row in await c.fetchall()]
+    if outbox != expected_outbox: failures.append(f"уведомлений {outbox}, ожидалось {expected_outbox}")
+    mismatches = await models.verify_stats()
+    if mismatches: failures.append(f"расхождения статистики: {mismatches}")
+
+    stats = models.pool.stats()
+    print(f"{args.books} книг, {attempts} нажатий за {elapsed:.2f} с; {q['queries']} запросов, "
+          f"{stats['commits']} коммитов на {stats['writes']} блоков записи")
+    for f in failures[:20]: print("FAIL", f)
+    print("OK" if not failures else f"ошибок: {len(failures)}")
+    if failures: sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Стресс-проверка передач и возвратов")
+    parser.add_argument("--books", type=int, default=300)
+    parser.add_argument("--taps", type=int, default=5, help="одновременных нажатий одной кнопки")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,31 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_IDS = [int(i.strip()) for i in os.getenv("ADMIN_IDS", "").split(",") if i.strip()]
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес бота, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "16"))  # Одновременно обрабатываемых обновлений
+# Порт /metrics (Prometheus) в режиме polling; 0 — не запускать. В режиме webhook /metrics на WEBHOOK_PORT
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Через сколько часов простоя незаконченный диалог (добавление книги, анкета и т.п.) забывается
+FSM_TTL_HOURS = float(os.getenv("FSM_TTL_HOURS", "24"))
+
+# Фоновое обслуживание базы (maintenance.py): как часто запускать и через сколько дней
+# записи журнала админов и история перемещений уходят в архив (0 — хранить в основной таблице всегда)
+MAINTENANCE_INTERVAL_MINUTES = float(os.getenv("MAINTENANCE_INTERVAL_MINUTES", "60"))
+ADMIN_LOG_RETENTION_DAYS = int(os.getenv("ADMIN_LOG_RETENTION_DAYS", "90"))
+MOVEMENTS_RETENTION_DAYS = int(os.getenv("MOVEMENTS_RETENTION_DAYS", "365"))
+
+# Сколько секунд ждать ответа каждого источника ISBN (Google Books, Open Library)
+ISBN_LOOKUP_TIMEOUT = float(os.getenv("ISBN_LOOKUP_TIMEOUT", "5"))
 
 if not BOT_TOKEN:
     print("Ошибка: Токен бота не найден! Создайте файл .env и добавьте туда BOT_TOKEN=ваш_токен")
+if BOT_MODE == "webhook" and not (WEBHOOK_URL and WEBHOOK_SECRET):
+    print("Ошибка: для BOT_MODE=webhook укажите в .env WEBHOOK_URL и WEBHOOK_SECRET")
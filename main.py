@@ -1,5 +1,7 @@
 import asyncio
 import logging
+import time
+from html import escape
 import aiohttp
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
@@ -7,26 +9,36 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
 
-from config import BOT_TOKEN, ADMIN_IDS
+import metrics
+from config import BOT_TOKEN, ADMIN_IDS, ISBN_LOOKUP_TIMEOUT, BOT_MODE, METRICS_HOST, METRICS_PORT
+from sender import scheduler, outbox_msg, outbox_worker
+from webhook import run_webhook, run_metrics_server
+from storage import SQLiteStorage
+from maintenance import maintenance_worker, last_report
 from models import (
-    init_db, add_user, add_book, get_all_books, 
-    get_book, create_booking, get_user_books, get_user_bookings,
+    init_db, add_user, add_book, book_cursor,
+    get_book, create_booking, get_user_bookings, get_profile,
     delete_book, update_book_status, update_book_info,
-    search_books, get_unique_genres, get_unique_age_ratings,
-    confirm_transfer, return_book, get_books_on_shelf,
-    add_to_waitlist, get_waitlist, remove_from_waitlist,
-    get_incoming_requests, reject_booking, get_book_history,
+    search_books, get_facet_counts, suggest_tags, normalize_tags, tag_key,
+    confirm_transfer, return_book,
+    add_to_waitlist, get_waitlist, get_waitlists, remove_from_waitlist,
+    reject_booking, get_book_history,
     request_book_return, cancel_return_request, add_review, get_book_reviews,
     update_user_profile, update_user_status, set_admin_status, get_user,
-    get_all_users, log_admin_action, delete_review, get_stats, get_admin_logs
+    search_users, count_users_by_status, get_user_districts, USER_STATUSES, log_admin_action, delete_review, get_stats, get_admin_logs,
+    close_db, count_queries, get_cached_isbn, cache_isbn, MISSING, LRUCache, enqueue_messages,
+    slow_queries, SLOW_QUERY_MS
 )
 
 logging.basicConfig(level=logging.INFO)
-bot = Bot(token=BOT_TOKEN); dp = Dispatcher()
+bot = Bot(token=BOT_TOKEN); dp = Dispatcher(storage=SQLiteStorage())  # Диалоги FSM хранятся в базе и переживают перезапуск
+bot.session.middleware(scheduler)  # Все отправки идут через планировщик с учетом лимитов Telegram
+metrics.setup(dp, count_queries)  # Время хендлеров и число SQL-запросов на обновление (/metrics, /admin)
 
 # Каталоги
 GENRES = ["Роман", "Детектив", "Фэнтези", "Научная фантастика", "Приключения", "Научпоп", "Ужасы", "Биография", "Классика", "Детское", "Поэзия"]
 AGE_RATINGS = ["0+", "6+", "12+", "16+", "18+"]
+PAGE_SIZE = 5  # Книг на одной странице каталога
 
 class AddBook(StatesGroup):
     waiting_for_method = State()
@@ -38,49 +50,85 @@ class Registration(StatesGroup):
     waiting_for_name = State()
     waiting_for_district = State()
 
+GOOGLE_BOOKS_URL = "https://www.googleapis.com/books/v1/volumes"
+OPEN_LIBRARY_URL = "https://openlibrary.org/search.json"
+ISBN_CACHE_TTL = 30 * 24 * 3600       # найденные книги
+ISBN_NEGATIVE_TTL = 24 * 3600         # «не найдено» — живет меньше, вдруг книгу добавят
+
+http_session = None  # Общий aiohttp.ClientSession (пул соединений), создается в main()
+
+def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+    return http_session
+
+def normalize_isbn(isbn):
+    """Приводит ISBN-10 и ISBN-13 к одному ключу — ISBN-13 без дефисов. None, если это не ISBN."""
+    isbn = "".join(ch for ch in isbn.upper() if ch.isdigit() or ch == "X")
+    if len(isbn) == 10 and isbn[:9].isdigit():
+        core = "978" + isbn[:9]
+        check = (10 - sum(int(d) * (1 if i % 2 == 0 else 3) for i, d in enumerate(core)) % 10) % 10
+        return core + str(check)
+    if len(isbn) == 13 and isbn.isdigit(): return isbn
+    return None
+
+async def lookup_google_books(session, isbn):
+    async with session.get(GOOGLE_BOOKS_URL, params={"q": f"isbn:{isbn}"}) as resp:
+        resp.raise_for_status()
+        data = await resp.json()
+    if data.get("totalItems", 0) > 0:
+        item = data["items"][0]["volumeInfo"]
+        return {
+            "title": item.get("title", ""),
+            "author": ", ".join(item.get("authors", [])),
+            "description": item.get("description", ""),
+            "photo_url": item.get("imageLinks", {}).get("thumbnail")
+        }
+
+async def lookup_open_library(session, isbn):
+    async with session.get(OPEN_LIBRARY_URL, params={"isbn": isbn}) as resp:
+        resp.raise_for_status()
+        data = await resp.json()
+    if data.get("numFound", 0) > 0:
+        book = data["docs"][0]
+        # У Open Library нет прямого описания в поиске, но есть ID обложки
+        cover_id = book.get("cover_i")
+        return {
+            "title": book.get("title", ""),
+            "author": ", ".join(book.get("author_name", [])),
+            "description": "", # В поиске OL нет описания
+            "photo_url": f"https://covers.openlibrary.org/b/id/{cover_id}-L.jpg" if cover_id else None
+        }
+
+ISBN_PROVIDERS = (lookup_google_books, lookup_open_library)
+
 async def fetch_book_by_isbn(isbn):
-    isbn = "".join(filter(str.isdigit, isbn))
+    isbn = normalize_isbn(isbn)
     if not isbn: return None
-    
-    # Сначала пробуем Google Books
-    async with aiohttp.ClientSession() as session:
-        try:
-            url_gb = f"https://www.googleapis.com/books/v1/volumes?q=isbn:{isbn}"
-            async with session.get(url_gb, timeout=10) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    if data.get("totalItems", 0) > 0:
-                        item = data["items"][0]["volumeInfo"]
-                        return {
-                            "title": item.get("title", ""),
-                            "author": ", ".join(item.get("authors", [])),
-                            "description": item.get("description", ""),
-                            "photo_url": item.get("imageLinks", {}).get("thumbnail")
-                        }
-        except: pass
-
-        # Если Google не сработал (квота или нет книги), пробуем Open Library
-        try:
-            url_ol = f"https://openlibrary.org/search.json?isbn={isbn}"
-            async with session.get(url_ol, timeout=10) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    if data.get("numFound", 0) > 0:
-                        book = data["docs"][0]
-                        title = book.get("title", "")
-                        author = ", ".join(book.get("author_name", []))
-                        # У Open Library нет прямого описания в поиске, но есть ID обложки
-                        cover_id = book.get("cover_i")
-                        photo_url = f"https://covers.openlibrary.org/b/id/{cover_id}-L.jpg" if cover_id else None
-                        return {
-                            "title": title,
-                            "author": author,
-                            "description": "", # В поиске OL нет описания
-                            "photo_url": photo_url
-                        }
-        except: pass
-        
-    return None
+
+    cached = await get_cached_isbn(isbn)
+    if cached is not MISSING: return cached
+
+    # Опрашиваем источники параллельно: берем первый найденный ответ, остальные отменяем
+    session = get_http_session()
+    tasks = {asyncio.create_task(asyncio.wait_for(lookup(session, isbn), ISBN_LOOKUP_TIMEOUT)): lookup
+             for lookup in ISBN_PROVIDERS}
+    book, answered, pending = None, True, set(tasks)
+    try:
+        while pending and not book:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try: book = book or task.result()
+                except Exception as e:
+                    # Ошибка или таймаут — «не найдено» тогда не кэшируем
+                    logging.warning("%s(%s): %r", tasks[task].__name__, isbn, e); answered = False
+    finally:
+        for task in pending: task.cancel()
+
+    if book: await cache_isbn(isbn, book, ISBN_CACHE_TTL)
+    elif answered: await cache_isbn(isbn, None, ISBN_NEGATIVE_TTL)
+    return book
 
 class EditBook(StatesGroup):
     waiting_for_title = State(); waiting_for_author = State(); waiting_for_genre = State()
@@ -92,6 +140,9 @@ class Search(StatesGroup):
 class AddReview(StatesGroup):
     waiting_for_text = State()
 
+class AdminUsers(StatesGroup):
+    waiting_for_name = State()
+
 def main_menu():
     return ReplyKeyboardMarkup(keyboard=[
         [KeyboardButton(text="📚 Поиск книг"), KeyboardButton(text="➕ Добавить книгу")],
@@ -158,18 +209,15 @@ async def reg_district(message: types.Message, state: FSMContext):
     real_name = data['real_name']
     district = message.text.strip()
     
-    await update_user_profile(message.from_user.id, real_name, district, "")
-    await message.answer("✨ Спасибо! Ваша заявка отправлена администраторам. Ожидайте подтверждения.")
-    
-    # Уведомляем админов
+    # Уведомление админам уходит через outbox вместе с сохранением анкеты
     kb = InlineKeyboardMarkup(inline_keyboard=[[
         InlineKeyboardButton(text="✅ Принять", callback_data=f"adm_appr_{message.from_user.id}"),
         InlineKeyboardButton(text="❌ Отклонить", callback_data=f"adm_rejt_{message.from_user.id}")
     ]])
     caption = f"🆕 <b>Новая заявка!</b>\n\n👤 Юзер: @{message.from_user.username}\n📝 Имя: {real_name}\n📍 Район: {district}"
-    for admin_id in ADMIN_IDS:
-        try: await bot.send_message(admin_id, caption, parse_mode="HTML", reply_markup=kb)
-        except: pass
+    outbox = [outbox_msg(admin_id, caption, parse_mode="HTML", reply_markup=kb) for admin_id in ADMIN_IDS]
+    await update_user_profile(message.from_user.id, real_name, district, "", outbox=outbox)
+    await message.answer("✨ Спасибо! Ваша заявка отправлена администраторам. Ожидайте подтверждения.")
     await state.clear()
 
 async def is_approved(user_id):
@@ -208,19 +256,20 @@ async def p_isbn(message: types.Message, state: FSMContext):
     await state.update_data(**book)
     text = f"✨ <b>Нашел книгу!</b>\n\n📖 {book['title']}\n👤 {book['author']}\n\nОна?\n(0 - продолжить, либо введите другое название)"
     
-    # Пытаемся получить фото
+    # Пытаемся получить фото; медленный или недоступный сервер обложек — показываем без нее
+    content = None
     if book['photo_url']:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(book['photo_url']) as resp:
-                if resp.status == 200:
-                    content = await resp.read()
-                    photo = BufferedInputFile(content, filename="cover.jpg")
-                    try:
-                        msg = await message.answer_photo(photo, caption=text, parse_mode="HTML")
-                        await state.update_data(photo_id=msg.photo[-1].file_id)
-                    except:
-                        await message.answer(text, parse_mode="HTML")
-                else: await message.answer(text, parse_mode="HTML")
+        try:
+            async with get_http_session().get(book['photo_url'], timeout=aiohttp.ClientTimeout(total=ISBN_LOOKUP_TIMEOUT)) as resp:
+                if resp.status == 200: content = await resp.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning("обложка %s: %r", book['photo_url'], e)
+    if content:
+        try:
+            msg = await message.answer_photo(BufferedInputFile(content, filename="cover.jpg"), caption=text, parse_mode="HTML")
+            await state.update_data(photo_id=msg.photo[-1].file_id)
+        except:
+            await message.answer(text, parse_mode="HTML")
     else:
         await message.answer(text, parse_mode="HTML")
         
@@ -250,7 +299,7 @@ async def p_genre(message: types.Message, state: FSMContext):
 
 @dp.message(AddBook.waiting_for_tags)
 async def p_tags(message: types.Message, state: FSMContext):
-    tags = ", ".join([t.strip().lower() for t in message.text.split(",")])
+    tags = normalize_tags(message.text)
     await state.update_data(tags=tags); await message.answer("Выберите рейтинг:", reply_markup=get_age_ratings_keyboard()); await state.set_state(AddBook.waiting_for_age_rating)
 
 @dp.message(AddBook.waiting_for_age_rating)
@@ -291,13 +340,19 @@ async def p_photo(message: types.Message, state: FSMContext):
 # --- Поиск и Библиотека ---
 async def display_books(message, books, user_id):
     if not books: await message.answer("Ничего не найдено. 🤷‍♂️"); return
+    # Очереди всех книг и права зрителя — одним заходом на страницу, а не на каждую карточку
+    with count_queries() as q:
+        waitlists = await get_waitlists([b['id'] for b in books])
+        viewer = await get_user(user_id)
+    logging.debug("display_books: %d книг, %d SQL-запросов", len(books), q['queries'])
+    is_admin = bool(viewer and viewer['is_admin'])
     for b in books:
         own = f"@{b['owner_username']}" if b['owner_username'] else b['owner_name']
         t_str = f"🏷 Теги: {b['tags']}\n" if b['tags'] and b['tags'] != "None" else ""
         a_str = f"🔞 Рейтинг: {b['age_rating']}\n" if b['age_rating'] and b['age_rating'] != "None" else ""
         
         status_line = ""
-        waitlist = await get_waitlist(b['id'])
+        waitlist = waitlists[b['id']]
         queue_str = f"\n👥 Очередь: {len(waitlist)} чел." if waitlist else ""
         
         if b['current_holder_id']:
@@ -329,8 +384,7 @@ async def display_books(message, books, user_id):
             cap += f"\n\n👥 <b>Очередь:</b> {q_names}"
 
         # Админ-кнопки
-        user = await get_user(user_id)
-        if user and user['is_admin']:
+        if is_admin:
             buttons.append([
                 InlineKeyboardButton(text="⚙️ Ред. (Админ)", callback_data=f"edit_{b['id']}"),
                 InlineKeyboardButton(text="🗑 Уд. (Админ)", callback_data=f"delete_{b['id']}")
@@ -352,38 +406,132 @@ async def cmd_library(message: types.Message):
     ])
     await message.answer("Как будем искать книги?", reply_markup=kb)
 
+def encode_cursor(cur): return ",".join(repr(v) for v in cur)
+
+def decode_cursor(s):
+    *rank, bid = s.split(",")
+    return tuple(float(v) for v in rank) + (int(bid),)
+
+async def show_books_page(message, state, user_id, query, after=None, before=None):
+    """Одна страница каталога (PAGE_SIZE книг) и кнопки листания.
+    Параметры поиска лежат в FSM (lib_query), в кнопках — только курсор."""
+    await state.update_data(lib_query=query)
+    books = await search_books(**query, after=after, before=before, limit=PAGE_SIZE + 1)
+    if before is not None:
+        has_prev, has_next = len(books) > PAGE_SIZE, True
+        books = books[-PAGE_SIZE:]
+    else:
+        has_prev, has_next = after is not None, len(books) > PAGE_SIZE
+        books = books[:PAGE_SIZE]
+    await display_books(message, books, user_id)
+    nav = []
+    if books and has_prev: nav.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"libprev_{encode_cursor(book_cursor(books[0]))}"))
+    if books and has_next: nav.append(InlineKeyboardButton(text="Далее ➡️", callback_data=f"libnext_{encode_cursor(book_cursor(books[-1]))}"))
+    if nav: await message.answer("📄 Листать дальше:", reply_markup=InlineKeyboardMarkup(inline_keyboard=[nav]))
+
+@dp.callback_query(F.data.startswith("libnext_") | F.data.startswith("libprev_"))
+async def process_library_page(callback: types.CallbackQuery, state: FSMContext):
+    direction, cur = callback.data.split("_", 1)
+    query = (await state.get_data()).get('lib_query')
+    if not query: await callback.answer("Поиск устарел, начните заново из «📚 Поиск книг».", show_alert=True); return
+    page = {'after': decode_cursor(cur)} if direction == "libnext" else {'before': decode_cursor(cur)}
+    await callback.message.delete_reply_markup()
+    await show_books_page(callback.message, state, callback.from_user.id, query, **page); await callback.answer()
+
 @dp.callback_query(F.data.startswith("lib_"))
 async def process_library_filter(callback: types.CallbackQuery, state: FSMContext):
     action = callback.data.split("_")[1]
-    if action == "available": await display_books(callback.message, await get_all_books(status_filter='available'), callback.from_user.id)
-    elif action == "held": await display_books(callback.message, await get_all_books(status_filter='held'), callback.from_user.id)
-    elif action == "all": await display_books(callback.message, await get_all_books(status_filter='all'), callback.from_user.id)
+    if action in ("available", "held", "all"): await show_books_page(callback.message, state, callback.from_user.id, {'status_filter': action})
     elif action == "genre":
-        gs = await get_unique_genres(); btns = [[InlineKeyboardButton(text=g, callback_data=f"libgenre_{g}")] for g in gs]
-        await callback.message.edit_text("Выберите жанр:", reply_markup=InlineKeyboardMarkup(inline_keyboard=btns))
-    elif action == "tag": await callback.message.edit_text("Введите тег:"); await state.set_state(Search.waiting_for_tag)
-    elif action == "age": await callback.message.edit_text("Рейтинг:", reply_markup=get_age_ratings_kb_inline())
+        btns = facet_buttons("libgenre", await get_facet_counts('genre'))
+        await callback.message.edit_text("Выберите жанр:" if btns else "В каталоге пока нет книг с жанром.", reply_markup=InlineKeyboardMarkup(inline_keyboard=btns))
+    elif action == "tag":
+        btns = facet_buttons("libtag", await get_facet_counts('tag', limit=TOP_TAGS))
+        await callback.message.edit_text("Введите тег" + (" или выберите популярный:" if btns else ":"), reply_markup=InlineKeyboardMarkup(inline_keyboard=btns) if btns else None)
+        await state.set_state(Search.waiting_for_tag)
+    elif action == "age":
+        btns = await get_age_ratings_kb_inline()
+        await callback.message.edit_text("Рейтинг:" if btns.inline_keyboard else "В каталоге пока нет книг с рейтингом.", reply_markup=btns)
     elif action == "text": await callback.message.edit_text("Что искать?"); await state.set_state(Search.waiting_for_text)
     await callback.answer()
 
-def get_age_ratings_kb_inline():
-    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=r, callback_data=f"libage_{r}")] for r in AGE_RATINGS])
+TOP_TAGS = 10  # Популярных тегов в меню «По тегу»
+
+def facet_buttons(prefix, counts):
+    """Кнопки «Фэнтези (42)» по значениям фасета; значения, не влезающие в callback_data (64 байта), пропускаются."""
+    return [[InlineKeyboardButton(text=f"{v} ({n})", callback_data=f"{prefix}_{v}")]
+            for v, n in counts if len(f"{prefix}_{v}".encode()) <= 64]
+
+async def get_age_ratings_kb_inline():
+    # Рейтинги без книг не показываем; порядок — как в AGE_RATINGS
+    counts = sorted(await get_facet_counts('age'), key=lambda c: (AGE_RATINGS.index(c[0]) if c[0] in AGE_RATINGS else len(AGE_RATINGS), c[0]))
+    return InlineKeyboardMarkup(inline_keyboard=facet_buttons("libage", counts))
 
 @dp.callback_query(F.data.startswith("libgenre_"))
-async def s_genre_proc_lib(callback: types.CallbackQuery):
-    g = callback.data.split("_")[1]; await display_books(callback.message, await search_books(genre=g), callback.from_user.id); await callback.answer()
+async def s_genre_proc_lib(callback: types.CallbackQuery, state: FSMContext):
+    g = callback.data.split("_")[1]; await show_books_page(callback.message, state, callback.from_user.id, {'genre': g}); await callback.answer()
 
 @dp.callback_query(F.data.startswith("libage_"))
-async def s_age_proc_lib(callback: types.CallbackQuery):
-    a = callback.data.split("_")[1]; await display_books(callback.message, await search_books(age_rating=a), callback.from_user.id); await callback.answer()
+async def s_age_proc_lib(callback: types.CallbackQuery, state: FSMContext):
+    a = callback.data.split("_")[1]; await show_books_page(callback.message, state, callback.from_user.id, {'age_rating': a}); await callback.answer()
+
+@dp.callback_query(F.data.startswith("libtag_"))
+async def s_tag_proc_lib(callback: types.CallbackQuery, state: FSMContext):
+    t = callback.data.split("_", 1)[1]; await state.clear()
+    await show_books_page(callback.message, state, callback.from_user.id, {'tag': t}); await callback.answer()
 
 @dp.message(Search.waiting_for_tag)
 async def s_tag_proc(message: types.Message, state: FSMContext):
-    await display_books(message, await search_books(tag=message.text.strip()), message.from_user.id); await state.clear()
+    # Такого тега нет — подсказываем существующие с тем же началом и ждем выбора или нового ввода
+    tag = message.text.strip(); hints = await suggest_tags(tag, limit=TOP_TAGS)
+    if hints and hints[0] != tag_key(tag):
+        btns = [[InlineKeyboardButton(text=h, callback_data=f"libtag_{h}")] for h in hints if len(f"libtag_{h}".encode()) <= 64]
+        await message.answer("Такого тега нет. Может быть, один из этих? Или введите другой:", reply_markup=InlineKeyboardMarkup(inline_keyboard=btns)); return
+    await state.clear(); await show_books_page(message, state, message.from_user.id, {'tag': tag})
 
 @dp.message(Search.waiting_for_text)
 async def s_txt_proc(message: types.Message, state: FSMContext):
-    await display_books(message, await search_books(text_query=message.text.strip()), message.from_user.id); await state.clear()
+    await state.clear(); await show_books_page(message, state, message.from_user.id, {'text_query': message.text.strip()})
+
+# --- Inline-поиск (@bot запрос) ---
+INLINE_PAGE_SIZE = 20        # результатов в одном ответе (Telegram допускает до 50)
+INLINE_MAX_RESULTS = 200     # сколько книг выбирается из базы на один запрос
+INLINE_CACHE_TTL = 60        # секунд живет выборка в inline_cache
+inline_cache = LRUCache(256)  # (запрос, фильтр) -> (момент истечения, книги)
+
+def inline_search_key(query):
+    """Нормализованный запрос и фильтр: «*» в начале — искать и среди книг на руках."""
+    q = " ".join(query.lower().replace("ё", "е").split())
+    if q.startswith("*"): return q[1:].strip(), 'all'
+    return q, 'available'
+
+async def inline_search(q, status_filter):
+    """Выборка для inline-режима; при листании (offset) берется из кэша, а не из SQLite."""
+    cached = inline_cache.get((q, status_filter))
+    if cached is not MISSING and cached[0] > time.monotonic(): return cached[1]
+    books = await search_books(text_query=q or None, status_filter=status_filter, limit=INLINE_MAX_RESULTS)
+    inline_cache.put((q, status_filter), (time.monotonic() + INLINE_CACHE_TTL, books))
+    return books
+
+def inline_result(b):
+    status = "📖 Сейчас у читателя" if b['current_holder_id'] else "✅ Доступна"
+    return types.InlineQueryResultCachedPhoto(
+        id=str(b['id']), photo_file_id=b['photo_id'],  # обложка уже на серверах Telegram, повторной загрузки нет
+        title=b['title'], description=f"{b['author']} · {b['genre']}",
+        caption=f"📖 {b['title']}\n👤 Автор: {b['author']}\n🎭 Жанр: {b['genre']}\n{status}",
+    )
+
+@dp.inline_query()
+async def inline_books(query: types.InlineQuery):
+    if not await is_approved(query.from_user.id):
+        await query.answer([], is_personal=True, cache_time=10,
+                           button=types.InlineQueryResultsButton(text="Вступить в клуб", start_parameter="inline"))
+        return
+    books = await inline_search(*inline_search_key(query.query))
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    page = books[offset:offset + INLINE_PAGE_SIZE]
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(books) else ""
+    await query.answer([inline_result(b) for b in page], is_personal=True, cache_time=INLINE_CACHE_TTL, next_offset=next_offset)
 
 # --- История перемещений ---
 @dp.callback_query(F.data.startswith("hist_"))
@@ -407,11 +555,9 @@ async def process_view_history(callback: types.CallbackQuery):
 async def p_recall(c: types.CallbackQuery):
     bid = int(c.data.split("_")[1]); b = await get_book(bid)
     if not b: return
-    await request_book_return(bid, c.from_user.id)
+    outbox = [outbox_msg(b['current_holder_id'], f"📦 Владелец просит вернуть книгу «{b['title']}». Пожалуйста, занесите её хозяину при возможности.")] if b['current_holder_id'] else []
+    await request_book_return(bid, c.from_user.id, outbox=outbox)
     await c.message.edit_text(f"🏠 Вы отозвали книгу «{b['title']}». Теперь читатель сможет только вернуть её вам.")
-    if b['current_holder_id']:
-        try: await bot.send_message(b['current_holder_id'], f"📦 Владелец просит вернуть книгу «{b['title']}». Пожалуйста, занесите её хозяину при возможности.")
-        except: pass
     await c.answer()
 
 @dp.callback_query(F.data.startswith("cancelrecall_"))
@@ -427,16 +573,10 @@ async def p_cancelrecall(c: types.CallbackQuery):
 async def process_queue_join(c: types.CallbackQuery):
     bid = int(c.data.split("_")[1]); b = await get_book(bid)
     if not b: return
-    added = await add_to_waitlist(bid, c.from_user.id)
-    if added:
-        await c.answer("Вы встали в очередь!", show_alert=True)
-        name = f"@{c.from_user.username}" if c.from_user.username else c.from_user.full_name
-        msg = f"👥 Новый в очереди на «{b['title']}»: {name}"
-        try: await bot.send_message(b['owner_id'], msg)
-        except: pass
-        if b['current_holder_id']:
-            try: await bot.send_message(b['current_holder_id'], msg)
-            except: pass
+    name = f"@{c.from_user.username}" if c.from_user.username else c.from_user.full_name
+    msg = f"👥 Новый в очереди на «{b['title']}»: {name}"
+    outbox = [outbox_msg(uid, msg) for uid in (b['owner_id'], b['current_holder_id']) if uid]
+    if await add_to_waitlist(bid, c.from_user.id, outbox=outbox): await c.answer("Вы встали в очередь!", show_alert=True)
     else: await c.answer("Вы уже в очереди.", show_alert=True)
 
 # --- Бронирование ---
@@ -445,19 +585,20 @@ async def p_book(c: types.CallbackQuery):
     bid = int(c.data.split("_")[1]); b = await get_book(bid)
     if not b: return
     if b['owner_id'] == c.from_user.id: await c.answer("Это ваша книга!", show_alert=True); return
-    await create_booking(bid, c.from_user.id)
     u = c.from_user; name = f"@{u.username}" if u.username else u.full_name
     kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="✅ Выдать", callback_data=f"give_{bid}_{u.id}")]])
-    await bot.send_message(b['owner_id'], f"🔔 <b>{name}</b> хочет взять «{b['title']}».\nПодтвердите выдачу в профиле или здесь:", parse_mode="HTML", reply_markup=kb)
+    await create_booking(bid, u.id, outbox=[outbox_msg(b['owner_id'], f"🔔 <b>{name}</b> хочет взять «{b['title']}».\nПодтвердите выдачу в профиле или здесь:", parse_mode="HTML", reply_markup=kb)])
     await c.answer("Заявка отправлена!", show_alert=True)
 
 @dp.callback_query(F.data.startswith("give_"))
 async def p_give(c: types.CallbackQuery):
-    _, bid, uid = c.data.split("_"); bid = int(bid); uid = int(uid)
-    await confirm_transfer(bid, uid); await remove_from_waitlist(bid, uid)
+    # give_{книга}_{читатель}; из списка заявок профиля — еще и смещение страницы
+    parts = c.data.split("_"); bid = int(parts[1]); uid = int(parts[2])
+    if await confirm_transfer(bid, uid, c.from_user.id, outbox=[outbox_msg(uid, "🎉 Владелец подтвердил передачу книги! Она теперь на вашей «Полке».")]) is None:
+        await c.answer("Книга уже передана или сейчас не у вас.", show_alert=True); return
+    if len(parts) > 3:
+        await refresh_profile_section(c.message, c.from_user.id, 'requests', int(parts[3])); await c.answer("✅ Книга передана читателю."); return
     await c.message.edit_text("✅ Книга передана читателю.")
-    try: await bot.send_message(uid, f"🎉 Владелец подтвердил передачу книги! Она теперь на вашей «Полке».")
-    except: pass
     await c.answer()
 
 @dp.callback_query(F.data.startswith("handover_"))
@@ -465,56 +606,55 @@ async def p_handover(c: types.CallbackQuery):
     _, bid, uid = c.data.split("_"); bid = int(bid); uid = int(uid)
     b = await get_book(bid)
     if not b: return
-    owner_id = await confirm_transfer(bid, uid)
-    await remove_from_waitlist(bid, uid)
     old_holder_name = f"@{c.from_user.username}" if c.from_user.username else c.from_user.full_name
+    if await confirm_transfer(bid, uid, c.from_user.id, outbox=[
+        outbox_msg(uid, f"🎉 Вам передали книгу «{b['title']}» от {old_holder_name}! Она на вашей «Полке»."),
+        outbox_msg(b['owner_id'], f"🔄 Книга «{b['title']}» совершила переезд! {old_holder_name} передал её новому читателю.")
+    ]) is None:
+        await c.answer("Книга уже передана или сейчас не у вас.", show_alert=True); return
     await c.message.edit_text(f"🤝 Книга «{b['title']}» передана.")
-    try: await bot.send_message(uid, f"🎉 Вам передали книгу «{b['title']}» от {old_holder_name}! Она на вашей «Полке».")
-    except: pass
-    try: await bot.send_message(owner_id, f"🔄 Книга «{b['title']}» совершила переезд! {old_holder_name} передал её новому читателю.")
-    except: pass
     await c.answer("Передача подтверждена!")
 
 @dp.callback_query(F.data.startswith("rej_"))
 async def p_rej(c: types.CallbackQuery):
-    _, bid, uid = c.data.split("_"); bid = int(bid); uid = int(uid)
-    await reject_booking(bid, uid)
+    parts = c.data.split("_"); bid = int(parts[1]); uid = int(parts[2])
+    if not await reject_booking(bid, uid, outbox=[outbox_msg(uid, "😔 Владелец отклонил ваш запрос на книгу.")]):
+        await c.answer("Запрос уже обработан.", show_alert=True); return
+    if len(parts) > 3:
+        await refresh_profile_section(c.message, c.from_user.id, 'requests', int(parts[3])); await c.answer("❌ Запрос отклонен."); return
     await c.message.edit_text("❌ Запрос отклонен.")
-    try: await bot.send_message(uid, "😔 Владелец отклонил ваш запрос на книгу.")
-    except: pass
     await c.answer()
 
 @dp.callback_query(F.data.startswith("return_"))
 async def p_return(c: types.CallbackQuery):
     bid = int(c.data.split("_")[1]); b = await get_book(bid); u = c.from_user; name = f"@{u.username}" if u.username else u.full_name
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="✅ Получил назад", callback_data=f"gotback_{bid}")]])
-    await bot.send_message(b['owner_id'], f"📦 <b>{name}</b> вернул «{b['title']}».\nПодтвердите:", parse_mode="HTML", reply_markup=kb)
+    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="✅ Получил назад", callback_data=f"gotback_{bid}_{u.id}")]])
+    await enqueue_messages([outbox_msg(b['owner_id'], f"📦 <b>{name}</b> вернул «{b['title']}».\nПодтвердите:", parse_mode="HTML", reply_markup=kb)])
     await c.answer("Владелец уведомлен!", show_alert=True)
 
+def queue_turn_msg(user_id, b):
+    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⏭ Пропустить ход", callback_data=f"skipqueue_{b['id']}")]])
+    return outbox_msg(user_id, f"📚 Книга «{b['title']}» освободилась! Вы первый в очереди.", reply_markup=kb)
+
 @dp.callback_query(F.data.startswith("gotback_"))
 async def p_gotback(c: types.CallbackQuery):
-    bid = int(c.data.split("_")[1]); b = await get_book(bid); await return_book(bid)
-    await c.message.edit_text("✅ Возврат подтвержден."); await c.answer()
-    if b['current_holder_id']:
-        try: await bot.send_message(b['current_holder_id'], "📖 Владелец подтвердил возврат. Спасибо!")
-        except: pass
+    # gotback_{книга}_{читатель}; в старых кнопках читателя нет
+    parts = c.data.split("_"); bid = int(parts[1]); b = await get_book(bid)
+    if not b: return
+    holder_id = int(parts[2]) if len(parts) > 2 else b['current_holder_id']
+    outbox = [outbox_msg(holder_id, "📖 Владелец подтвердил возврат. Спасибо!")] if holder_id else []
     waitlist = await get_waitlist(bid)
-    if waitlist:
-        next_user = waitlist[0]
-        kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⏭ Пропустить ход", callback_data=f"skipqueue_{bid}")]])
-        try: await bot.send_message(next_user['user_id'], f"📚 Книга «{b['title']}» освободилась! Вы первый в очереди.", reply_markup=kb)
-        except: pass
+    if waitlist: outbox.append(queue_turn_msg(waitlist[0]['user_id'], b))
+    if await return_book(bid, c.from_user.id, holder_id, outbox=outbox) is None:
+        await c.answer("Возврат уже подтвержден или книга у другого читателя.", show_alert=True); return
+    await c.message.edit_text("✅ Возврат подтвержден."); await c.answer()
 
 @dp.callback_query(F.data.startswith("skipqueue_"))
 async def p_skipqueue(c: types.CallbackQuery):
-    bid = int(c.data.split("_")[1]); b = await get_book(bid); await remove_from_waitlist(bid, c.from_user.id)
+    bid = int(c.data.split("_")[1]); b = await get_book(bid)
+    rest = [w for w in await get_waitlist(bid) if w['user_id'] != c.from_user.id]
+    await remove_from_waitlist(bid, c.from_user.id, outbox=[queue_turn_msg(rest[0]['user_id'], b)] if rest else [])
     await c.message.edit_text("⏭ Вы пропустили очередь на эту книгу.")
-    waitlist = await get_waitlist(bid)
-    if waitlist:
-        next_user = waitlist[0]
-        kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⏭ Пропустить ход", callback_data=f"skipqueue_{bid}")]])
-        try: await bot.send_message(next_user['user_id'], f"📚 Книга «{b['title']}» освободилась! Вы первый в очереди.", reply_markup=kb)
-        except: pass
     await c.answer()
 
 @dp.callback_query(F.data.startswith("reviews_"))
@@ -558,73 +698,126 @@ async def p_addreview_finish(message: types.Message, state: FSMContext):
     await message.answer("✅ Спасибо за отзыв! Он теперь виден всем в карточке книги.", reply_markup=main_menu()); await state.clear()
 
 # --- Профиль ---
+PROFILE_PAGE_SIZE = 8  # Книг или заявок в одном сообщении раздела профиля
+PROFILE_SECTIONS = {
+    'books': ("👤 <b>Ваш профиль</b>\n\n📚 <b>Мои книги (в базе):</b>", "Пока нет своих книг."),
+    'shelf': ("✨ <b>Моя полка (читаю):</b>", "На полке пусто."),
+    'requests': ("📥 <b>Запросы от других:</b>", "Новых запросов нет."),
+}
+
+def owned_book_status(b):
+    st = "🤝 У читателя" if b['current_holder_id'] else ("✅ Доступна" if b['status']=='available' else "🔒 Скрыта")
+    if b['current_holder_id'] and b['return_requested']: st += " (Ожидается возврат)"
+    return st
+
+def owned_book_card(b):
+    """Карточка своей книги с действиями; b — строка раздела 'books' из get_profile."""
+    q_info = f"\n👥 Очередь: {b['wait_count']} чел." if b['wait_count'] else ""
+    row1 = [
+        InlineKeyboardButton(text="⏸" if b['status']=='available' else "▶️", callback_data=f"toggle_{b['id']}"),
+        InlineKeyboardButton(text="✏️", callback_data=f"edit_{b['id']}"),
+        InlineKeyboardButton(text="🗑", callback_data=f"delete_{b['id']}"),
+        InlineKeyboardButton(text="📜", callback_data=f"hist_{b['id']}"),
+        InlineKeyboardButton(text="💬", callback_data=f"reviews_{b['id']}")
+    ]
+    row2 = []
+    if b['current_holder_id']:
+        if b['return_requested']: row2.append(InlineKeyboardButton(text="🏠 Отмена отзыва", callback_data=f"cancelrecall_{b['id']}"))
+        else: row2.append(InlineKeyboardButton(text="🏠 Отозвать книгу", callback_data=f"recall_{b['id']}"))
+    text = f"📖 <b>{escape(b['title'], quote=False)}</b>\nСтатус: {owned_book_status(b)}{q_info}"
+    return text, InlineKeyboardMarkup(inline_keyboard=[row1, row2] if row2 else [row1])
+
+def shelf_book_card(b):
+    """Карточка книги с полки; b — строка раздела 'shelf' из get_profile."""
+    q_info = f"\n👥 Ждут: {b['wait_count']} чел." if b['wait_count'] else ""
+    text = f"📖 <b>{escape(b['title'], quote=False)}</b>{q_info}"
+    row1 = [
+        InlineKeyboardButton(text="📦 Вернуть хозяину", callback_data=f"return_{b['id']}"),
+        InlineKeyboardButton(text="📜 История", callback_data=f"hist_{b['id']}"),
+        InlineKeyboardButton(text="💬 Отзывы", callback_data=f"reviews_{b['id']}")
+    ]
+    row2 = []
+    if b['return_requested']: text += "\n⚠️ <b>Владелец просит вернуть книгу!</b>"
+    elif b['next_user_id']:
+        target_name = f"@{b['next_username']}" if b['next_username'] else b['next_name']
+        row2.append(InlineKeyboardButton(text=f"🤝 Передать {target_name}", callback_data=f"handover_{b['id']}_{b['next_user_id']}"))
+    return text, InlineKeyboardMarkup(inline_keyboard=[row1, row2] if row2 else [row1])
+
+def profile_section(kind, items, offset=0):
+    """Одна страница раздела профиля (PROFILE_PAGE_SIZE строк) одним сообщением.
+    Книги открываются кнопками с номером (pbook_/pshelf_), заявки выдаются или
+    отклоняются прямо из списка; смещение страницы — в кнопках prof_."""
+    title, empty = PROFILE_SECTIONS[kind]
+    page = items[offset:offset + PROFILE_PAGE_SIZE]
+    lines, rows = [], []
+    for n, b in enumerate(page, offset + 1):
+        name = escape(b['title'], quote=False)
+        if kind == 'books':
+            q_info = f", очередь: {b['wait_count']}" if b['wait_count'] else ""
+            lines.append(f"{n}. <b>{name}</b> — {owned_book_status(b)}{q_info}")
+        elif kind == 'shelf':
+            q_info = f", ждут: {b['wait_count']}" if b['wait_count'] else ""
+            lines.append(f"{n}. <b>{name}</b>{q_info}" + (" — ⚠️ владелец просит вернуть" if b['return_requested'] else ""))
+        else:
+            r_name = f"@{b['renter_username']}" if b['renter_username'] else b['renter_name']
+            lines.append(f"{n}. 👤 {escape(r_name or '', quote=False)} хочет взять <b>{name}</b>")
+            rows.append([InlineKeyboardButton(text=f"✅ {n}. Выдать", callback_data=f"give_{b['id']}_{b['renter_id']}_{offset}"),
+                         InlineKeyboardButton(text="❌ Откл.", callback_data=f"rej_{b['id']}_{b['renter_id']}_{offset}")])
+    if kind != 'requests':
+        prefix = "pbook" if kind == 'books' else "pshelf"
+        buttons = [InlineKeyboardButton(text=f"{n}. {b['title'][:24]}", callback_data=f"{prefix}_{b['id']}")
+                   for n, b in enumerate(page, offset + 1)]
+        rows += [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    nav = []
+    if offset > 0: nav.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"prof_{kind}_{max(0, offset - PROFILE_PAGE_SIZE)}"))
+    if offset + PROFILE_PAGE_SIZE < len(items): nav.append(InlineKeyboardButton(text="Далее ➡️", callback_data=f"prof_{kind}_{offset + PROFILE_PAGE_SIZE}"))
+    if nav: rows.append(nav)
+    text = f"{title}\n\n" + ("\n".join(lines) if lines else empty)
+    if len(items) > PROFILE_PAGE_SIZE: text += f"\n\n📄 {offset + 1}–{offset + len(page)} из {len(items)}"
+    return text, InlineKeyboardMarkup(inline_keyboard=rows) if rows else None
+
+async def refresh_profile_section(message, user_id, kind, offset):
+    """Перерисовывает сообщение раздела после действия; если страница опустела — предыдущую."""
+    items = (await get_profile(user_id))[kind]
+    if offset >= len(items): offset = max(0, (len(items) - 1) // PROFILE_PAGE_SIZE * PROFILE_PAGE_SIZE)
+    text, kb = profile_section(kind, items, offset)
+    await message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+
 @dp.message(F.text == "👤 Мой профиль")
 async def cmd_profile(message: types.Message):
-    await message.answer("👤 <b>Ваш профиль</b>", parse_mode="HTML")
-    # 1. Мои книги
-    my_books = await get_user_books(message.from_user.id)
-    await message.answer("📚 <b>Мои книги (в базе):</b>", parse_mode="HTML")
-    if my_books:
-        for b in my_books:
-            waitlist = await get_waitlist(b['id'])
-            q_info = f"\n👥 Очередь: {len(waitlist)} чел." if waitlist else ""
-            st = "🤝 У читателя" if b['current_holder_id'] else ("✅ Доступна" if b['status']=='available' else "🔒 Скрыта")
-            row1 = [
-                InlineKeyboardButton(text="⏸" if b['status']=='available' else "▶️", callback_data=f"toggle_{b['id']}"),
-                InlineKeyboardButton(text="✏️", callback_data=f"edit_{b['id']}"),
-                InlineKeyboardButton(text="🗑", callback_data=f"delete_{b['id']}"),
-                InlineKeyboardButton(text="📜", callback_data=f"hist_{b['id']}"),
-                InlineKeyboardButton(text="💬", callback_data=f"reviews_{b['id']}")
-            ]
-            row2 = []
-            if b['current_holder_id']:
-                if b['return_requested']:
-                    row2.append(InlineKeyboardButton(text="🏠 Отмена отзыва", callback_data=f"cancelrecall_{b['id']}"))
-                    st += " (Ожидается возврат)"
-                else:
-                    row2.append(InlineKeyboardButton(text="🏠 Отозвать книгу", callback_data=f"recall_{b['id']}"))
-            kb = InlineKeyboardMarkup(inline_keyboard=[row1, row2] if row2 else [row1])
-            await message.answer(f"📖 <b>{b['title']}</b>\nСтатус: {st}{q_info}", parse_mode="HTML", reply_markup=kb)
-    else: await message.answer("Пока нет своих книг.")
-
-    # 2. Моя полка
-    my_shelf = await get_books_on_shelf(message.from_user.id)
-    await message.answer("✨ <b>Моя полка (читаю):</b>", parse_mode="HTML")
-    if my_shelf:
-        for b in my_shelf:
-            waitlist = await get_waitlist(b['id'])
-            q_info = f"\n👥 Ждут: {len(waitlist)} чел." if waitlist else ""
-            info_text = f"📖 <b>{b['title']}</b>{q_info}"
-            row1 = [
-                InlineKeyboardButton(text="📦 Вернуть хозяину", callback_data=f"return_{b['id']}"),
-                InlineKeyboardButton(text="📜 История", callback_data=f"hist_{b['id']}"),
-                InlineKeyboardButton(text="💬 Отзывы", callback_data=f"reviews_{b['id']}")
-            ]
-            row2 = []
-            if b['return_requested']: info_text += "\n⚠️ <b>Владелец просит вернуть книгу!</b>"
-            elif waitlist:
-                next_u = waitlist[0]; target_name = f"@{next_u['username']}" if next_u['username'] else next_u['full_name']
-                row2.append(InlineKeyboardButton(text=f"🤝 Передать {target_name}", callback_data=f"handover_{b['id']}_{next_u['user_id']}"))
-            kb = InlineKeyboardMarkup(inline_keyboard=[row1, row2] if row2 else [row1])
-            await message.answer(info_text, parse_mode="HTML", reply_markup=kb)
-    else: await message.answer("На полке пусто.")
-
-    # 3. Запросы
-    await message.answer("📥 <b>Запросы от других:</b>", parse_mode="HTML")
-    reqs = await get_incoming_requests(message.from_user.id)
-    if reqs:
-        for r in reqs:
-            r_name = f"@{r['renter_username']}" if r['renter_username'] else r['renter_name']
-            kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="✅ Выдать", callback_data=f"give_{r['book_id']}_{r['renter_id']}"), InlineKeyboardButton(text="❌ Откл.", callback_data=f"rej_{r['book_id']}_{r['renter_id']}") ]])
-            await message.answer(f"👤 {r_name} хочет взять:\n📖 <b>{r['title']}</b>", parse_mode="HTML", reply_markup=kb)
-    else: await message.answer("Новых запросов нет.")
+    # Один запрос на весь профиль и по сообщению на раздел (вместо сообщения на каждую книгу)
+    profile = await get_profile(message.from_user.id)
+    for kind in PROFILE_SECTIONS:
+        text, kb = profile_section(kind, profile[kind])
+        await message.answer(text, parse_mode="HTML", reply_markup=kb)
+
+@dp.callback_query(F.data.startswith("prof_"))
+async def p_profile_page(c: types.CallbackQuery):
+    _, kind, offset = c.data.split("_")
+    if kind not in PROFILE_SECTIONS: await c.answer(); return
+    await refresh_profile_section(c.message, c.from_user.id, kind, int(offset)); await c.answer()
+
+@dp.callback_query(F.data.startswith("pbook_") | F.data.startswith("pshelf_"))
+async def p_profile_book(c: types.CallbackQuery):
+    prefix, bid = c.data.split("_"); bid = int(bid)
+    kind, card = ('books', owned_book_card) if prefix == "pbook" else ('shelf', shelf_book_card)
+    b = next(iter((await get_profile(c.from_user.id, bid))[kind]), None)
+    if not b: await c.answer("Книги уже нет в этом списке. Откройте профиль заново.", show_alert=True); return
+    text, kb = card(b)
+    await c.message.answer(text, parse_mode="HTML", reply_markup=kb); await c.answer()
 
 @dp.callback_query(F.data.startswith("toggle_"))
 async def p_toggle_btn(c: types.CallbackQuery):
     bid = int(c.data.split("_")[1]); b = await get_book(bid)
     if not b: return
     ns = 'unavailable' if b['status']=='available' else 'available'
-    await update_book_status(bid, c.from_user.id, ns); await c.answer("Статус изменен!"); await cmd_profile(c.message)
+    await update_book_status(bid, c.from_user.id, ns)
+    # Перерисовываем только карточку этой книги
+    b = next(iter((await get_profile(c.from_user.id, bid))['books']), None)
+    if b:
+        text, kb = owned_book_card(b)
+        await c.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+    await c.answer("Статус изменен!")
 
 # --- Редактирование ---
 @dp.callback_query(F.data.startswith("edit_"))
@@ -647,7 +840,7 @@ async def e_genre(message: types.Message, state: FSMContext):
 
 @dp.message(EditBook.waiting_for_tags)
 async def e_tags(message: types.Message, state: FSMContext):
-    data = await state.get_data(); v = message.text.strip(); t = data['otg'] if v=="0" else ", ".join([x.strip().lower() for x in v.split(",")]); await state.update_data(ntg=t); await message.answer("Рейтинг:", reply_markup=get_age_ratings_keyboard()); await state.set_state(EditBook.waiting_for_age_rating)
+    data = await state.get_data(); v = message.text.strip(); t = normalize_tags(data['otg'] if v=="0" else v); await state.update_data(ntg=t); await message.answer("Рейтинг:", reply_markup=get_age_ratings_keyboard()); await state.set_state(EditBook.waiting_for_age_rating)
 
 @dp.message(EditBook.waiting_for_age_rating)
 async def e_age(message: types.Message, state: FSMContext):
@@ -655,7 +848,7 @@ async def e_age(message: types.Message, state: FSMContext):
 
 @dp.message(EditBook.waiting_for_description)
 async def e_desc(message: types.Message, state: FSMContext):
-    data = await state.get_data(); v = message.text.strip(); nd = data['od'] if v=="0" else v; await update_book_info(data['edit_book_id'], message.from_user.id, data['nt'], data['na'], data['ng'], data['ntg'], data['nr'], nd); await message.answer("✅ Готово!"); await state.clear()
+    data = await state.get_data(); v = message.text.strip(); nd = data['od'] if v=="0" else v; await update_book_info(data['edit_book_id'], data['nt'], data['na'], data['ng'], data['ntg'], data['nr'], nd, owner_id=message.from_user.id); await message.answer("✅ Готово!"); await state.clear()
 
 @dp.callback_query(F.data.startswith("delete_"))
 async def p_del(c: types.CallbackQuery):
@@ -708,33 +901,204 @@ async def cmd_admin(message: types.Message):
     user = await get_user(message.from_user.id)
     if not user or not user['is_admin']: return
     
+    pending = (await count_users_by_status()).get('pending', 0)
     kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"⏳ Заявки ({pending})", callback_data="admuf_pending")],
         [InlineKeyboardButton(text="👥 Список юзеров", callback_data="adm_users")],
-        [InlineKeyboardButton(text="📜 Логи действий", callback_data="adm_logs")]
+        [InlineKeyboardButton(text="📜 Логи действий", callback_data="adm_logs")],
+        [InlineKeyboardButton(text="📈 Производительность", callback_data="adm_perf")]
     ])
     await message.answer("🛡 <b>Панель администратора</b>", parse_mode="HTML", reply_markup=kb)
 
+@dp.callback_query(F.data == "adm_perf")
+async def adm_perf(c: types.CallbackQuery):
+    admin = await get_user(c.from_user.id)
+    if not admin or not admin['is_admin']: await c.answer(); return
+    handlers, sql = metrics.summary()
+    text = "📈 <b>Самые медленные хендлеры</b> (с запуска бота):\n\n"
+    if not handlers: text += "Данных пока нет."
+    for h in handlers:
+        err = f", ошибок: {h['errors']}" if h['errors'] else ""
+        text += f"🔹 <code>{h['handler']}</code> ×{h['count']}\n└ ср. {h['avg_ms']:.1f} мс, p95 ≤ {h['p95_ms']:.0f} мс, SQL: {h['avg_sql']:.1f}{err}\n"
+    if sql:
+        text += "\n🗄 <b>SQL:</b>\n" + "\n".join(f"{op}: {n} запр., ср. {ms:.2f} мс" for op, (n, ms) in sql.items())
+    if last_report:
+        r, mb = last_report, 2**20
+        text += (f"\n\n🧹 <b>Обслуживание БД</b> ({time.strftime('%d.%m %H:%M', time.localtime(r['at']))}):\n"
+                 f"в архив: история {r.get('movements_archived', 0)}, брони {r.get('bookings_archived', 0)}, "
+                 f"журнал {r.get('admin_logs_archived', 0)}\n"
+                 f"освобождено {r['bytes_reclaimed'] / mb:.1f} МБ; база {r['db_bytes'] / mb:.1f} МБ, "
+                 f"из них свободно {r['free_bytes'] / mb:.1f} МБ")
+    await c.message.answer(text, parse_mode="HTML"); await c.answer()
+
+USERS_PAGE_SIZE = 20  # Пользователей на одной странице справочника
+USER_STATUS_ICONS = {'approved': "✅", 'pending': "⏳", 'blocked': "🚫", 'rejected': "❌"}
+USER_STATUS_NAMES = {'pending': "Ждут одобрения", 'approved': "Одобренные", 'blocked': "Заблокированные", 'rejected': "Отклоненные"}
+
+async def is_admin_user(user_id):
+    admin = await get_user(user_id)
+    return bool(admin and admin['is_admin'])
+
 @dp.callback_query(F.data == "adm_users")
 async def adm_users_list(c: types.CallbackQuery):
-    users = await get_all_users()
-    text = "👥 <b>Все пользователи:</b>\n\n"
+    if not await is_admin_user(c.from_user.id): await c.answer(); return
+    counts = await count_users_by_status()
+    rows = [[InlineKeyboardButton(text=f"{USER_STATUS_ICONS[st]} {USER_STATUS_NAMES[st]} ({counts[st]})", callback_data=f"admuf_{st}")]
+            for st in USER_STATUSES if counts.get(st)]
+    rows.append([InlineKeyboardButton(text="📍 По району", callback_data="admuf_districts"),
+                 InlineKeyboardButton(text="🔎 По имени", callback_data="admuf_name")])
+    rows.append([InlineKeyboardButton(text=f"👥 Все ({sum(counts.values())})", callback_data="admuf_all")])
+    await c.message.answer("👥 <b>Пользователи</b>", parse_mode="HTML", reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
+    await c.answer()
+
+async def show_users_page(message, state, query, after=None, before=None, edit=False):
+    """Одна страница справочника (USERS_PAGE_SIZE пользователей) одним сообщением.
+    Фильтры лежат в FSM (adm_users_query), в кнопках — только user_id для курсора."""
+    await state.update_data(adm_users_query=query)
+    users = await search_users(**query, after=after, before=before, limit=USERS_PAGE_SIZE + 1)
+    if before is not None:
+        has_prev, has_next = len(users) > USERS_PAGE_SIZE, True
+        users = users[-USERS_PAGE_SIZE:]
+    else:
+        has_prev, has_next = after is not None, len(users) > USERS_PAGE_SIZE
+        users = users[:USERS_PAGE_SIZE]
+    title = " · ".join(filter(None, [USER_STATUS_NAMES.get(query.get('status')), query.get('district') and f"📍 {query['district']}",
+                                     query.get('name') and f"🔎 «{query['name']}»"])) or "Все пользователи"
+    text = f"👥 <b>{escape(title, quote=False)}</b>\n\n"
+    if not users: text += "Никого не найдено."
     for u in users:
-        icon = "✅" if u['status'] == 'approved' else ("⏳" if u['status'] == 'pending' else "🚫")
         admin_at = " ⭐" if u['is_admin'] else ""
-        text += f"{icon} {u['real_name'] or 'Не указано'} (@{u['username'] or 'no_user'}){admin_at}\n"
-        text += f"└ 📍 {u['district'] or '-'}\n"
-        text += f"└ Действия: /u_{u['user_id']}\n\n"
-    await c.message.answer(text, parse_mode="HTML"); await c.answer()
+        name = escape((u['real_name'] or u['full_name'] or 'Не указано')[:60], quote=False)
+        text += f"{USER_STATUS_ICONS.get(u['status'], '❔')} {name} (@{escape(u['username'] or 'no_user', quote=False)}){admin_at}\n"
+        text += f"└ 📍 {escape((u['district'] or '-')[:60], quote=False)} · /u_{u['user_id']}\n"
+    nav = []
+    if users and has_prev: nav.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"admuprev_{users[0]['user_id']}"))
+    if users and has_next: nav.append(InlineKeyboardButton(text="Далее ➡️", callback_data=f"admunext_{users[-1]['user_id']}"))
+    kb = InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+    if edit: await message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+    else: await message.answer(text, parse_mode="HTML", reply_markup=kb)
+
+@dp.callback_query(F.data.startswith("admuf_"))
+async def adm_users_filter(c: types.CallbackQuery, state: FSMContext):
+    if not await is_admin_user(c.from_user.id): await c.answer(); return
+    action = c.data.split("_", 1)[1]
+    if action in USER_STATUSES: await show_users_page(c.message, state, {'status': action})
+    elif action == "all": await show_users_page(c.message, state, {})
+    elif action == "districts":
+        districts = await get_user_districts()
+        if not districts: await c.answer("Районы еще не указаны.", show_alert=True); return
+        # Район — произвольный текст, в callback_data только его номер в списке
+        await state.update_data(adm_districts=[d for d, _ in districts])
+        btns = [[InlineKeyboardButton(text=f"{d[:40]} ({n})", callback_data=f"admud_{i}")] for i, (d, n) in enumerate(districts)]
+        await c.message.answer("📍 Выберите район:", reply_markup=InlineKeyboardMarkup(inline_keyboard=btns))
+    elif action == "name":
+        await state.set_state(AdminUsers.waiting_for_name)
+        await c.message.answer("🔎 Введите часть имени или @username:")
+    await c.answer()
 
-@dp.callback_query(F.data == "adm_logs")
-async def adm_logs_list(c: types.CallbackQuery):
-    logs = await get_admin_logs()
-    text = "📜 <b>Последние действия админов:</b>\n\n"
-    if not logs: text += "Логов пока нет."
+@dp.callback_query(F.data.startswith("admud_"))
+async def adm_users_district(c: types.CallbackQuery, state: FSMContext):
+    if not await is_admin_user(c.from_user.id): await c.answer(); return
+    districts = (await state.get_data()).get('adm_districts') or []
+    i = int(c.data.split("_")[1])
+    if i >= len(districts): await c.answer("Список устарел, откройте его заново.", show_alert=True); return
+    await show_users_page(c.message, state, {'district': districts[i]}); await c.answer()
+
+@dp.message(AdminUsers.waiting_for_name, F.text)
+async def adm_users_name(message: types.Message, state: FSMContext):
+    await state.set_state(None)
+    if not await is_admin_user(message.from_user.id): return
+    await show_users_page(message, state, {'name': message.text.strip()})
+
+@dp.callback_query(F.data.startswith("admunext_") | F.data.startswith("admuprev_"))
+async def adm_users_page(c: types.CallbackQuery, state: FSMContext):
+    if not await is_admin_user(c.from_user.id): await c.answer(); return
+    direction, uid = c.data.split("_")
+    query = (await state.get_data()).get('adm_users_query')
+    if query is None: await c.answer("Список устарел, откройте его заново.", show_alert=True); return
+    page = {'after': int(uid)} if direction == "admunext" else {'before': int(uid)}
+    await show_users_page(c.message, state, query, **page, edit=True); await c.answer()
+
+LOGS_PAGE_SIZE = 10  # Записей журнала на одной странице
+ADMIN_ACTIONS = {
+    'approve_user': "✅ Одобрение", 'reject_user': "❌ Отклонение", 'block_user': "🚫 Блокировка",
+    'make_admin': "⭐ Новый админ", 'delete_review': "🗑 Удаление отзыва",
+}
+
+async def show_logs_page(message, state, query, after=None, before=None, edit=False):
+    """Страница журнала админов (LOGS_PAGE_SIZE записей, новые первыми) с фильтрами.
+    Фильтры лежат в FSM (adm_logs_query), в кнопках — только id записи для курсора."""
+    await state.update_data(adm_logs_query=query)
+    logs = await get_admin_logs(**query, after=after, before=before, limit=LOGS_PAGE_SIZE + 1)
+    if before is not None:
+        has_newer, has_older = len(logs) > LOGS_PAGE_SIZE, True
+        logs = logs[-LOGS_PAGE_SIZE:]
     else:
-        for l in logs:
-            text += f"🔹 {l['created_at']}\nID {l['admin_id']}: {l['action_type']}\n{l['details']}\n\n"
-    await c.message.answer(text, parse_mode="HTML"); await c.answer()
+        has_newer, has_older = after is not None, len(logs) > LOGS_PAGE_SIZE
+        logs = logs[:LOGS_PAGE_SIZE]
+    title = " · ".join(filter(None, [ADMIN_ACTIONS.get(query.get('action_type'), query.get('action_type')),
+                                     query.get('admin_id') and f"админ {query['admin_id']}"])) or "Последние действия админов"
+    text = f"📜 <b>{escape(title, quote=False)}:</b>\n\n"
+    if not logs: text += "Записей нет."
+    for l in logs:
+        action = ADMIN_ACTIONS.get(l['action_type'], l['action_type'])
+        text += f"🔹 {l['created_at']} · {escape(action, quote=False)}\n👤 /la_{l['admin_id']}: {escape((l['details'] or '')[:200], quote=False)}\n\n"
+    rows = []
+    nav = []
+    if logs and has_newer: nav.append(InlineKeyboardButton(text="⬅️ Новее", callback_data=f"admlprev_{logs[0]['id']}"))
+    if logs and has_older: nav.append(InlineKeyboardButton(text="Старее ➡️", callback_data=f"admlnext_{logs[-1]['id']}"))
+    if nav: rows.append(nav)
+    actions = [InlineKeyboardButton(text=label, callback_data=f"admlf_{a}") for a, label in ADMIN_ACTIONS.items() if a != query.get('action_type')]
+    rows += [actions[i:i + 2] for i in range(0, len(actions), 2)]
+    if query: rows.append([InlineKeyboardButton(text="🔄 Сбросить фильтры", callback_data="admlf_all")])
+    rows.append([InlineKeyboardButton(text=f"🐢 Медленные запросы ({len(slow_queries)})", callback_data="adm_slow")])
+    kb = InlineKeyboardMarkup(inline_keyboard=rows)
+    if edit: await message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+    else: await message.answer(text, parse_mode="HTML", reply_markup=kb)
+
+@dp.callback_query(F.data == "adm_logs")
+async def adm_logs_list(c: types.CallbackQuery, state: FSMContext):
+    if not await is_admin_user(c.from_user.id): await c.answer(); return
+    await show_logs_page(c.message, state, {}); await c.answer()
+
+@dp.callback_query(F.data.startswith("admlf_"))
+async def adm_logs_filter(c: types.CallbackQuery, state: FSMContext):
+    if not await is_admin_user(c.from_user.id): await c.answer(); return
+    action = c.data.split("_", 1)[1]
+    query = (await state.get_data()).get('adm_logs_query') or {}
+    query = {} if action == "all" else {**query, 'action_type': action}
+    await show_logs_page(c.message, state, query, edit=True); await c.answer()
+
+@dp.message(F.text.startswith("/la_"))
+async def adm_logs_by_admin(message: types.Message, state: FSMContext):
+    if not await is_admin_user(message.from_user.id): return
+    try: admin_id = int(message.text.split("_")[1])
+    except ValueError: return
+    await show_logs_page(message, state, {'admin_id': admin_id})
+
+@dp.callback_query(F.data.startswith("admlnext_") | F.data.startswith("admlprev_"))
+async def adm_logs_page(c: types.CallbackQuery, state: FSMContext):
+    if not await is_admin_user(c.from_user.id): await c.answer(); return
+    direction, log_id = c.data.split("_")
+    query = (await state.get_data()).get('adm_logs_query')
+    if query is None: await c.answer("Журнал устарел, откройте его заново.", show_alert=True); return
+    page = {'after': int(log_id)} if direction == "admlnext" else {'before': int(log_id)}
+    await show_logs_page(c.message, state, query, **page, edit=True); await c.answer()
+
+@dp.callback_query(F.data == "adm_slow")
+async def adm_slow_queries(c: types.CallbackQuery):
+    admin = await get_user(c.from_user.id)
+    if not admin or not admin['is_admin']: await c.answer(); return
+    if not slow_queries:
+        await c.message.answer(f"🐢 Запросов дольше {SLOW_QUERY_MS:.0f} мс с запуска бота не было."); await c.answer(); return
+    # Последние 5, каждый обрезан, чтобы уложиться в лимит сообщения Telegram
+    for q in list(slow_queries)[-5:][::-1]:
+        plan = "\n".join(q['plan'] or ["(план еще не получен)"])
+        text = (f"🐢 <b>{q['ms']:.0f} мс</b> · {time.strftime('%d.%m %H:%M:%S', time.localtime(q['at']))}\n"
+                f"<pre>{escape(q['sql'][:1500], quote=False)}</pre>\nПараметры: <code>{escape(str(q['params'])[:300], quote=False)}</code>\n"
+                f"План:\n<pre>{escape(plan[:1500], quote=False)}</pre>")
+        await c.message.answer(text, parse_mode="HTML")
+    await c.answer()
 
 @dp.message(F.text.startswith("/u_"))
 async def adm_user_detail(message: types.Message):
@@ -756,19 +1120,15 @@ async def adm_user_detail(message: types.Message):
 @dp.callback_query(F.data.startswith("adm_appr_"))
 async def adm_approve(c: types.CallbackQuery):
     uid = int(c.data.split("_")[2])
-    await update_user_status(uid, 'approved')
+    await update_user_status(uid, 'approved', outbox=[outbox_msg(uid, "🎉 Ваша заявка одобрена! Добро пожаловать в клуб. Теперь бот полностью доступен.")])
     await log_admin_action(c.from_user.id, "approve_user", f"User ID: {uid}")
-    try: await bot.send_message(uid, "🎉 Ваша заявка одобрена! Добро пожаловать в клуб. Теперь бот полностью доступен.")
-    except: pass
     await c.message.edit_text("✅ Пользователь одобрен."); await c.answer()
 
 @dp.callback_query(F.data.startswith("adm_rejt_"))
 async def adm_reject(c: types.CallbackQuery):
     uid = int(c.data.split("_")[2])
-    await update_user_status(uid, 'rejected')
+    await update_user_status(uid, 'rejected', outbox=[outbox_msg(uid, "😔 К сожалению, ваша заявка на вступление отклонена.")])
     await log_admin_action(c.from_user.id, "reject_user", f"User ID: {uid}")
-    try: await bot.send_message(uid, "😔 К сожалению, ваша заявка на вступление отклонена.")
-    except: pass
     await c.message.edit_text("❌ Заявка отклонена."); await c.answer()
 
 @dp.callback_query(F.data.startswith("adm_block_"))
@@ -785,7 +1145,24 @@ async def adm_make_admin(c: types.CallbackQuery):
     await log_admin_action(c.from_user.id, "make_admin", f"User ID: {uid}")
     await c.message.edit_text("⭐ Пользователь назначен администратором."); await c.answer()
 
-async def main(): await init_db(); await dp.start_polling(bot)
+async def main():
+    await init_db(); get_http_session()
+    outbox_task = asyncio.create_task(outbox_worker(bot))
+    maintenance_task = asyncio.create_task(maintenance_worker())
+    metrics_runner = None
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            if METRICS_PORT: metrics_runner = await run_metrics_server(METRICS_HOST, METRICS_PORT)
+            await bot.delete_webhook()  # иначе Telegram не отдаст обновления через getUpdates
+            await dp.start_polling(bot)
+    finally:
+        outbox_task.cancel(); maintenance_task.cancel()
+        if metrics_runner: await metrics_runner.cleanup()
+        await dp.storage.close()
+        await http_session.close()
+        await close_db()
 if __name__ == "__main__":
     try: asyncio.run(main())
     except: pass
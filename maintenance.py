@@ -0,0 +1,36 @@
+import asyncio
+import logging
+import time
+
+from config import MAINTENANCE_INTERVAL_MINUTES, ADMIN_LOG_RETENTION_DAYS, MOVEMENTS_RETENTION_DAYS
+from models import archive_admin_logs, archive_movements, archive_bookings, incremental_vacuum, get_db_space
+
+# Итоги последнего прохода (для панели «Производительность»): {'at': time.time(), задача: число}
+last_report = {}
+
+async def run_maintenance():
+    """Один проход обслуживания базы. Возвращает итоги: перенесенные в архив строки
+    по таблицам, освобожденные байты и размер базы после прохода."""
+    report = {}
+    if ADMIN_LOG_RETENTION_DAYS > 0:
+        report['admin_logs_archived'] = await archive_admin_logs(ADMIN_LOG_RETENTION_DAYS)
+    if MOVEMENTS_RETENTION_DAYS > 0:
+        report['movements_archived'] = await archive_movements(MOVEMENTS_RETENTION_DAYS)
+    report['bookings_archived'] = await archive_bookings()
+    report['bytes_reclaimed'] = await incremental_vacuum()
+    space = await get_db_space()
+    report['db_bytes'], report['free_bytes'] = space['size'], space['free']
+    last_report.clear()
+    last_report.update(report, at=time.time())
+    return report
+
+async def maintenance_worker():
+    """Запускает run_maintenance сразу после старта и затем раз в MAINTENANCE_INTERVAL_MINUTES."""
+    while True:
+        try:
+            report = await run_maintenance()
+            if any(v for k, v in report.items() if k not in ('db_bytes', 'free_bytes')):
+                logging.info("Обслуживание БД: %s", report)
+        except Exception:
+            logging.exception("Ошибка обслуживания БД")
+        await asyncio.sleep(MAINTENANCE_INTERVAL_MINUTES * 60)
@@ -0,0 +1,155 @@
+import bisect
+import time
+
+from aiogram import BaseMiddleware
+
+# Границы корзин гистограмм (Prometheus): задержки в секундах и число SQL-запросов
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами, как в клиентах Prometheus."""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя корзина — +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Оценка квантиля: верхняя граница корзины, в которую он попал."""
+        if not self.count: return 0.0
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank: return bound
+        return float("inf")
+
+class HistogramFamily:
+    """Набор гистограмм одной метрики с разными значениями метки."""
+    def __init__(self, name, help_text, label, buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.label, self.buckets = name, help_text, label, buckets
+        self.series = {}
+
+    def observe(self, label_value, value):
+        h = self.series.get(label_value)
+        if h is None: h = self.series[label_value] = Histogram(self.buckets)
+        h.observe(value)
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for value, h in sorted(self.series.items()):
+            labels = f'{self.label}="{value}"'
+            cumulative = 0
+            for bound, n in zip(self.buckets, h.counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {h.count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {h.sum:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {h.count}")
+        return lines
+
+class CounterFamily:
+    def __init__(self, name, help_text, label):
+        self.name, self.help, self.label = name, help_text, label
+        self.values = {}
+
+    def inc(self, label_value, amount=1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f'{self.name}{{{self.label}="{v}"}} {n}' for v, n in sorted(self.values.items())]
+        return lines
+
+update_latency = HistogramFamily("bot_update_latency_seconds", "Время обработки обновления по хендлеру", "handler")
+callback_latency = HistogramFamily("bot_callback_latency_seconds", "Время обработки нажатия кнопки по префиксу callback_data", "prefix")
+update_statements = HistogramFamily("bot_update_sql_statements", "SQL-запросов на одно обновление", "handler", STATEMENT_BUCKETS)
+update_errors = CounterFamily("bot_update_errors_total", "Обновления, обработка которых завершилась исключением", "handler")
+sql_latency = HistogramFamily("bot_sql_latency_seconds", "Время выполнения SQL-запроса models.py по типу", "op")
+
+FAMILIES = (update_latency, callback_latency, update_statements, update_errors, sql_latency)
+
+def observe_sql(sql, seconds):
+    sql_latency.observe(sql.split(None, 1)[0].upper(), seconds)
+
+def callback_prefix(data):
+    """«lib_all» -> «lib_», «give_12_34» -> «give_»; без подчеркивания — вся строка."""
+    head, sep, _ = (data or "").partition("_")
+    return head + sep
+
+class MetricsMiddleware(BaseMiddleware):
+    """Outer-middleware обновлений: время обработки, число и время SQL-запросов.
+
+    Какой хендлер сработал, становится известно только после роутинга, поэтому
+    HandlerNameMiddleware (inner, на message/callback_query/inline_query)
+    записывает его имя в общий словарь metrics_record из data.
+    """
+    def __init__(self, count_queries):
+        self.count_queries = count_queries
+
+    async def __call__(self, handler, event, data):
+        record = data['metrics_record'] = {'handler': "unhandled"}
+        started = time.perf_counter()
+        failed = False
+        with self.count_queries() as q:
+            try:
+                return await handler(event, data)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                name = record['handler']
+                update_latency.observe(name, elapsed)
+                update_statements.observe(name, q['queries'])
+                if failed: update_errors.inc(name)
+                if event.callback_query is not None:
+                    callback_latency.observe(callback_prefix(event.callback_query.data), elapsed)
+
+class HandlerNameMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        record = data.get('metrics_record')
+        if record is not None and 'handler' in data:
+            record['handler'] = data['handler'].callback.__name__
+        return await handler(event, data)
+
+def setup(dp, count_queries):
+    dp.update.outer_middleware(MetricsMiddleware(count_queries))
+    name_middleware = HandlerNameMiddleware()
+    for observer in (dp.message, dp.callback_query, dp.inline_query):
+        observer.middleware(name_middleware)
+
+def simple_lines(name, help_text, kind, values):
+    """Строки для счетчика или gauge: values — {значение метки или None: число}."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for labels, value in values.items():
+        lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+    return lines
+
+def expose(extra=()):
+    """Все метрики в текстовом формате Prometheus; extra — строки дополнительных метрик."""
+    lines = []
+    for family in FAMILIES:
+        lines += family.expose()
+    lines += extra
+    return "\n".join(lines) + "\n"
+
+def summary(limit=10):
+    """Самые медленные хендлеры (по среднему времени) для админки."""
+    rows = []
+    for name, h in update_latency.series.items():
+        statements = update_statements.series.get(name)
+        rows.append({
+            'handler': name, 'count': h.count, 'avg_ms': h.sum / h.count * 1000,
+            'p95_ms': h.quantile(0.95) * 1000,
+            'avg_sql': statements.sum / statements.count if statements and statements.count else 0,
+            'errors': update_errors.values.get(name, 0),
+        })
+    rows.sort(key=lambda r: r['avg_ms'], reverse=True)
+    sql = {op: (h.count, h.sum / h.count * 1000) for op, h in sorted(sql_latency.series.items()) if h.count}
+    return rows[:limit], sql
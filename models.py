@@ -1,10 +1,523 @@
+import asyncio
+import contextvars
 import aiosqlite
+import json
+import logging
 import os
+import re
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+from metrics import observe_sql
 
 DB_PATH = 'books_bot.db'
+POOL_SIZE = 4
+
+# Активные счетчики запросов текущей задачи (см. count_queries)
+_query_counters = contextvars.ContextVar("query_counters", default=())
+
+@contextmanager
+def count_queries():
+    """Считает SQL-запросы, выполненные внутри блока: with count_queries() as q: ...; q['queries'].
+    Блоки могут быть вложенными — запрос учитывается во всех активных счетчиках."""
+    counter = {'queries': 0}
+    token = _query_counters.set(_query_counters.get() + (counter,))
+    try:
+        yield counter
+    finally:
+        _query_counters.reset(token)
+
+class _TimedQuery:
+    """Результат execute(): как aiosqlite.Result (await или async with), но с замером времени.
+    В форме async with время считается до выхода из блока, т.е. вместе с fetch*()."""
+    __slots__ = ("_result", "_sql", "_params", "_started")
+
+    def __init__(self, result, sql, params):
+        self._result = result
+        self._sql = sql
+        self._params = params
+
+    def __await__(self):
+        return self._run().__await__()
+
+    async def _run(self):
+        self._started = time.perf_counter()
+        try: return await self._result
+        finally: self._done()
+
+    async def __aenter__(self):
+        self._started = time.perf_counter()
+        return await self._result.__aenter__()
+
+    async def __aexit__(self, *exc):
+        try: await self._result.__aexit__(*exc)
+        finally: self._done()
+
+    def _done(self):
+        elapsed = time.perf_counter() - self._started
+        observe_sql(self._sql, elapsed)
+        if elapsed * 1000 >= SLOW_QUERY_MS: _log_slow_query(self._sql, self._params, elapsed)
+
+class _Connection:
+    """Обертка над соединением из пула: учитывает и замеряет каждый execute()."""
+    def __init__(self, conn):
+        self._conn = conn
+        self.outbox_rows = 0  # сколько уведомлений записано через _add_outbox
+
+    def execute(self, sql, parameters=None):
+        for counter in _query_counters.get():
+            counter['queries'] += 1
+        return _TimedQuery(self._conn.execute(sql, parameters), sql, parameters)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+# Настройки каждого соединения. WAL: читатели не ждут писателя, коммит — дозапись в журнал
+# (режим сохраняется в файле базы). synchronous=NORMAL в WAL не делает fsync на каждый коммит:
+# при отключении питания можно потерять последние коммиты, но база остается целой.
+# auto_vacuum действует только на новой базе и только если задан до journal_mode;
+# существующую переводит разовый VACUUM (см. incremental_vacuum).
+PRAGMAS = (
+    ("auto_vacuum", "INCREMENTAL"),
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("cache_size", -16000),      # 16 МБ на соединение
+    ("mmap_size", 256 * 2**20),
+    ("temp_store", "MEMORY"),
+    ("busy_timeout", 5000),      # на случай внешних процессов (резервная копия, sqlite3)
+)
+WRITE_BATCH = 64  # сколько изменений из очереди писателя объединяется в один коммит
+
+class _WriteJob:
+    __slots__ = ("granted", "finished", "committed")
+
+    def __init__(self, loop):
+        self.granted = loop.create_future()    # писатель выдал соединение
+        self.finished = loop.create_future()   # блок write() завершился (None или исключение)
+        self.committed = loop.create_future()  # транзакция с этим изменением закоммичена
+
+    def finish(self, exc=None):
+        if not self.finished.done(): self.finished.set_result(exc)
+
+class ConnectionPool:
+    """Небольшой пул долгоживущих соединений aiosqlite.
+
+    Соединения открываются один раз (в init_db) и выдаются функциям модуля
+    через acquire(), вместо нового aiosqlite.connect() (и нового потока) на каждый вызов.
+    Соединения acquire() только читают; все изменения идут через write().
+    """
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self._conns = []
+        self._idle = None
+        self._lock = asyncio.Lock()
+        self._writes = None
+        self._writer = None
+        self.writes = self.commits = self.failed_commits = 0
+
+    async def _connect(self, path, **kwargs):
+        conn = await aiosqlite.connect(path or DB_PATH, **kwargs)
+        conn.row_factory = aiosqlite.Row
+        for name, value in PRAGMAS:
+            await conn.execute(f"PRAGMA {name} = {value}")
+        self._conns.append(conn)
+        return conn
+
+    async def open(self, path=None):
+        async with self._lock:
+            if self._conns: return
+            self._idle = asyncio.Queue()
+            for _ in range(self.size):
+                self._idle.put_nowait(await self._connect(path))
+            # Отдельное соединение писателя; транзакциями управляет сам писатель
+            writer_conn = await self._connect(path, isolation_level=None)
+            self._writes = asyncio.Queue()
+            self._writer = asyncio.create_task(self._write_loop(writer_conn))
+
+    @asynccontextmanager
+    async def acquire(self):
+        if not self._conns: await self.open()
+        conn = await self._idle.get()
+        try:
+            yield _Connection(conn)
+        except BaseException:
+            # Не оставляем в пуле соединение с незавершенной транзакцией
+            if conn.in_transaction: await conn.rollback()
+            raise
+        finally:
+            self._idle.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        """Соединение писателя для изменений: async with pool.write() as db: ...
+
+        Блоки выполняются строго по очереди, каждый в своей точке сохранения:
+        исключение откатывает только этот блок. Блоки, накопившиеся в очереди,
+        коммитятся одной транзакцией (group commit). Выход из блока ждет коммита,
+        поэтому после него изменения видны всем читателям. commit() вызывать не нужно.
+        Внутри блока нельзя вызывать другие функции, которые пишут (взаимоблокировка).
+        """
+        if not self._conns: await self.open()
+        job = _WriteJob(asyncio.get_running_loop())
+        self._writes.put_nowait(job)
+        try:
+            db = _Connection(await job.granted)
+            yield db
+        except BaseException as e:
+            job.finish(e)
+            raise
+        job.finish()
+        await job.committed
+        if db.outbox_rows: outbox_event().set()
+
+    async def _write_loop(self, conn):
+        stopping = False
+        while not stopping:
+            job = await self._writes.get()
+            if job is None: return
+            batch, error = [], None
+            try:
+                await conn.execute("BEGIN IMMEDIATE")
+                while True:
+                    batch.append(job)
+                    await conn.execute("SAVEPOINT job")
+                    if not job.granted.done(): job.granted.set_result(conn)
+                    if await job.finished is not None:
+                        await conn.execute("ROLLBACK TO job")
+                    await conn.execute("RELEASE job")
+                    if len(batch) >= WRITE_BATCH or self._writes.empty(): break
+                    job = self._writes.get_nowait()
+                    if job is None:
+                        stopping = True
+                        break
+                await conn.execute("COMMIT")
+                self.commits += 1
+                self.writes += len(batch)
+            except Exception as e:
+                logging.exception("Ошибка записи группы из %d изменений", len(batch))
+                if conn.in_transaction: await conn.execute("ROLLBACK")
+                self.failed_commits += 1
+                error = e
+            for job in batch:
+                if error is not None and not job.granted.done(): job.granted.set_exception(error)
+                if job.committed.done(): continue
+                if error is None: job.committed.set_result(None)
+                else: job.committed.set_exception(error)
+
+    def stats(self):
+        return {'writes': self.writes, 'commits': self.commits, 'failed_commits': self.failed_commits,
+                'write_queue': self._writes.qsize() if self._writes else 0}
+
+    async def close(self):
+        async with self._lock:
+            if self._writer:
+                # Дописываем все, что уже в очереди, и останавливаем писателя
+                self._writes.put_nowait(None)
+                await self._writer
+                self._writer = None
+            conns, self._conns = self._conns, []
+            for conn in conns:
+                await conn.close()
+
+pool = ConnectionPool()
+
+MISSING = object()
+
+class LRUCache:
+    """Ограниченный LRU-кэш со счетчиками попаданий и промахов.
+
+    version растет при каждой инвалидации: значение, прочитанное из БД до
+    инвалидации, не попадет в кэш (put с устаревшей версией игнорируется).
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = self.misses = 0
+        self.version = 0
+
+    def get(self, key):
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+        self.misses += 1
+        return MISSING
+
+    def put(self, key, value, version=None):
+        if version is not None and version != self.version: return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+        self.version += 1
+
+    def clear(self):
+        self._data.clear()
+        self.version += 1
+
+    def stats(self):
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+# Записи users по user_id (включая «нет такого пользователя»).
+# Сбрасывается функциями, меняющими users: add_user, update_user_*, set_admin_status.
+USER_CACHE_SIZE = 1024
+user_cache = LRUCache(USER_CACHE_SIZE)
+
+# Журнал медленных запросов: последние SLOW_QUERY_LOG_SIZE запросов дольше SLOW_QUERY_MS
+# (порог задается в .env) с типами параметров и планом EXPLAIN QUERY PLAN
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+SLOW_QUERY_LOG_SIZE = 50
+slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+_plan_cache = LRUCache(64)  # SQL -> план, чтобы не повторять EXPLAIN для одного и того же запроса
+_EXPLAINABLE = ("SELECT", "WITH", "UPDATE", "DELETE", "INSERT", "REPLACE")
+
+def _param_shape(value):
+    """Тип параметра без значения (значения могут содержать личные данные)."""
+    if value is None: return "NULL"
+    if isinstance(value, (str, bytes)): return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+def _log_slow_query(sql, params, elapsed):
+    if isinstance(params, dict): shapes = {k: _param_shape(v) for k, v in params.items()}
+    else: shapes = [_param_shape(v) for v in params or ()]
+    entry = {'at': time.time(), 'ms': round(elapsed * 1000, 1), 'sql': " ".join(sql.split()), 'params': shapes, 'plan': None}
+    slow_queries.append(entry)
+    logging.warning("Медленный запрос %.0f мс: %s %s", entry['ms'], entry['sql'][:300], shapes)
+    plan = _plan_cache.get(sql)
+    if plan is not MISSING: entry['plan'] = plan
+    elif sql.split(None, 1)[0].upper() in _EXPLAINABLE:
+        asyncio.get_running_loop().create_task(_explain(entry, sql, params))
+
+async def _explain(entry, sql, params):
+    try:
+        async with pool.acquire() as db:
+            # Мимо _TimedQuery: сам EXPLAIN не замеряется и не попадает в журнал
+            async with db._conn.execute("EXPLAIN QUERY PLAN " + sql, params) as cursor:
+                plan = [row[3] for row in await cursor.fetchall()]
+    except Exception as e:
+        plan = [f"EXPLAIN не удался: {e}"]
+    _plan_cache.put(sql, plan)
+    entry['plan'] = plan
+
+# Статистика для /stats: счетчики и число передач по книгам и читателям.
+# Обновляются триггерами при каждом изменении users, books и movements.
+# Удаление строк movements (архивация) счетчики не уменьшает — это итог за все время.
+STATS_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS stats_counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS book_transfer_counts (book_id INTEGER PRIMARY KEY, count INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS reader_transfer_counts (user_id INTEGER PRIMARY KEY, count INTEGER NOT NULL DEFAULT 0)",
+    "CREATE INDEX IF NOT EXISTS idx_book_transfer_counts_count ON book_transfer_counts (count)",
+    "CREATE INDEX IF NOT EXISTS idx_reader_transfer_counts_count ON reader_transfer_counts (count)",
+    """CREATE TRIGGER IF NOT EXISTS stats_users_ai AFTER INSERT ON users WHEN new.status = 'approved' BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'total_users';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stats_users_au AFTER UPDATE OF status ON users
+    WHEN (old.status = 'approved') != (new.status = 'approved') BEGIN
+        UPDATE stats_counters SET value = value + (CASE WHEN new.status = 'approved' THEN 1 ELSE -1 END)
+        WHERE name = 'total_users';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stats_books_ai AFTER INSERT ON books BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'total_books';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stats_books_ad AFTER DELETE ON books BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'total_books';
+        DELETE FROM book_transfer_counts WHERE book_id = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stats_movements_ai AFTER INSERT ON movements WHEN new.event_type = 'transfer' BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'total_transfers';
+        INSERT INTO book_transfer_counts (book_id, count) SELECT new.book_id, 1 WHERE EXISTS (SELECT 1 FROM books WHERE id = new.book_id)
+            ON CONFLICT (book_id) DO UPDATE SET count = count + 1;
+        INSERT INTO reader_transfer_counts (user_id, count) SELECT new.to_user_id, 1 WHERE new.to_user_id IS NOT NULL
+            ON CONFLICT (user_id) DO UPDATE SET count = count + 1;
+    END""",
+]
+
+# Полнотекстовый индекс книг. Хранит свою копию текста с «ё» -> «е»,
+# чтобы «темное» находило «Тёмное»; синхронизируется триггерами на books.
+FTS_COLUMNS = ("title", "author", "description", "tags")
+FTS_WEIGHTS = "10.0, 5.0, 1.0, 3.0"
+
+def _fts_norm(expr):
+    return f"replace(replace({expr}, 'ё', 'е'), 'Ё', 'Е')"
+
+def _fts_values(prefix):
+    return ", ".join(_fts_norm(f"{prefix}.{c}") for c in FTS_COLUMNS)
+
+FTS_SCHEMA = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+        {", ".join(FTS_COLUMNS)}, tokenize = 'unicode61 remove_diacritics 2'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS books_fts_ai AFTER INSERT ON books BEGIN
+        INSERT INTO books_fts (rowid, {", ".join(FTS_COLUMNS)}) VALUES (new.id, {_fts_values("new")});
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_ad AFTER DELETE ON books BEGIN
+        DELETE FROM books_fts WHERE rowid = old.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS books_fts_au AFTER UPDATE OF {", ".join(FTS_COLUMNS)} ON books BEGIN
+        DELETE FROM books_fts WHERE rowid = old.id;
+        INSERT INTO books_fts (rowid, {", ".join(FTS_COLUMNS)}) VALUES (new.id, {_fts_values("new")});
+    END""",
+]
+
+# Фасеты каталога: число книг по жанру, возрастному рейтингу и тегу для меню поиска.
+# Значение тега — ключ tag_key(), как в book_tags: кнопка меню находит столько книг, сколько на ней написано.
+# Книга попадает в корзину 'available' или 'held' (как в STATUS_FILTERS; скрытые — никуда),
+# фильтр 'all' — сумма обеих. Ведутся триггерами на books, строки с count = 0 не показываются.
+FACET_BUCKETS = {'available': ('available',), 'held': ('held',), 'all': ('available', 'held')}
+
+def _facet_bucket(b):
+    return f"(CASE WHEN {b}.current_holder_id IS NOT NULL THEN 'held' WHEN {b}.status = 'available' THEN 'available' END)"
+
+def _split_tags(b):
+    """Теги книги как json_each: строка tags («a, b») превращается в JSON-массив.
+    json_quote экранирует кавычки и переводы строк, запятых в экранировании не бывает."""
+    return f"""json_each('[' || replace(json_quote(coalesce({b}.tags, '')), ',', '","') || ']')"""
+
+def _tag_key_sql(expr):
+    """Ключ тега в SQL, как tag_key(): теги в books.tags уже в нижнем регистре (normalize_tags)."""
+    return f"replace(lower(trim({expr})), 'ё', 'е')"
+
+def _facet_rows(b):
+    """SELECT (facet, value, bucket) для книги b — по строке на жанр, рейтинг и каждый тег."""
+    bucket = _facet_bucket(b)
+    return f"""
+        SELECT 'genre', {b}.genre, {bucket} WHERE coalesce({b}.genre, '') != ''
+        UNION SELECT 'age', {b}.age_rating, {bucket} WHERE coalesce({b}.age_rating, '') != ''
+        UNION SELECT 'tag', {_tag_key_sql("value")}, {bucket} FROM {_split_tags(b)} WHERE trim(value) != ''
+    """
+
+def _facet_add(b, delta):
+    return f"""
+        INSERT INTO book_facets (facet, value, bucket, count)
+        SELECT f.*, {delta} FROM ({_facet_rows(b)}) f WHERE {_facet_bucket(b)} IS NOT NULL
+        ON CONFLICT (facet, bucket, value) DO UPDATE SET count = count + {delta};
+    """
+
+FACET_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS book_facets (
+        facet TEXT, value TEXT, bucket TEXT, count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (facet, bucket, value)
+    ) WITHOUT ROWID""",
+    f"""CREATE TRIGGER IF NOT EXISTS book_facets_ai AFTER INSERT ON books BEGIN
+        {_facet_add("new", 1)}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS book_facets_ad AFTER DELETE ON books BEGIN
+        {_facet_add("old", -1)}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS book_facets_au AFTER UPDATE OF genre, age_rating, tags, status, current_holder_id ON books
+    WHEN old.genre IS NOT new.genre OR old.age_rating IS NOT new.age_rating OR old.tags IS NOT new.tags
+      OR {_facet_bucket("old")} IS NOT {_facet_bucket("new")} BEGIN
+        {_facet_add("old", -1)}
+        {_facet_add("new", 1)}
+    END""",
+]
+# Теги книг по одному в строке: tag — ключ tag_key() (нижний регистр, «ё» -> «е»).
+# Первичный ключ (tag, book_id) — индекс для точного поиска и подсказок по префиксу.
+# Синхронизируется триггерами на books.tags, поэтому его видят все способы записи книг.
+# lower() в SQLite не понимает кириллицу, поэтому books.tags всегда хранится в виде normalize_tags():
+# его приводят add_book, update_book_info и init_db (для старых записей и вставленных мимо них).
+def _book_tags_insert(b):
+    return f"""
+        INSERT OR IGNORE INTO book_tags (tag, book_id)
+        SELECT {_tag_key_sql("j.value")}, {b}.id FROM {_split_tags(b)} j WHERE trim(j.value) != '';
+    """
+
+TAGS_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS book_tags (
+        tag TEXT, book_id INTEGER,
+        PRIMARY KEY (tag, book_id)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_book_tags_book ON book_tags (book_id)",
+    f"""CREATE TRIGGER IF NOT EXISTS book_tags_ai AFTER INSERT ON books BEGIN
+        {_book_tags_insert("new")}
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_tags_ad AFTER DELETE ON books BEGIN
+        DELETE FROM book_tags WHERE book_id = old.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS book_tags_au AFTER UPDATE OF tags ON books WHEN old.tags IS NOT new.tags BEGIN
+        DELETE FROM book_tags WHERE book_id = old.id;
+        {_book_tags_insert("new")}
+    END""",
+]
+
+BOOK_TAGS_FROM_SCRATCH = f"""
+    SELECT {_tag_key_sql("j.value")}, b.id FROM books b, {_split_tags("b")} j WHERE trim(j.value) != ''
+"""
+
+def normalize_tags(text):
+    """Теги из ввода пользователя в вид books.tags: «Космос,  Тёмное фэнтези, космос» -> «космос, тёмное фэнтези»."""
+    tags = {}
+    for t in (text or "").split(","):
+        t = " ".join(t.lower().split())
+        if t: tags.setdefault(tag_key(t), t)
+    return ", ".join(tags.values())
+
+def tag_key(tag):
+    """Ключ тега в book_tags: как в триггерах — нижний регистр, «ё» -> «е», одиночные пробелы."""
+    return " ".join(tag.lower().split()).replace("ё", "е")
+
+FACETS_FROM_SCRATCH = f"""
+    SELECT facet, value, bucket, COUNT(*) FROM (
+        SELECT b.id, 'genre' AS facet, b.genre AS value, {_facet_bucket("b")} AS bucket FROM books b WHERE coalesce(b.genre, '') != ''
+        UNION SELECT b.id, 'age', b.age_rating, {_facet_bucket("b")} FROM books b WHERE coalesce(b.age_rating, '') != ''
+        UNION SELECT b.id, 'tag', {_tag_key_sql("j.value")}, {_facet_bucket("b")} FROM books b, {_split_tags("b")} j WHERE trim(j.value) != ''
+    ) WHERE bucket IS NOT NULL GROUP BY facet, bucket, value
+"""
+
+def fts_query(text):
+    """Превращает пользовательский ввод в запрос FTS5: все слова, с поиском по префиксу."""
+    words = re.findall(r"\w+", text.replace("ё", "е").replace("Ё", "Е"))
+    return " ".join(f'"{w}"*' for w in words)
+
+INDEXES = [
+    ("idx_users_status", "users", "status"),
+    ("idx_users_district", "users", "district"),
+    ("idx_books_owner", "books", "owner_id"),
+    ("idx_books_holder", "books", "current_holder_id"),
+    ("idx_books_status_genre", "books", "status, genre"),
+    ("idx_books_status_age", "books", "status, age_rating"),
+    ("idx_waitlist_book_created", "waitlist", "book_id, created_at"),
+    ("idx_bookings_book_renter", "bookings", "book_id, renter_id, status"),
+    ("idx_bookings_renter_status", "bookings", "renter_id, status"),
+    ("idx_bookings_status", "bookings", "status"),
+    ("idx_movements_book_created", "movements", "book_id, created_at"),
+    ("idx_movements_event_book", "movements", "event_type, book_id"),
+    ("idx_movements_event_to", "movements", "event_type, to_user_id"),
+    ("idx_movements_created", "movements", "created_at"),
+    ("idx_movements_archive_book", "movements_archive", "book_id, created_at"),
+    ("idx_reviews_book_created", "reviews", "book_id, created_at"),
+    ("idx_admin_logs_created", "admin_logs", "created_at"),
+    ("idx_admin_logs_admin", "admin_logs", "admin_id, id"),
+    ("idx_admin_logs_action", "admin_logs", "action_type, id"),
+    ("idx_outbox_next", "outbox", "next_attempt_at"),
+    ("idx_fsm_updated", "fsm_storage", "updated_at"),
+]
+
+_outbox_event = None
+
+def outbox_event():
+    """Событие «в outbox есть новые сообщения» — будит фоновый отправитель."""
+    global _outbox_event
+    if _outbox_event is None: _outbox_event = asyncio.Event()
+    return _outbox_event
+
+async def _add_outbox(db, outbox):
+    """Уведомления пишутся в той же транзакции, что и изменение состояния, поэтому
+    не теряются при сбое. Отправитель будится после коммита (см. ConnectionPool.write)."""
+    for chat_id, text, options in outbox:
+        await db.execute("INSERT INTO outbox (chat_id, text, options) VALUES (?, ?, ?)", (chat_id, text, options))
+    db.outbox_rows += len(outbox)
+
+async def close_db():
+    await pool.close()
 
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
+    await pool.open()
+    async with pool.write() as db:
         # Таблица пользователей
         await db.execute("""
             CREATE TABLE IF NOT EXISTS users (
@@ -20,10 +533,16 @@ async def init_db():
         """)
         
         # Добавляем колонки если их нет (для миграции)
-        for col, col_type in [("real_name", "TEXT"), ("district", "TEXT"), ("street", "TEXT"), ("status", "TEXT DEFAULT 'pending'"), ("is_admin", "INTEGER DEFAULT 0")]:
+        for col, col_type in [("real_name", "TEXT"), ("district", "TEXT"), ("street", "TEXT"), ("status", "TEXT DEFAULT 'pending'"), ("is_admin", "INTEGER DEFAULT 0"), ("search_name", "TEXT")]:
             try:
                 await db.execute(f"ALTER TABLE users ADD COLUMN {col} {col_type}")
             except: pass
+        # search_name для поиска в админке; заполняем у старых записей (и вставленных мимо add_user)
+        async with db.execute("SELECT user_id, real_name, full_name, username FROM users WHERE search_name IS NULL") as cursor:
+            rows = await cursor.fetchall()
+        if rows:
+            await db.executemany("UPDATE users SET search_name = ? WHERE user_id = ?",
+                                 [(user_search_name(r['real_name'], r['full_name'], r['username']), r['user_id']) for r in rows])
 
         # Таблица книг
         await db.execute("""
@@ -84,6 +603,33 @@ async def init_db():
             )
         """)
         
+        # Архив истории (см. archive_movements) и закрытых бронирований (archive_bookings).
+        # movements_all — вся история: и свежая, и архивная
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS movements_archive (
+                id INTEGER PRIMARY KEY, -- id из movements
+                book_id INTEGER,
+                from_user_id INTEGER,
+                to_user_id INTEGER,
+                event_type TEXT,
+                created_at TIMESTAMP
+            )
+        """)
+        await db.execute("""
+            CREATE VIEW IF NOT EXISTS movements_all AS
+            SELECT id, book_id, from_user_id, to_user_id, event_type, created_at FROM movements
+            UNION ALL
+            SELECT id, book_id, from_user_id, to_user_id, event_type, created_at FROM movements_archive
+        """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS bookings_archive (
+                id INTEGER PRIMARY KEY, -- id из bookings
+                book_id INTEGER,
+                renter_id INTEGER,
+                status TEXT
+            )
+        """)
+        
         # Таблица отзывов
         await db.execute("""
             CREATE TABLE IF NOT EXISTS reviews (
@@ -107,140 +653,370 @@ async def init_db():
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
-        await db.commit()
+
+        # Архив журнала админов (см. archive_admin_logs): без вторичных индексов, время — unix
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS admin_logs_archive (
+                id INTEGER PRIMARY KEY, -- id из admin_logs
+                admin_id INTEGER,
+                action_type TEXT,
+                details TEXT,
+                created_at INTEGER
+            )
+        """)
+
+        # Исходящие уведомления (outbox), их отправляет фоновый воркер
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER,
+                text TEXT,
+                options TEXT, -- JSON: parse_mode, reply_markup
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Кэш ответов внешних API по ISBN (data = NULL — книга не найдена)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS isbn_cache (
+                isbn TEXT PRIMARY KEY,
+                data TEXT,
+                expires_at INTEGER
+            )
+        """)
+
+        # Состояния диалогов FSM (см. storage.py); data — JSON
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_storage (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                updated_at REAL
+            )
+        """)
+
+        # Фасеты каталога; при первом создании и при смене триггеров (CREATE ... IF NOT EXISTS
+        # старые не заменит) пересоздаем и считаем по существующим книгам
+        async with db.execute("SELECT name, sql FROM sqlite_master WHERE name LIKE 'book_facets%'") as cursor:
+            stored = {row['name']: row['sql'] for row in await cursor.fetchall()}
+        triggers = {stmt.split()[5]: stmt.replace(" IF NOT EXISTS", "", 1) for stmt in FACET_SCHEMA if stmt.startswith("CREATE TRIGGER")}
+        facets_current = 'book_facets' in stored and all(stored.get(name) == sql for name, sql in triggers.items())
+        if not facets_current:
+            for name in triggers:
+                await db.execute(f"DROP TRIGGER IF EXISTS {name}")
+            await db.execute("DROP TABLE IF EXISTS book_facets")
+        for stmt in FACET_SCHEMA:
+            await db.execute(stmt)
+        if not facets_current:
+            await db.execute(f"INSERT INTO book_facets (facet, value, bucket, count) {FACETS_FROM_SCRATCH}")
+
+        # Теги в виде normalize_tags() у старых книг (и вставленных мимо add_book); изменения
+        # разносят триггеры на books.tags
+        async with db.execute("SELECT id, tags FROM books WHERE coalesce(tags, '') != ''") as cursor:
+            rows = await cursor.fetchall()
+        changed = [(normalize_tags(r['tags']), r['id']) for r in rows if normalize_tags(r['tags']) != r['tags']]
+        if changed:
+            await db.executemany("UPDATE books SET tags = ? WHERE id = ?", changed)
+
+        # Теги книг; при первом создании раскладываем теги существующих книг
+        async with db.execute("SELECT 1 FROM sqlite_master WHERE name = 'book_tags'") as cursor:
+            tags_exist = await cursor.fetchone()
+        for stmt in TAGS_SCHEMA:
+            await db.execute(stmt)
+        if not tags_exist:
+            await db.execute(f"INSERT OR IGNORE INTO book_tags (tag, book_id) {BOOK_TAGS_FROM_SCRATCH}")
+
+        # Статистика; при первом создании заполняем счетчики по существующим данным
+        async with db.execute("SELECT 1 FROM sqlite_master WHERE name = 'stats_counters'") as cursor:
+            stats_exist = await cursor.fetchone()
+        for stmt in STATS_SCHEMA:
+            await db.execute(stmt)
+        if not stats_exist:
+            await _rebuild_stats(db)
+
+        # Полнотекстовый поиск; при первом создании заполняем индекс существующими книгами
+        async with db.execute("SELECT 1 FROM sqlite_master WHERE name = 'books_fts'") as cursor:
+            fts_exists = await cursor.fetchone()
+        for stmt in FTS_SCHEMA:
+            await db.execute(stmt)
+        if not fts_exists:
+            await db.execute(f"INSERT INTO books_fts (rowid, {', '.join(FTS_COLUMNS)}) SELECT id, {_fts_values('books')} FROM books")
+
+        # Индексы под основные пути доступа (проверяются benchmarks/check_query_plans.py)
+        for name, table, cols in INDEXES:
+            await db.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({cols})")
+
+def user_search_name(real_name, full_name, username):
+    """Строка для поиска пользователя по подстроке: имена и ник в нижнем регистре, «ё» -> «е».
+    Считается в Python: lower() в SQLite не понимает кириллицу."""
+    return " ".join(dict.fromkeys(p for p in (real_name, full_name, username) if p)).lower().replace("ё", "е")
 
 async def add_user(user_id, username, full_name, status='pending'):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with pool.write() as db:
         await db.execute(
-            "INSERT OR IGNORE INTO users (user_id, username, full_name, status) VALUES (?, ?, ?, ?)",
-            (user_id, username, full_name, status)
+            "INSERT OR IGNORE INTO users (user_id, username, full_name, status, search_name) VALUES (?, ?, ?, ?, ?)",
+            (user_id, username, full_name, status, user_search_name(None, full_name, username))
         )
-        await db.commit()
+    user_cache.invalidate(user_id)
 
-async def update_user_profile(user_id, real_name, district, street):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE users SET real_name = ?, district = ?, street = ? WHERE user_id = ?",
+async def update_user_profile(user_id, real_name, district, street, outbox=()):
+    async with pool.write() as db:
+        async with db.execute(
+            "UPDATE users SET real_name = ?, district = ?, street = ? WHERE user_id = ? RETURNING full_name, username",
             (real_name, district, street, user_id)
-        )
-        await db.commit()
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row:
+            await db.execute("UPDATE users SET search_name = ? WHERE user_id = ?",
+                             (user_search_name(real_name, row['full_name'], row['username']), user_id))
+        await _add_outbox(db, outbox)
+    user_cache.invalidate(user_id)
 
-async def update_user_status(user_id, status):
-    async with aiosqlite.connect(DB_PATH) as db:
+async def update_user_status(user_id, status, outbox=()):
+    async with pool.write() as db:
         await db.execute("UPDATE users SET status = ? WHERE user_id = ?", (status, user_id))
-        await db.commit()
+        await _add_outbox(db, outbox)
+    user_cache.invalidate(user_id)
 
 async def set_admin_status(user_id, is_admin):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with pool.write() as db:
         await db.execute("UPDATE users SET is_admin = ? WHERE user_id = ?", (1 if is_admin else 0, user_id))
-        await db.commit()
+    user_cache.invalidate(user_id)
 
 async def get_user(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    user = user_cache.get(user_id)
+    if user is not MISSING: return user
+    version = user_cache.version
+    async with pool.acquire() as db:
         async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            return await cursor.fetchone()
+            user = await cursor.fetchone()
+    user_cache.put(user_id, user, version)
+    return user
 
 async def get_all_users():
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with pool.acquire() as db:
         async with db.execute("SELECT * FROM users") as cursor:
             return await cursor.fetchall()
 
+USER_STATUSES = ('pending', 'approved', 'blocked', 'rejected')
+
+def _like_escape(text):
+    """Экранирует % и _ для LIKE ... ESCAPE '\\': ввод ищется как есть, а не как шаблон."""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+async def search_users(status=None, district=None, name=None, after=None, before=None, limit=None):
+    """Страница справочника пользователей для админки.
+
+    Фильтры: статус, район (точное совпадение), подстрока имени или ника.
+    Keyset-пагинация по user_id: after/before — user_id последнего пользователя
+    предыдущей страницы или первого следующей, как в get_all_books."""
+    query, params = "SELECT * FROM users WHERE 1=1", []
+    if status:
+        query += " AND status = ?"; params.append(status)
+    if district:
+        query += " AND district = ?"; params.append(district)
+    if name:
+        query += " AND search_name LIKE ? ESCAPE '\\'"; params.append(f"%{_like_escape(user_search_name(name.lstrip('@'), None, None))}%")
+    query = _keyset(query, params, ("user_id",), None if after is None else (after,), None if before is None else (before,), limit)
+    return await _fetch_page(query, params, before)
+
+async def count_users_by_status():
+    async with pool.acquire() as db:
+        async with db.execute("SELECT status, COUNT(*) FROM users GROUP BY status") as cursor:
+            return {row[0]: row[1] for row in await cursor.fetchall()}
+
+async def get_user_districts(limit=20):
+    """Самые частые районы пользователей: [(район, число)]."""
+    async with pool.acquire() as db:
+        async with db.execute("""
+            SELECT district, COUNT(*) FROM users WHERE district IS NOT NULL AND district != ''
+            GROUP BY district ORDER BY COUNT(*) DESC, district LIMIT ?
+        """, (limit,)) as cursor:
+            return [(row[0], row[1]) for row in await cursor.fetchall()]
+
 async def log_admin_action(admin_id, action_type, details):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with pool.write() as db:
         await db.execute(
             "INSERT INTO admin_logs (admin_id, action_type, details) VALUES (?, ?, ?)",
             (admin_id, action_type, details)
         )
-        await db.commit()
 
-async def get_admin_logs(limit=50):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM admin_logs ORDER BY created_at DESC LIMIT ?", (limit,)) as cursor:
-            return await cursor.fetchall()
+async def get_admin_logs(admin_id=None, action_type=None, after=None, before=None, limit=50):
+    """Страница журнала админов, новые записи первыми.
+
+    Keyset-пагинация по id: after — id последней записи текущей страницы
+    (следующая страница, более старые записи), before — id первой (предыдущая, более новые)."""
+    query, params = "SELECT * FROM admin_logs WHERE 1=1", []
+    if admin_id is not None:
+        query += " AND admin_id = ?"; params.append(admin_id)
+    if action_type:
+        query += " AND action_type = ?"; params.append(action_type)
+    if after is not None:
+        query += " AND id < ?"; params.append(after)
+    elif before is not None:
+        query += " AND id > ?"; params.append(before)
+    query += " ORDER BY id" + ("" if before is not None else " DESC") + " LIMIT ?"
+    params.append(limit)
+    return await _fetch_page(query, params, before)
+
+async def _archive_batches(copy_sql, delete_sql, params, batch):
+    """Копирует пачку строк в архив и удаляет ее из основной таблицы, пока пачки полные.
+    Оба запроса выбирают строки одним подзапросом в одной транзакции, т.е. одни и те же."""
+    moved = 0
+    while True:
+        async with pool.write() as db:
+            n = (await db.execute(copy_sql, params)).rowcount
+            if n: await db.execute(delete_sql, params)
+        moved += n
+        if n < batch: return moved
+
+async def archive_admin_logs(days, batch=500):
+    """Переносит записи журнала старше days дней в admin_logs_archive.
+
+    Пачками по batch строк, каждая — отдельный блок записи, чтобы перенос
+    большого хвоста не задерживал изменения из хендлеров. Возвращает число перенесенных."""
+    old = "SELECT id FROM admin_logs WHERE created_at < datetime('now', ?) ORDER BY created_at, id LIMIT ?"
+    return await _archive_batches(f"""
+        INSERT INTO admin_logs_archive (id, admin_id, action_type, details, created_at)
+        SELECT id, admin_id, action_type, details, CAST(strftime('%s', created_at) AS INTEGER)
+        FROM admin_logs WHERE id IN ({old})
+    """, f"DELETE FROM admin_logs WHERE id IN ({old})", (f"-{days} days", batch), batch)
 
 async def add_book(owner_id, title, author, genre, tags, age_rating, description, photo_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with pool.write() as db:
         await db.execute("""
             INSERT INTO books (owner_id, title, author, genre, tags, age_rating, description, photo_id)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (owner_id, title, author, genre, tags, age_rating, description, photo_id))
-        await db.commit()
+        """, (owner_id, title, author, genre, normalize_tags(tags), age_rating, description, photo_id))
 
-async def get_all_books(status_filter='available'):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        query = """
-            SELECT b.*, u.username as owner_username, u.full_name as owner_name,
-                   h.username as holder_username, h.full_name as holder_name
-            FROM books b
-            JOIN users u ON b.owner_id = u.user_id
-            LEFT JOIN users h ON b.current_holder_id = h.user_id
-            WHERE 1=1
-        """
-        if status_filter == 'available':
-            query += " AND b.status = 'available' AND b.current_holder_id IS NULL"
-        elif status_filter == 'held':
-            query += " AND b.current_holder_id IS NOT NULL"
-        elif status_filter == 'all':
-            query += " AND (b.status = 'available' OR b.current_holder_id IS NOT NULL)"
-
-        async with db.execute(query) as cursor:
-            return await cursor.fetchall()
+BOOK_SELECT = """
+    SELECT b.*, u.username as owner_username, u.full_name as owner_name,
+           h.username as holder_username, h.full_name as holder_name{extra}
+    FROM books b
+    JOIN users u ON b.owner_id = u.user_id
+    LEFT JOIN users h ON b.current_holder_id = h.user_id{join}
+    WHERE 1=1
+"""
 
-async def search_books(genre=None, tag=None, age_rating=None, text_query=None, status_filter='all'):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        query = """
-            SELECT b.*, u.username as owner_username, u.full_name as owner_name,
-                   h.username as holder_username, h.full_name as holder_name
-            FROM books b
-            JOIN users u ON b.owner_id = u.user_id
-            LEFT JOIN users h ON b.current_holder_id = h.user_id
-            WHERE 1=1
-        """
-        params = []
-        
-        if status_filter == 'available':
-            query += " AND b.status = 'available' AND b.current_holder_id IS NULL"
-        elif status_filter == 'held':
-            query += " AND b.current_holder_id IS NOT NULL"
-        elif status_filter == 'all':
-            query += " AND (b.status = 'available' OR b.current_holder_id IS NOT NULL)"
-
-        if genre:
-            query += " AND b.genre LIKE ?"
-            params.append(f"%{genre}%")
-        if tag:
-            query += " AND b.tags LIKE ?"
-            params.append(f"%{tag}%")
-        if age_rating:
-            query += " AND b.age_rating = ?"
-            params.append(age_rating)
-        if text_query:
-            query += " AND (b.title LIKE ? OR b.author LIKE ? OR b.description LIKE ?)"
-            params.extend([f"%{text_query}%", f"%{text_query}%", f"%{text_query}%"])
-            
+STATUS_FILTERS = {
+    'available': " AND b.status = 'available' AND b.current_holder_id IS NULL",
+    'held': " AND b.current_holder_id IS NOT NULL",
+    'all': " AND (b.status = 'available' OR b.current_holder_id IS NOT NULL)",
+}
+
+def _keyset(query, params, key, after=None, before=None, limit=None):
+    """Дописывает к запросу keyset-пагинацию по выражениям key.
+
+    after/before — курсор (значения key) последней книги предыдущей страницы
+    или первой книги следующей. Строки всегда возвращаются в прямом порядке.
+    """
+    cols, marks = ", ".join(key), ", ".join("?" * len(key))
+    if after is not None:
+        query += f" AND ({cols}) > ({marks})"; params.extend(after)
+    elif before is not None:
+        query += f" AND ({cols}) < ({marks})"; params.extend(before)
+    direction = " DESC" if before is not None else ""
+    query += " ORDER BY " + ", ".join(k + direction for k in key)
+    if limit:
+        query += " LIMIT ?"; params.append(limit)
+    return query
+
+def book_cursor(book):
+    """Курсор книги для after/before: (bm25, id) для текстового поиска, иначе (id,)."""
+    return (book['score'], book['id']) if 'score' in book.keys() else (book['id'],)
+
+async def _fetch_page(query, params, before):
+    async with pool.acquire() as db:
         async with db.execute(query, tuple(params)) as cursor:
-            return await cursor.fetchall()
+            rows = await cursor.fetchall()
+    return rows[::-1] if before is not None else rows
+
+async def get_all_books(status_filter='available', after=None, before=None, limit=None):
+    query = BOOK_SELECT.format(extra="", join="") + STATUS_FILTERS.get(status_filter, "")
+    params = []
+    query = _keyset(query, params, ("b.id",), after, before, limit)
+    return await _fetch_page(query, params, before)
+
+async def search_books(genre=None, tag=None, age_rating=None, text_query=None, status_filter='all',
+                       after=None, before=None, limit=None):
+    key, extra, join = ("b.id",), "", ""
+    if text_query:
+        # Полнотекстовый поиск через FTS5 с ранжированием по bm25
+        match = fts_query(text_query)
+        if not match: return []
+        rank = f"bm25(books_fts, {FTS_WEIGHTS})"
+        extra, join = f", {rank} as score", "\n    JOIN books_fts ON books_fts.rowid = b.id"
+        key = (rank, "b.id")
+    if tag:
+        # Точное совпадение тега через индекс book_tags; без текста листаем в порядке этого индекса
+        join += "\n    JOIN book_tags t ON t.book_id = b.id"
+        if not text_query: key = ("t.book_id",)
+    query = BOOK_SELECT.format(extra=extra, join=join)
+    query += STATUS_FILTERS.get(status_filter, "")
+    params = []
+
+    if genre:
+        # Точное совпадение: значения приходят из меню жанров (get_facet_counts)
+        query += " AND b.genre = ?"
+        params.append(genre)
+    if tag:
+        query += " AND t.tag = ?"
+        params.append(tag_key(tag))
+    if age_rating:
+        query += " AND b.age_rating = ?"
+        params.append(age_rating)
+    if text_query:
+        query += " AND books_fts MATCH ?"
+        params.append(match)
+
+    query = _keyset(query, params, key, after, before, limit)
+    return await _fetch_page(query, params, before)
+
+async def get_facet_counts(facet, status_filter='all', limit=None):
+    """Значения фасета ('genre', 'age' или 'tag') с числом книг для фильтра статуса:
+    список (значение, число), самые частые первыми. Читает только book_facets."""
+    buckets = FACET_BUCKETS[status_filter]
+    query = f"""
+        SELECT value, SUM(count) AS n FROM book_facets
+        WHERE facet = ? AND bucket IN ({", ".join("?" * len(buckets))})
+        GROUP BY value HAVING n > 0 ORDER BY n DESC, value
+    """
+    params = [facet, *buckets]
+    if limit:
+        query += " LIMIT ?"; params.append(limit)
+    async with pool.acquire() as db:
+        async with db.execute(query, params) as cursor:
+            return [(row['value'], row['n']) for row in await cursor.fetchall()]
+
+async def suggest_tags(prefix, limit=10):
+    """Существующие теги (ключи tag_key), начинающиеся с prefix, по алфавиту.
+    Каждый следующий тег — один поиск по первичному ключу book_tags после предыдущего,
+    поэтому число книг с тегом на время не влияет."""
+    start = tag_key(prefix)
+    if not start: return []
+    query = """
+        WITH RECURSIVE found(tag, n) AS (
+            SELECT (SELECT min(tag) FROM book_tags WHERE tag >= ?1 AND tag < ?2), 1
+            UNION ALL
+            SELECT (SELECT min(tag) FROM book_tags WHERE tag > found.tag AND tag < ?2), n + 1
+            FROM found WHERE found.tag IS NOT NULL AND n < ?3
+        )
+        SELECT tag FROM found WHERE tag IS NOT NULL
+    """
+    async with pool.acquire() as db:
+        async with db.execute(query, (start, start + chr(0x10FFFF), limit)) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
 
 async def get_unique_genres():
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT DISTINCT genre FROM books WHERE genre IS NOT NULL AND status = 'available'") as cursor:
-            rows = await cursor.fetchall()
-            return [row[0] for row in rows if row[0]]
+    return [g for g, _ in await get_facet_counts('genre', 'available')]
 
 async def get_unique_age_ratings():
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT DISTINCT age_rating FROM books WHERE age_rating IS NOT NULL AND status = 'available'") as cursor:
-            rows = await cursor.fetchall()
-            return [row[0] for row in rows if row[0]]
+    return [a for a, _ in await get_facet_counts('age', 'available')]
 
 async def get_book(book_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with pool.acquire() as db:
         query = """
             SELECT b.*, u.username as owner_username, u.full_name as owner_name,
                    h.username as holder_username, h.full_name as holder_name
@@ -252,62 +1028,123 @@ async def get_book(book_id):
         async with db.execute(query, (book_id,)) as cursor:
             return await cursor.fetchone()
 
-async def confirm_transfer(book_id, holder_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Получаем владельца и текущего держателя
-        async with db.execute("SELECT owner_id, current_holder_id FROM books WHERE id = ?", (book_id,)) as cursor:
+async def confirm_transfer(book_id, holder_id, from_id, outbox=()):
+    """Передача книги от from_id (владельца, если книга у него, или текущего читателя) к holder_id.
+
+    Проверка и изменение — одним условным UPDATE в одной транзакции с историей,
+    бронированием и очередью, поэтому из двух одновременных нажатий срабатывает одно.
+    Возвращает owner_id или None, если книга уже не у from_id (уведомления тогда не пишутся)."""
+    async with pool.write() as db:
+        async with db.execute("""
+            UPDATE books SET current_holder_id = ?, status = 'unavailable'
+            WHERE id = ? AND coalesce(current_holder_id, owner_id) = ? AND ? != ?
+            RETURNING owner_id
+        """, (holder_id, book_id, from_id, holder_id, from_id)) as cursor:
             row = await cursor.fetchone()
-            if not row: return None
-            owner_id, old_holder_id = row
-            
-        from_id = old_holder_id if old_holder_id else owner_id
-        
-        await db.execute("UPDATE books SET current_holder_id = ?, status = 'unavailable' WHERE id = ?", (holder_id, book_id))
+        if not row: return None
         # Записываем историю: от текущего держателя к новому читателю
         await db.execute("INSERT INTO movements (book_id, from_user_id, to_user_id, event_type) VALUES (?, ?, ?, 'transfer')", (book_id, from_id, holder_id))
-        # Обновляем статус бронирования на 'completed' (если оно было)
+        # Обновляем статус бронирования на 'completed' (если оно было) и выводим читателя из очереди
         await db.execute("UPDATE bookings SET status = 'completed' WHERE book_id = ? AND renter_id = ? AND status = 'pending'", (book_id, holder_id))
-        await db.commit()
-        return owner_id
-
-async def reject_booking(book_id, renter_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE bookings SET status = 'rejected' WHERE book_id = ? AND renter_id = ? AND status = 'pending'", (book_id, renter_id))
-        await db.commit()
-
-async def return_book(book_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Получаем текущего холдера и владельца для истории
-        async with db.execute("SELECT owner_id, current_holder_id FROM books WHERE id = ?", (book_id,)) as cursor:
+        await db.execute("DELETE FROM waitlist WHERE book_id = ? AND user_id = ?", (book_id, holder_id))
+        await _add_outbox(db, outbox)
+        return row['owner_id']
+
+async def reject_booking(book_id, renter_id, outbox=()):
+    """False, если ожидающей заявки уже нет (повторное нажатие)."""
+    async with pool.write() as db:
+        cursor = await db.execute("UPDATE bookings SET status = 'rejected' WHERE book_id = ? AND renter_id = ? AND status = 'pending'", (book_id, renter_id))
+        if not cursor.rowcount: return False
+        await _add_outbox(db, outbox)
+        return True
+
+async def return_book(book_id, owner_id, holder_id=None, outbox=()):
+    """Возврат книги владельцу от holder_id (None — от любого текущего читателя).
+    Как и confirm_transfer, срабатывает один раз: возвращает id читателя, вернувшего
+    книгу, или None, если книга уже у владельца или у другого читателя."""
+    async with pool.write() as db:
+        # История пишется первой: INSERT ... SELECT видит держателя до UPDATE
+        async with db.execute("""
+            INSERT INTO movements (book_id, from_user_id, to_user_id, event_type)
+            SELECT id, current_holder_id, owner_id, 'return' FROM books
+            WHERE id = ? AND owner_id = ? AND current_holder_id = coalesce(?, current_holder_id)
+            RETURNING from_user_id
+        """, (book_id, owner_id, holder_id)) as cursor:
             row = await cursor.fetchone()
-            if not row: return
-            owner_id, holder_id = row
-            
+        if not row: return None
         await db.execute("UPDATE books SET current_holder_id = NULL, status = 'available', return_requested = 0 WHERE id = ?", (book_id,))
-        # Записываем историю: от читателя к владельцу
-        if holder_id:
-            await db.execute("INSERT INTO movements (book_id, from_user_id, to_user_id, event_type) VALUES (?, ?, ?, 'return')", (book_id, holder_id, owner_id))
-        await db.commit()
+        await _add_outbox(db, outbox)
+        return row['from_user_id']
 
 async def get_book_history(book_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    """Вся история книги: свежие записи movements вместе с перенесенными в архив."""
+    async with pool.acquire() as db:
         query = """
             SELECT m.*, 
                    u_from.full_name as from_name, u_from.username as from_username,
                    u_to.full_name as to_name, u_to.username as to_username
-            FROM movements m
+            FROM movements_all m
             LEFT JOIN users u_from ON m.from_user_id = u_from.user_id
             LEFT JOIN users u_to ON m.to_user_id = u_to.user_id
             WHERE m.book_id = ?
-            ORDER BY m.created_at ASC
+            ORDER BY m.created_at ASC, m.id ASC
         """
         async with db.execute(query, (book_id,)) as cursor:
             return await cursor.fetchall()
 
+async def archive_movements(days, batch=500):
+    """Переносит историю старше days дней в movements_archive (пачками, как archive_admin_logs).
+    get_book_history и подсчет статистики с нуля читают обе таблицы через movements_all."""
+    old = "SELECT id FROM movements WHERE created_at < datetime('now', ?) ORDER BY created_at, id LIMIT ?"
+    return await _archive_batches(f"""
+        INSERT INTO movements_archive (id, book_id, from_user_id, to_user_id, event_type, created_at)
+        SELECT id, book_id, from_user_id, to_user_id, event_type, created_at FROM movements WHERE id IN ({old})
+    """, f"DELETE FROM movements WHERE id IN ({old})", (f"-{days} days", batch), batch)
+
+async def archive_bookings(batch=500):
+    """Переносит завершенные и отклоненные бронирования в bookings_archive:
+    бот читает только ожидающие (status = 'pending')."""
+    old = "SELECT id FROM bookings WHERE status IN ('completed', 'rejected') ORDER BY id LIMIT ?"
+    return await _archive_batches(f"""
+        INSERT INTO bookings_archive (id, book_id, renter_id, status)
+        SELECT id, book_id, renter_id, status FROM bookings WHERE id IN ({old})
+    """, f"DELETE FROM bookings WHERE id IN ({old})", (batch,), batch)
+
+async def get_db_space():
+    """Размер базы и свободных (после удалений) страниц в ней, в байтах."""
+    values = {}
+    async with pool.acquire() as db:
+        for name in ("page_size", "page_count", "freelist_count", "auto_vacuum"):
+            async with db.execute(f"PRAGMA {name}") as cursor:
+                values[name] = (await cursor.fetchone())[0]
+    return {
+        'size': values['page_count'] * values['page_size'],
+        'free': values['freelist_count'] * values['page_size'],
+        'page_size': values['page_size'],
+        'incremental': values['auto_vacuum'] == 2,  # 2 — auto_vacuum = INCREMENTAL
+    }
+
+async def incremental_vacuum(batch=256):
+    """Возвращает свободные страницы файлу базы пачками по batch страниц
+    (каждая — отдельный блок записи). Возвращает освобожденные байты.
+
+    Работает только при auto_vacuum = INCREMENTAL; существующую базу переводит
+    разовый PRAGMA auto_vacuum = INCREMENTAL; VACUUM при остановленном боте."""
+    space = await get_db_space()
+    if not space['incremental']: return 0
+    freed = 0
+    while True:
+        async with pool.write() as db:
+            async with db.execute("PRAGMA freelist_count") as cursor:
+                n = min((await cursor.fetchone())[0], batch)
+            # sqlite3 делает один шаг запроса на execute(), а шаг incremental_vacuum
+            # освобождает одну страницу; executemany — n шагов за один вызов
+            if n: await db.executemany("PRAGMA incremental_vacuum", [()] * n)
+        freed += n
+        if n < batch: return freed * space['page_size']
+
 async def get_books_on_shelf(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with pool.acquire() as db:
         query = """
             SELECT b.*, u.username as owner_username, u.full_name as owner_name
             FROM books b
@@ -317,17 +1154,16 @@ async def get_books_on_shelf(user_id):
         async with db.execute(query, (user_id,)) as cursor:
             return await cursor.fetchall()
 
-async def add_to_waitlist(book_id, user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+async def add_to_waitlist(book_id, user_id, outbox=()):
+    async with pool.write() as db:
         async with db.execute("SELECT id FROM waitlist WHERE book_id = ? AND user_id = ?", (book_id, user_id)) as cursor:
             if await cursor.fetchone(): return False
         await db.execute("INSERT INTO waitlist (book_id, user_id) VALUES (?, ?)", (book_id, user_id))
-        await db.commit()
+        await _add_outbox(db, outbox)
         return True
 
 async def get_waitlist(book_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with pool.acquire() as db:
         query = """
             SELECT w.*, u.username, u.full_name
             FROM waitlist w
@@ -338,19 +1174,34 @@ async def get_waitlist(book_id):
         async with db.execute(query, (book_id,)) as cursor:
             return await cursor.fetchall()
 
-async def remove_from_waitlist(book_id, user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+async def get_waitlists(book_ids):
+    """Очереди сразу для нескольких книг одним запросом: {book_id: [строки очереди]}."""
+    waitlists = {bid: [] for bid in book_ids}
+    if not waitlists: return waitlists
+    async with pool.acquire() as db:
+        query = f"""
+            SELECT w.*, u.username, u.full_name
+            FROM waitlist w
+            JOIN users u ON w.user_id = u.user_id
+            WHERE w.book_id IN ({", ".join("?" * len(waitlists))})
+            ORDER BY w.book_id, w.created_at ASC
+        """
+        async with db.execute(query, tuple(waitlists)) as cursor:
+            for row in await cursor.fetchall():
+                waitlists[row['book_id']].append(row)
+    return waitlists
+
+async def remove_from_waitlist(book_id, user_id, outbox=()):
+    async with pool.write() as db:
         await db.execute("DELETE FROM waitlist WHERE book_id = ? AND user_id = ?", (book_id, user_id))
-        await db.commit()
+        await _add_outbox(db, outbox)
 
 async def add_review(book_id, user_id, text):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with pool.write() as db:
         await db.execute("INSERT INTO reviews (book_id, user_id, text) VALUES (?, ?, ?)", (book_id, user_id, text))
-        await db.commit()
 
 async def get_book_reviews(book_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with pool.acquire() as db:
         query = """
             SELECT r.*, u.username, u.full_name
             FROM reviews r
@@ -362,24 +1213,21 @@ async def get_book_reviews(book_id):
             return await cursor.fetchall()
 
 async def delete_review(review_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with pool.write() as db:
         await db.execute("DELETE FROM reviews WHERE id = ?", (review_id,))
-        await db.commit()
 
-async def create_booking(book_id, renter_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+async def create_booking(book_id, renter_id, outbox=()):
+    async with pool.write() as db:
         await db.execute("INSERT INTO bookings (book_id, renter_id) VALUES (?, ?)", (book_id, renter_id))
-        await db.commit()
+        await _add_outbox(db, outbox)
 
 async def get_user_books(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with pool.acquire() as db:
         async with db.execute("SELECT * FROM books WHERE owner_id = ?", (user_id,)) as cursor:
             return await cursor.fetchall()
 
 async def get_user_bookings(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with pool.acquire() as db:
         async with db.execute("""
             SELECT b.id as booking_id, bk.title, bk.author, u.username as owner_username
             FROM bookings b
@@ -390,8 +1238,7 @@ async def get_user_bookings(user_id):
             return await cursor.fetchall()
 
 async def get_incoming_requests(owner_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with pool.acquire() as db:
         query = """
             SELECT b.id as booking_id, b.renter_id, bk.id as book_id, bk.title, u.username as renter_username, u.full_name as renter_name
             FROM bookings b
@@ -402,21 +1249,52 @@ async def get_incoming_requests(owner_id):
         async with db.execute(query, (owner_id,)) as cursor:
             return await cursor.fetchall()
 
+async def get_profile(user_id, book_id=None):
+    """Все для «Моего профиля» одним запросом: {'books': свои книги, 'shelf': книги на руках,
+    'requests': ожидающие заявки на свои книги}. У каждой книги — wait_count (длина очереди)
+    и первый в очереди (next_user_id, next_username, next_name); у заявок — renter_*.
+    С book_id — только строки этой книги (для перерисовки одной карточки)."""
+    only_book = " AND b.id = ?2" if book_id is not None else ""
+    async with pool.acquire() as db:
+        query = f"""
+            WITH items AS (
+                SELECT 'books' AS kind, b.*, NULL AS renter_id FROM books b WHERE b.owner_id = ?1{only_book}
+                UNION ALL
+                SELECT 'shelf', b.*, NULL FROM books b WHERE b.current_holder_id = ?1{only_book}
+                UNION ALL
+                SELECT 'requests', b.*, k.renter_id FROM bookings k JOIN books b ON k.book_id = b.id
+                WHERE b.owner_id = ?1 AND k.status = 'pending'{only_book}
+            )
+            SELECT items.*,
+                   (SELECT COUNT(*) FROM waitlist w WHERE w.book_id = items.id) AS wait_count,
+                   w.user_id AS next_user_id, nu.username AS next_username, nu.full_name AS next_name,
+                   ru.username AS renter_username, ru.full_name AS renter_name
+            FROM items
+            LEFT JOIN waitlist w ON w.id = (SELECT id FROM waitlist WHERE book_id = items.id ORDER BY created_at, id LIMIT 1)
+            LEFT JOIN users nu ON w.user_id = nu.user_id
+            LEFT JOIN users ru ON items.renter_id = ru.user_id
+            ORDER BY items.kind, items.id
+        """
+        profile = {'books': [], 'shelf': [], 'requests': []}
+        async with db.execute(query, (user_id,) if book_id is None else (user_id, book_id)) as cursor:
+            for row in await cursor.fetchall():
+                profile[row['kind']].append(row)
+        return profile
+
 async def delete_book(book_id, owner_id=None):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with pool.write() as db:
         if owner_id:
             await db.execute("DELETE FROM books WHERE id = ? AND owner_id = ?", (book_id, owner_id))
         else:
             await db.execute("DELETE FROM books WHERE id = ?", (book_id,))
-        await db.commit()
 
 async def update_book_status(book_id, owner_id, status):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with pool.write() as db:
         await db.execute("UPDATE books SET status = ? WHERE id = ? AND owner_id = ?", (status, book_id, owner_id))
-        await db.commit()
 
 async def update_book_info(book_id, title, author, genre, tags, age_rating, description, owner_id=None):
-    async with aiosqlite.connect(DB_PATH) as db:
+    tags = normalize_tags(tags)
+    async with pool.write() as db:
         if owner_id:
             await db.execute("""
                 UPDATE books SET title=?, author=?, genre=?, tags=?, age_rating=?, description=?
@@ -427,39 +1305,97 @@ async def update_book_info(book_id, title, author, genre, tags, age_rating, desc
                 UPDATE books SET title=?, author=?, genre=?, tags=?, age_rating=?, description=?
                 WHERE id=?
             """, (title, author, genre, tags, age_rating, description, book_id))
-        await db.commit()
 
-async def request_book_return(book_id, owner_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+async def request_book_return(book_id, owner_id, outbox=()):
+    async with pool.write() as db:
         await db.execute("UPDATE books SET return_requested = 1 WHERE id = ? AND owner_id = ?", (book_id, owner_id))
-        await db.commit()
+        await _add_outbox(db, outbox)
 
 async def cancel_return_request(book_id, owner_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with pool.write() as db:
         await db.execute("UPDATE books SET return_requested = 0 WHERE id = ? AND owner_id = ?", (book_id, owner_id))
-        await db.commit()
+
+# SQL «с нуля» для счетчиков статистики: используется для заполнения и проверки.
+# Передачи считаются вместе с архивом — счетчики при архивации не уменьшаются
+STATS_FROM_SCRATCH = {
+    'total_users': "SELECT COUNT(*) FROM users WHERE status = 'approved'",
+    'total_books': "SELECT COUNT(*) FROM books",
+    'total_transfers': "SELECT COUNT(*) FROM movements_all WHERE event_type = 'transfer'",
+}
+BOOK_COUNTS_FROM_SCRATCH = """
+    SELECT m.book_id, COUNT(*) FROM movements_all m JOIN books b ON m.book_id = b.id
+    WHERE m.event_type = 'transfer' GROUP BY m.book_id
+"""
+READER_COUNTS_FROM_SCRATCH = """
+    SELECT to_user_id, COUNT(*) FROM movements_all
+    WHERE event_type = 'transfer' AND to_user_id IS NOT NULL GROUP BY to_user_id
+"""
+
+async def _rebuild_stats(db):
+    await db.execute("DELETE FROM stats_counters")
+    for name, query in STATS_FROM_SCRATCH.items():
+        await db.execute(f"INSERT INTO stats_counters (name, value) SELECT ?, ({query})", (name,))
+    await db.execute("DELETE FROM book_transfer_counts")
+    await db.execute(f"INSERT INTO book_transfer_counts (book_id, count) {BOOK_COUNTS_FROM_SCRATCH}")
+    await db.execute("DELETE FROM reader_transfer_counts")
+    await db.execute(f"INSERT INTO reader_transfer_counts (user_id, count) {READER_COUNTS_FROM_SCRATCH}")
+    await db.execute("DELETE FROM book_facets")
+    await db.execute(f"INSERT INTO book_facets (facet, value, bucket, count) {FACETS_FROM_SCRATCH}")
+    await db.execute("DELETE FROM book_tags")
+    await db.execute(f"INSERT OR IGNORE INTO book_tags (tag, book_id) {BOOK_TAGS_FROM_SCRATCH}")
+
+async def rebuild_stats():
+    """Пересчитывает счетчики статистики, фасеты и индекс тегов по исходным таблицам."""
+    async with pool.write() as db:
+        await _rebuild_stats(db)
+
+async def verify_stats():
+    """Сверяет инкрементальные счетчики с подсчетом с нуля.
+    Возвращает {название: (счетчик, с нуля)} для расхождений; пустой словарь — все сходится."""
+    mismatches = {}
+    async with pool.acquire() as db:
+        async with db.execute("SELECT name, value FROM stats_counters") as c:
+            counters = {row['name']: row['value'] for row in await c.fetchall()}
+        for name, query in STATS_FROM_SCRATCH.items():
+            async with db.execute(query) as c:
+                expected = (await c.fetchone())[0]
+            if counters.get(name) != expected: mismatches[name] = (counters.get(name), expected)
+        for table, key, query in (("book_transfer_counts", "book_id", BOOK_COUNTS_FROM_SCRATCH),
+                                  ("reader_transfer_counts", "user_id", READER_COUNTS_FROM_SCRATCH)):
+            async with db.execute(f"SELECT {key}, count FROM {table} WHERE count > 0") as c:
+                actual = {row[0]: row[1] for row in await c.fetchall()}
+            async with db.execute(query) as c:
+                expected = {row[0]: row[1] for row in await c.fetchall()}
+            for k in actual.keys() | expected.keys():
+                if actual.get(k) != expected.get(k): mismatches[f"{table}[{k}]"] = (actual.get(k), expected.get(k))
+        async with db.execute("SELECT facet, value, bucket, count FROM book_facets WHERE count != 0") as c:
+            actual = {tuple(row[:3]): row[3] for row in await c.fetchall()}
+        async with db.execute(FACETS_FROM_SCRATCH) as c:
+            expected = {tuple(row[:3]): row[3] for row in await c.fetchall()}
+        for k in actual.keys() | expected.keys():
+            if actual.get(k) != expected.get(k): mismatches[f"book_facets[{', '.join(map(str, k))}]"] = (actual.get(k), expected.get(k))
+        async with db.execute("SELECT tag, book_id FROM book_tags") as c:
+            actual = {tuple(row) for row in await c.fetchall()}
+        # Ожидаемые ключи — через tag_key() в Python, чтобы заметить теги не в виде normalize_tags()
+        async with db.execute("SELECT id, tags FROM books WHERE coalesce(tags, '') != ''") as c:
+            expected = {(tag_key(t), row['id']) for row in await c.fetchall() for t in row['tags'].split(",") if t.strip()}
+        for k in actual ^ expected: mismatches[f"book_tags[{k[0]}, {k[1]}]"] = (int(k in actual), int(k in expected))
+    return mismatches
 
 async def get_stats():
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        stats = {}
-        
-        # Общие цифры
-        async with db.execute("SELECT COUNT(*) FROM users WHERE status = 'approved'") as c:
-            stats['total_users'] = (await c.fetchone())[0]
-        async with db.execute("SELECT COUNT(*) FROM books") as c:
-            stats['total_books'] = (await c.fetchone())[0]
-        async with db.execute("SELECT COUNT(*) FROM movements WHERE event_type = 'transfer'") as c:
-            stats['total_transfers'] = (await c.fetchone())[0]
+    # Счетчики и топы поддерживаются триггерами (STATS_SCHEMA), здесь только чтение
+    async with pool.acquire() as db:
+        async with db.execute(f"SELECT name, value FROM stats_counters WHERE name IN ({', '.join('?' * len(STATS_FROM_SCRATCH))})",
+                              tuple(STATS_FROM_SCRATCH)) as c:
+            stats = {row['name']: row['value'] for row in await c.fetchall()}
+        for name in STATS_FROM_SCRATCH: stats.setdefault(name, 0)
 
         # Топ-5 популярных книг (по количеству перемещений)
         query_top_books = """
-            SELECT b.title, COUNT(m.id) as count
-            FROM movements m
-            JOIN books b ON m.book_id = b.id
-            WHERE m.event_type = 'transfer'
-            GROUP BY m.book_id
-            ORDER BY count DESC
+            SELECT b.title, t.count
+            FROM book_transfer_counts t
+            JOIN books b ON t.book_id = b.id
+            ORDER BY t.count DESC
             LIMIT 5
         """
         async with db.execute(query_top_books) as c:
@@ -467,15 +1403,78 @@ async def get_stats():
 
         # Топ-5 активных читателей (кто получил больше всего книг)
         query_top_readers = """
-            SELECT u.real_name, u.username, COUNT(m.id) as count
-            FROM movements m
-            JOIN users u ON m.to_user_id = u.user_id
-            WHERE m.event_type = 'transfer'
-            GROUP BY m.to_user_id
-            ORDER BY count DESC
+            SELECT u.real_name, u.username, t.count
+            FROM reader_transfer_counts t
+            JOIN users u ON t.user_id = u.user_id
+            ORDER BY t.count DESC
             LIMIT 5
         """
         async with db.execute(query_top_readers) as c:
             stats['top_readers'] = await c.fetchall()
-            
+
         return stats
+
+async def get_cached_isbn(isbn):
+    """Данные книги из isbn_cache: dict, None (известно, что не найдена) или MISSING."""
+    async with pool.acquire() as db:
+        async with db.execute("SELECT data, expires_at FROM isbn_cache WHERE isbn = ?", (isbn,)) as cursor:
+            row = await cursor.fetchone()
+    if not row or row['expires_at'] < time.time(): return MISSING
+    return json.loads(row['data']) if row['data'] is not None else None
+
+async def cache_isbn(isbn, data, ttl):
+    async with pool.write() as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO isbn_cache (isbn, data, expires_at) VALUES (?, ?, ?)",
+            (isbn, json.dumps(data, ensure_ascii=False) if data is not None else None, int(time.time() + ttl))
+        )
+
+async def enqueue_messages(outbox):
+    """Кладет уведомления в outbox без изменения другого состояния."""
+    async with pool.write() as db:
+        await _add_outbox(db, outbox)
+
+async def fetch_outbox(limit):
+    async with pool.acquire() as db:
+        async with db.execute(
+            "SELECT * FROM outbox WHERE next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT ?",
+            (time.time(), limit)
+        ) as cursor:
+            return await cursor.fetchall()
+
+async def complete_outbox(ids):
+    if not ids: return
+    async with pool.write() as db:
+        await db.execute(f"DELETE FROM outbox WHERE id IN ({', '.join('?' * len(ids))})", tuple(ids))
+
+async def retry_outbox(message_id, delay):
+    async with pool.write() as db:
+        await db.execute(
+            "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?",
+            (time.time() + delay, message_id)
+        )
+
+async def load_fsm(key, ttl):
+    """(state, data) диалога или (None, {}), если записи нет или она простаивала дольше ttl секунд."""
+    async with pool.acquire() as db:
+        async with db.execute(
+            "SELECT state, data FROM fsm_storage WHERE key = ? AND updated_at > ?", (key, time.time() - ttl)
+        ) as cursor:
+            row = await cursor.fetchone()
+    if not row: return None, {}
+    return row['state'], json.loads(row['data']) if row['data'] else {}
+
+async def save_fsm(records):
+    """Записывает пачку {key: (state, data)} одной транзакцией; пустые записи удаляются."""
+    now = time.time()
+    rows = [(k, st, json.dumps(d, ensure_ascii=False), now) for k, (st, d) in records.items() if st is not None or d]
+    empty = [(k,) for k, (st, d) in records.items() if st is None and not d]
+    async with pool.write() as db:
+        if rows: await db.executemany("INSERT OR REPLACE INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?)", rows)
+        if empty: await db.executemany("DELETE FROM fsm_storage WHERE key = ?", empty)
+
+async def evict_fsm(ttl):
+    """Удаляет диалоги, брошенные больше ttl секунд назад. Возвращает число удаленных."""
+    async with pool.write() as db:
+        cursor = await db.execute("DELETE FROM fsm_storage WHERE updated_at <= ?", (time.time() - ttl,))
+        return cursor.rowcount
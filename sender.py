@@ -0,0 +1,216 @@
+import asyncio
+import bisect
+import contextvars
+import itertools
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup
+
+from models import outbox_event, fetch_outbox, complete_outbox, retry_outbox
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~1 в секунду в один чат
+GLOBAL_RATE = 30
+PER_CHAT_RATE = 1
+PER_CHAT_BURST = 3
+MAX_RETRIES = 3
+MAX_NOTIFICATION_QUEUE = 1000
+
+# Outbox: размер пачки, опрос отложенных повторов, экспоненциальная пауза между попытками
+OUTBOX_BATCH = 20
+OUTBOX_POLL_INTERVAL = 5
+OUTBOX_BACKOFF = 5
+OUTBOX_MAX_ATTEMPTS = 6
+
+# Приоритеты: меньше — раньше
+INTERACTIVE = 0
+NOTIFICATION = 1
+
+_priority = contextvars.ContextVar("send_priority", default=INTERACTIVE)
+
+# Методы API, которые расходуют лимит на отправку сообщений
+RATE_LIMITED_PREFIXES = ("Send", "Edit", "Copy", "Forward")
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now):
+        """Через сколько секунд будет доступен токен (0 — уже доступен)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until: return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def idle(self, now):
+        return self.delay(now) == 0 and self.tokens >= self.capacity
+
+class SendScheduler(BaseRequestMiddleware):
+    """Планировщик исходящих сообщений (request-middleware сессии бота).
+
+    Каждый вызов Send*/Edit*/... ждет токен из общего ведра и ведра своего чата.
+    Ожидающие обслуживаются по приоритету: ответы пользователю раньше
+    уведомлений (см. low_priority). На 429 (RetryAfter) чат ставится на паузу, а
+    запрос повторяется до MAX_RETRIES раз.
+    """
+    def __init__(self, global_rate=GLOBAL_RATE, per_chat_rate=PER_CHAT_RATE, per_chat_burst=PER_CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.chats = {}
+        self._waiting = []  # отсортирован по (приоритет, порядковый номер)
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._pump_task = None
+        self.sent = self.retries = self.dropped = self.failed = 0
+
+    async def __call__(self, make_request, bot, method):
+        if not type(method).__name__.startswith(RATE_LIMITED_PREFIXES):
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        priority = _priority.get()
+        if priority >= NOTIFICATION and self.queue_depth(NOTIFICATION) >= MAX_NOTIFICATION_QUEUE:
+            self.dropped += 1
+            raise TelegramAPIError(method, "Очередь уведомлений переполнена")
+        for attempt in range(MAX_RETRIES + 1):
+            await self._acquire(chat_id, priority)
+            try:
+                result = await make_request(bot, method)
+                self.sent += 1
+                return result
+            except TelegramRetryAfter as e:
+                if attempt == MAX_RETRIES:
+                    self.dropped += 1
+                    raise
+                self.retries += 1
+                logging.warning("RetryAfter %s с для чата %s", e.retry_after, chat_id)
+                bucket = self._bucket(chat_id) if chat_id is not None else self.global_bucket
+                bucket.blocked_until = time.monotonic() + e.retry_after
+            except TelegramAPIError:
+                self.failed += 1
+                raise
+
+    def _bucket(self, chat_id):
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) > 10_000:
+                # Забываем чаты, ведра которых уже полностью восстановились
+                now = time.monotonic()
+                self.chats = {k: b for k, b in self.chats.items() if not b.idle(now)}
+            bucket = self.chats[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+        return bucket
+
+    async def _acquire(self, chat_id, priority):
+        if self._pump_task is None or self._pump_task.done():
+            self._wakeup = asyncio.Event()
+            self._pump_task = asyncio.create_task(self._pump())
+        fut = asyncio.get_running_loop().create_future()
+        bisect.insort(self._waiting, (priority, next(self._seq), chat_id, fut))
+        self._wakeup.set()
+        await fut
+
+    async def _pump(self):
+        while True:
+            self._waiting = [w for w in self._waiting if not w[3].done()]
+            if not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            sleep_for = self.global_bucket.delay(now)
+            if not sleep_for:
+                sleep_for = float("inf")
+                for item in self._waiting:
+                    chat_id = item[2]
+                    chat_delay = self._bucket(chat_id).delay(now) if chat_id is not None else 0
+                    if not chat_delay:
+                        self._waiting.remove(item)
+                        self.global_bucket.take()
+                        if chat_id is not None: self._bucket(chat_id).take()
+                        item[3].set_result(None)
+                        sleep_for = 0
+                        break
+                    sleep_for = min(sleep_for, chat_delay)
+            if sleep_for:
+                # Ждем токен, но просыпаемся раньше, если пришел новый запрос
+                self._wakeup.clear()
+                try: await asyncio.wait_for(self._wakeup.wait(), sleep_for)
+                except asyncio.TimeoutError: pass
+            else:
+                await asyncio.sleep(0)
+
+    def queue_depth(self, priority=None):
+        return sum(1 for w in self._waiting if not w[3].done() and (priority is None or w[0] == priority))
+
+    def stats(self):
+        return {
+            'queue_interactive': self.queue_depth(INTERACTIVE),
+            'queue_notifications': self.queue_depth(NOTIFICATION),
+            'sent': self.sent, 'retries': self.retries, 'dropped': self.dropped, 'failed': self.failed,
+        }
+
+scheduler = SendScheduler()
+
+@contextmanager
+def low_priority():
+    """Отправки внутри блока считаются уведомлениями и пропускают вперед ответы пользователям."""
+    token = _priority.set(NOTIFICATION)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+def outbox_msg(chat_id, text, parse_mode=None, reply_markup=None):
+    """Строка для outbox=[...] функций models: (chat_id, text, JSON с параметрами отправки)."""
+    options = {}
+    if parse_mode: options['parse_mode'] = parse_mode
+    if reply_markup: options['reply_markup'] = reply_markup.model_dump(exclude_none=True)
+    return (chat_id, text, json.dumps(options, ensure_ascii=False))
+
+async def deliver(bot, msg):
+    """Отправляет сообщение из outbox с низким приоритетом. True — строку можно удалять
+    (отправлено или отправить невозможно), False — отложено для повтора."""
+    options = json.loads(msg['options'] or "{}")
+    if 'reply_markup' in options:
+        options['reply_markup'] = InlineKeyboardMarkup.model_validate(options['reply_markup'])
+    try:
+        with low_priority():
+            await bot.send_message(msg['chat_id'], msg['text'], **options)
+        return True
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        # Пользователь заблокировал бота или сообщение некорректно — повтор не поможет
+        logging.warning("outbox #%s для %s отброшено: %s", msg['id'], msg['chat_id'], e)
+        return True
+    except Exception as e:
+        if msg['attempts'] + 1 >= OUTBOX_MAX_ATTEMPTS:
+            logging.error("outbox #%s для %s: попытки исчерпаны: %r", msg['id'], msg['chat_id'], e)
+            return True
+        await retry_outbox(msg['id'], OUTBOX_BACKOFF * 2 ** msg['attempts'])
+        return False
+
+async def outbox_worker(bot):
+    """Фоновая задача: разбирает outbox пачками по OUTBOX_BATCH."""
+    event = outbox_event()
+    while True:
+        try:
+            event.clear()
+            batch = await fetch_outbox(OUTBOX_BATCH)
+            if batch:
+                done = await asyncio.gather(*(deliver(bot, m) for m in batch))
+                await complete_outbox([m['id'] for m, ok in zip(batch, done) if ok])
+                continue
+        except Exception:
+            logging.exception("outbox_worker")
+        try: await asyncio.wait_for(event.wait(), OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError: pass
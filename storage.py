@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import time
+from contextlib import suppress
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+from config import FSM_TTL_HOURS
+from models import load_fsm, save_fsm, evict_fsm
+
+# Запись откладывается на FSM_FLUSH_DELAY секунд, чтобы set_state + несколько
+# update_data одного хендлера ушли в базу одной строкой
+FSM_FLUSH_DELAY = 0.5
+FSM_FLUSH_BATCH = 500
+FSM_SWEEP_INTERVAL = 600
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище aiogram в таблице fsm_storage базы бота.
+
+    Состояние и данные диалога переживают перезапуск. Изменения копятся в
+    _pending и сбрасываются пачкой через FSM_FLUSH_DELAY (или сразу, если
+    накопилось FSM_FLUSH_BATCH ключей), поэтому в памяти держатся только
+    несохраненные записи. Диалоги, простаивающие дольше ttl, не читаются и
+    периодически удаляются из таблицы.
+    """
+    def __init__(self, ttl=FSM_TTL_HOURS * 3600):
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._pending = {}   # key -> [state, data], еще не записано
+        self._flushing = {}  # пачка, которая пишется прямо сейчас
+        self._flush_task = None
+        self._last_sweep = 0.0
+        self.writes = self.flushes = self.evicted = 0
+
+    async def _record(self, key):
+        """Актуальная запись [state, data] для изменения; заводит ее в _pending."""
+        record = self._pending.get(key)
+        if record is None:
+            if key in self._flushing:
+                state, data = self._flushing[key]
+            else:
+                state, data = await load_fsm(key, self.ttl)
+            # Пока ждали базу, ключ мог появиться в _pending
+            record = self._pending.setdefault(key, [state, dict(data)])
+        return record
+
+    async def _read(self, key):
+        record = self._pending.get(key) or self._flushing.get(key)
+        if record is not None: return record
+        return await load_fsm(key, self.ttl)
+
+    def _schedule_flush(self):
+        self.writes += 1
+        if len(self._pending) >= FSM_FLUSH_BATCH:
+            self._flush_task = asyncio.create_task(self.flush())
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(FSM_FLUSH_DELAY)
+        await self.flush()
+
+    async def flush(self):
+        """Сбрасывает накопленные изменения в базу и при необходимости чистит старые диалоги."""
+        if self._pending:
+            batch, self._pending = self._pending, {}
+            self._flushing.update(batch)
+            try:
+                await save_fsm(batch)
+                self.flushes += 1
+            except (Exception, asyncio.CancelledError) as e:
+                # Возвращаем пачку в очередь: следующий flush (или close) запишет ее снова
+                for key, record in batch.items():
+                    self._pending.setdefault(key, record)
+                if isinstance(e, asyncio.CancelledError): raise
+                logging.exception("Не удалось сохранить состояние FSM")
+            finally:
+                for key in batch:
+                    if self._flushing.get(key) is batch[key]: del self._flushing[key]
+        if time.monotonic() - self._last_sweep >= FSM_SWEEP_INTERVAL:
+            self._last_sweep = time.monotonic()
+            try: self.evicted += await evict_fsm(self.ttl)
+            except Exception: logging.exception("Не удалось удалить устаревшие состояния FSM")
+
+    async def set_state(self, key, state=None):
+        record = await self._record(self.key_builder.build(key))
+        record[0] = state.state if isinstance(state, State) else state
+        self._schedule_flush()
+
+    async def get_state(self, key):
+        return (await self._read(self.key_builder.build(key)))[0]
+
+    async def set_data(self, key, data):
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        record = await self._record(self.key_builder.build(key))
+        record[1] = data.copy()
+        self._schedule_flush()
+
+    async def get_data(self, key):
+        return dict((await self._read(self.key_builder.build(key)))[1])
+
+    async def close(self):
+        task = self._flush_task
+        if task and not task.done():
+            task.cancel()
+            with suppress(asyncio.CancelledError): await task
+        await self.flush()
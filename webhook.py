@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import secrets
+import time
+
+from aiohttp import web
+from aiogram import types
+
+import metrics
+from config import WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_MAX_CONCURRENCY
+from models import pool, user_cache
+from sender import scheduler
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def metrics_text():
+    """Метрики хендлеров и SQL плюс состояние планировщика отправки и кэша пользователей."""
+    stats, cache, db = scheduler.stats(), user_cache.stats(), pool.stats()
+    extra = metrics.simple_lines("bot_send_queue", "Ожидающие отправки сообщения", "gauge", {
+        'priority="interactive"': stats['queue_interactive'], 'priority="notification"': stats['queue_notifications']})
+    extra += metrics.simple_lines("bot_send_total", "Исходы отправок через планировщик", "counter", {
+        f'result="{k}"': stats[k] for k in ("sent", "retries", "dropped", "failed")})
+    extra += metrics.simple_lines("bot_user_cache_total", "Обращения к кэшу пользователей", "counter", {
+        'result="hit"': cache['hits'], 'result="miss"': cache['misses']})
+    extra += metrics.simple_lines("bot_db_write_queue", "Блоки записи в очереди писателя БД", "gauge", {None: db['write_queue']})
+    extra += metrics.simple_lines("bot_db_writes_total", "Изменения и групповые коммиты писателя БД", "counter", {
+        'kind="write"': db['writes'], 'kind="commit"': db['commits'], 'kind="failed_commit"': db['failed_commits']})
+    return metrics.expose(extra)
+
+async def handle_metrics(request):
+    return web.Response(body=metrics_text().encode(), headers={"Content-Type": PROMETHEUS_CONTENT_TYPE})
+
+class WebhookServer:
+    """Прием обновлений от Telegram по HTTP (aiohttp) вместо long polling.
+
+    Запрос без правильного секретного заголовка отклоняется с 401. Обновление
+    обрабатывается в фоне, а Telegram сразу получает 200. Одновременно в работе
+    не больше max_concurrency обновлений: когда все слоты заняты, ответ
+    задерживается и Telegram сам притормаживает доставку.
+    """
+    def __init__(self, dp, bot, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET, max_concurrency=WEBHOOK_MAX_CONCURRENCY):
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.max_concurrency = max_concurrency
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._tasks = set()
+        self.started_at = time.monotonic()
+        self.processed = self.failed = self.rejected = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get("/healthz", self.handle_health)
+        app.router.add_get("/metrics", handle_metrics)
+        return app
+
+    def _check_secret(self, request):
+        token = request.headers.get(SECRET_HEADER, "")
+        return secrets.compare_digest(token.encode(), self.secret.encode())
+
+    async def handle_update(self, request):
+        if not self._check_secret(request):
+            self.rejected += 1
+            return web.Response(status=401)
+        try:
+            update = types.Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception:
+            self.rejected += 1
+            return web.Response(status=400)
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+            self.processed += 1
+        except Exception:
+            self.failed += 1
+            logging.exception("Ошибка обработки обновления %s", update.update_id)
+        finally:
+            self._slots.release()
+
+    async def handle_health(self, request):
+        return web.json_response({
+            'status': 'ok',
+            'uptime': round(time.monotonic() - self.started_at),
+            'in_flight': len(self._tasks),
+            'max_concurrency': self.max_concurrency,
+            'processed': self.processed, 'failed': self.failed, 'rejected': self.rejected,
+            'sender': scheduler.stats(),
+        })
+
+    async def drain(self):
+        """Дожидается обновлений, которые уже приняты, но еще обрабатываются."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+async def run_webhook(dp, bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+    """Регистрирует вебхук в Telegram и обслуживает его до отмены задачи."""
+    if not (WEBHOOK_URL and WEBHOOK_SECRET):
+        raise RuntimeError("Для BOT_MODE=webhook нужны WEBHOOK_URL и WEBHOOK_SECRET")
+    server = WebhookServer(dp, bot)
+    runner = web.AppRunner(server.app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONCURRENCY, allowed_updates=dp.resolve_used_update_types(),
+    )
+    logging.info("Вебхук слушает %s:%s%s", host, port, WEBHOOK_PATH)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await server.drain()
+
+async def run_metrics_server(host, port):
+    """Отдельный HTTP-сервер с /metrics для режима polling (в режиме вебхука он на том же сервере)."""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info("Метрики: http://%s:%s/metrics", host, port)
+    return runner